@@ -1,13 +1,51 @@
-from fastapi import APIRouter
-from .endpoints import tokens, messages, analytics
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse, PlainTextResponse
+from ...core.health import readiness_report
+from ...core.metrics import metrics
+from ...core.security import require_token
+from ...core.services import services
+from .endpoints import tokens, messages, analytics, chat
 
 router = APIRouter()
 
 # Incluir los routers de los diferentes endpoints
+# La emisión de tokens y los endpoints de operación no requieren JWT; el resto sí
 router.include_router(tokens.router, prefix="/tokens", tags=["tokens"])
-router.include_router(messages.router, prefix="/messages", tags=["messages"])
-router.include_router(analytics.router, prefix="/analytics", tags=["analytics"])
+router.include_router(
+    messages.router, prefix="/messages", tags=["messages"],
+    dependencies=[Depends(require_token)]
+)
+# El WebSocket de chat valida el JWT por sí mismo (parámetro `token`)
+router.include_router(chat.router, prefix="/messages", tags=["chat"])
+router.include_router(
+    analytics.router, prefix="/analytics", tags=["analytics"],
+    dependencies=[Depends(require_token)]
+)
 
 @router.get("/health-check")
 async def health_check():
-    return {"status": "ok"}
\ No newline at end of file
+    return {"status": "ok"}
+
+@router.get("/live")
+async def liveness():
+    """Liveness: el proceso responde (no consulta ningún servicio)"""
+    return {"status": "ok"}
+
+@router.get("/ready")
+async def readiness():
+    """
+    Readiness: 503 si el pool de conexiones, el event loop, las llamadas al LLM en curso
+    o la cola de admisión superan sus umbrales (READY_MAX_*)
+    """
+    report = readiness_report(services)
+    return JSONResponse(report, status_code=200 if report["status"] == "ready" else 503)
+
+@router.get("/boot-stats")
+async def boot_stats():
+    """Tiempos de arranque del worker y de inicialización de cada servicio"""
+    return services.boot_report()
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Métricas del worker en formato de texto de Prometheus"""
+    return metrics.render()
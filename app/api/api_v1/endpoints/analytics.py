@@ -1,22 +1,48 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from typing import Dict, Any, List
-from ....core.mcp_handler import MCPHandler
-from ....core.database import get_db
-from ....schemas.message import EvaluacionCreate, EvaluacionResponse
+from typing import Dict, Any, List, Optional
+import asyncio
+import functools
+import math
+import time
+from ....core.admission import AdmissionRejected
+from ....core.config import settings
+from ....core.http_cache import is_not_modified, make_etag, not_modified, set_validators
+from ....core.export import EXPORT_ENTITIES, EXPORT_FORMATS, ExportError, stream_export
+from ....core.mcp_handler import ANALYZE_LEAD_FLIGHT, EvaluationFailedError, MCPHandler, analysis_response
+from ....core.database import get_db, get_read_db
+from ....core.services import get_mcp_handler, get_services, get_traffic_recorder, ServiceContainer
+from ....core.traffic import TrafficRecorder
+from ....schemas.message import EvaluacionResponse, LeadProfileCreate
 from datetime import datetime
 
 router = APIRouter()
-mcp_handler = MCPHandler()
 
 @router.post("/analyze-lead", response_model=Dict[str, Any])
 async def analyze_lead(
     lead_id: int,
-    db: Session = Depends(get_db)
+    force_full: bool = False,
+    db: Session = Depends(get_db),
+    mcp_handler: MCPHandler = Depends(get_mcp_handler),
+    services: ServiceContainer = Depends(get_services),
+    recorder: Optional[TrafficRecorder] = Depends(get_traffic_recorder)
 ):
     """
-    Analiza un lead usando el sistema MCP para generar insights sin exponer datos personales
+    Analiza un lead usando el sistema MCP para generar insights sin exponer datos personales.
+
+    La evaluación es incremental: solo se envían al LLM los mensajes posteriores a la
+    última evaluación, junto con sus scores y resumen (`force_full=true` reevalúa todo el
+    historial). Las peticiones concurrentes para el mismo lead comparten un solo análisis,
+    y si no hay mensajes nuevos se devuelve la evaluación guardada. Si se supera la cuota
+    de llamadas al LLM se responde 429.
     """
+    if recorder is not None:
+        recorder.record_request(
+            "analytics.analyze_lead", "POST", "/analytics/analyze-lead",
+            lead_id=lead_id, params={"force_full": force_full}
+        )
     try:
         # Buscar el token anónimo existente o crear uno nuevo
         from ....models.chat import PIIToken
@@ -24,119 +50,395 @@ async def analyze_lead(
             PIIToken.lead_id == lead_id,
             PIIToken.is_active == True
         ).first()
-        
+
         if not pii_token:
             token_anonimo = mcp_handler.create_pii_token(db, lead_id)
         else:
             token_anonimo = pii_token.token_anonimo
-        
-        # Obtener datos del lead de manera segura
-        from ....models.chat import MensajeSanitizado, ContextoConversacional
-        mensajes = db.query(MensajeSanitizado).filter(
-            MensajeSanitizado.token_anonimo == token_anonimo
-        ).all()
-        
-        contexto = db.query(ContextoConversacional).filter(
-            ContextoConversacional.token_anonimo == token_anonimo
-        ).order_by(ContextoConversacional.relevancia_score.desc()).all()
-        
-        # Preparar datos para análisis
-        data_for_analysis = {
-            "mensajes_sanitizados": [
-                {
-                    "contenido": msg.contenido_sanitizado,
-                    "metadata": msg.metadata_sanitizada,
-                    "timestamp": msg.created_at.isoformat()
-                }
-                for msg in mensajes
-            ],
-            "contexto_relevante": [
-                {
-                    "tipo": ctx.tipo_contexto,
-                    "contenido": ctx.contenido_sanitizado,
-                    "relevancia": ctx.relevancia_score
-                }
-                for ctx in contexto
-            ]
-        }
-        
-        # Procesar con el LLM
-        llm_context = mcp_handler.prepare_data_for_llm(data_for_analysis)
-        
-        # Realizar evaluación
-        evaluacion = EvaluacionCreate(
-            lead_id=lead_id,
-            conversacion_id=0,  # Se puede actualizar si es necesario
-            mensaje_id=0,  # Se puede actualizar si es necesario
-            llm_configuracion_id=1,  # Usar configuración por defecto
-            prompt_utilizado="Análisis completo de lead",
-            score_potencial=0.0,  # Se actualizará con el resultado del LLM
-            score_satisfaccion=0.0,  # Se actualizará con el resultado del LLM
-            interes_productos={},  # Se actualizará con el resultado del LLM
-            palabras_clave=[]  # Se actualizará con el resultado del LLM
+
+        # Marca de agua de los datos: último mensaje y último contexto del lead
+        watermark = mcp_handler.lead_data_watermark(db, token_anonimo)
+
+        # Si nada cambió desde la última evaluación, se reutiliza
+        if not force_full:
+            evaluacion_actual = mcp_handler.current_evaluation(db, lead_id, watermark)
+            if evaluacion_actual:
+                mcp_handler.llm_handler.record_cache_hit("evaluacion")
+                return analysis_response(
+                    evaluacion_actual,
+                    {
+                        "timestamp": evaluacion_actual.fecha_evaluacion.isoformat(),
+                        "data_version": "1.0",
+                        "context_type": "crm_profile_analysis"
+                    },
+                    cached=True
+                )
+
+        async def run_analysis() -> Dict[str, Any]:
+            # El análisis sobrevive a esta petición si el cliente se desconecta (lo esperan
+            # otras peticiones del single-flight): usa su propia sesión
+            analysis_db = services.session_factory()
+            try:
+                evaluacion, metadata = await mcp_handler.analyze_lead(
+                    analysis_db, lead_id, token_anonimo, force_full=force_full
+                )
+                return analysis_response(evaluacion, metadata, cached=False)
+            except Exception:
+                analysis_db.rollback()
+                raise
+            finally:
+                analysis_db.close()
+
+        return await services.single_flight(ANALYZE_LEAD_FLIGHT).do(
+            (lead_id, watermark, force_full), run_analysis
         )
-        
-        resultado_evaluacion = mcp_handler.evaluate_conversation(
-            db=db,
-            lead_id=evaluacion.lead_id,
-            conversacion_id=evaluacion.conversacion_id,
-            mensaje_id=evaluacion.mensaje_id,
-            llm_config_id=evaluacion.llm_configuracion_id,
-            contenido_sanitizado=str(llm_context),
-            prompt_template=evaluacion.prompt_utilizado
+
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
         )
-        
-        return {
-            "analysis_id": resultado_evaluacion.id,
-            "timestamp": datetime.now().isoformat(),
-            "lead_analysis": {
-                "score_potencial": resultado_evaluacion.score_potencial,
-                "score_satisfaccion": resultado_evaluacion.score_satisfaccion,
-                "intereses": resultado_evaluacion.interes_productos,
-                "palabras_clave": resultado_evaluacion.palabras_clave,
-                "metadata": llm_context["metadata"]
-            }
-        }
-        
+    except EvaluationFailedError as e:
+        raise HTTPException(status_code=502, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/lead-metrics/{lead_id}", response_model=Dict[str, Any])
 async def get_lead_metrics(
     lead_id: int,
-    db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
+    services: ServiceContainer = Depends(get_services),
+    recorder: Optional[TrafficRecorder] = Depends(get_traffic_recorder)
 ):
     """
-    Obtiene métricas históricas de un lead de manera segura
+    Obtiene métricas históricas de un lead de manera segura.
+
+    La respuesta lleva ETag y Last-Modified derivados de la última evaluación del lead;
+    si el cliente revalida (If-None-Match / If-Modified-Since) y no hay evaluaciones
+    nuevas, se responde 304 tras una sola consulta al índice.
     """
+    if recorder is not None:
+        recorder.record_request(
+            "analytics.lead_metrics", "GET", "/analytics/lead-metrics/{lead_id}", lead_id=lead_id
+        )
     try:
         from ....models.chat import EvaluacionLLM
-        evaluaciones = db.query(EvaluacionLLM).filter(
-            EvaluacionLLM.lead_id == lead_id
-        ).order_by(EvaluacionLLM.fecha_evaluacion.desc()).all()
-        
-        if not evaluaciones:
+
+        # Marca de agua: la última evaluación del lead. Mientras no cambie, el resultado se reutiliza
+        # (el conteo cubre evaluaciones borradas); se resuelve con ix_evaluaciones_lead_fecha
+        watermark, last_modified, total = db.query(
+            func.max(EvaluacionLLM.id),
+            func.max(EvaluacionLLM.fecha_evaluacion),
+            func.count(EvaluacionLLM.id)
+        ).filter(EvaluacionLLM.lead_id == lead_id).one()
+        etag = make_etag("lead-metrics", lead_id, watermark or 0, total)
+        if is_not_modified(request, etag, last_modified):
+            return not_modified("lead_metrics", etag, last_modified)
+        set_validators(response, etag, last_modified)
+
+        def load_evaluations() -> List[Any]:
+            # El cálculo del single-flight sobrevive a esta petición: usa su propia sesión
+            metrics_db = services.replica_router.read_session()
+            try:
+                return metrics_db.query(EvaluacionLLM).filter(
+                    EvaluacionLLM.lead_id == lead_id
+                ).order_by(EvaluacionLLM.fecha_evaluacion.desc()).all()
+            finally:
+                metrics_db.close()
+
+        async def compute_metrics() -> Dict[str, Any]:
+            evaluaciones = load_evaluations()
+
+            if not evaluaciones:
+                return {
+                    "message": "No hay evaluaciones disponibles para este lead",
+                    "evaluaciones": []
+                }
+
             return {
-                "message": "No hay evaluaciones disponibles para este lead",
-                "evaluaciones": []
+                "total_evaluaciones": len(evaluaciones),
+                "ultima_evaluacion": evaluaciones[0].fecha_evaluacion.isoformat(),
+                "promedio_score_potencial": sum(e.score_potencial for e in evaluaciones) / len(evaluaciones),
+                "promedio_score_satisfaccion": sum(e.score_satisfaccion for e in evaluaciones) / len(evaluaciones),
+                "historial": [
+                    {
+                        "fecha": e.fecha_evaluacion.isoformat(),
+                        "score_potencial": e.score_potencial,
+                        "score_satisfaccion": e.score_satisfaccion,
+                        "intereses": e.interes_productos,
+                        "palabras_clave": e.palabras_clave
+                    }
+                    for e in evaluaciones
+                ]
             }
-        
-        return {
-            "total_evaluaciones": len(evaluaciones),
-            "ultima_evaluacion": evaluaciones[0].fecha_evaluacion.isoformat(),
-            "promedio_score_potencial": sum(e.score_potencial for e in evaluaciones) / len(evaluaciones),
-            "promedio_score_satisfaccion": sum(e.score_satisfaccion for e in evaluaciones) / len(evaluaciones),
-            "historial": [
-                {
-                    "fecha": e.fecha_evaluacion.isoformat(),
-                    "score_potencial": e.score_potencial,
-                    "score_satisfaccion": e.score_satisfaccion,
-                    "intereses": e.interes_productos,
-                    "palabras_clave": e.palabras_clave
-                }
-                for e in evaluaciones
-            ]
-        }
-        
+
+        flight = services.single_flight("lead-metrics", max_results=settings.LEAD_METRICS_CACHE_SIZE)
+        return await flight.do((lead_id, watermark, total), compute_metrics)
+
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/export/{entity}")
+async def export_data(
+    entity: str,
+    format: str = "ndjson",
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    chatbot_id: Optional[int] = None,
+    services: ServiceContainer = Depends(get_services)
+):
+    """
+    Exporta evaluaciones, mensajes sanitizados o contexto conversacional en NDJSON, CSV o Parquet.
+    Las filas se leen con un cursor del servidor y se envían por fragmentos (chunked),
+    por lo que la memoria no crece con el número de filas.
+    """
+    if entity not in EXPORT_ENTITIES:
+        raise HTTPException(status_code=400, detail=f"Entidad no soportada. Opciones: {', '.join(EXPORT_ENTITIES)}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato no soportado. Opciones: {', '.join(EXPORT_FORMATS)}")
+
+    try:
+        content = stream_export(
+            services.read_engine,
+            entity,
+            format,
+            desde=desde,
+            hasta=hasta,
+            chatbot_id=chatbot_id,
+            chunk_size=settings.EXPORT_CHUNK_SIZE
+        )
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return StreamingResponse(
+        content,
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{entity}.{format}"'}
+    )
+
+@router.post("/lead-profiles", response_model=Dict[str, Any])
+async def upsert_lead_profiles(
+    profiles: List[LeadProfileCreate],
+    db: Session = Depends(get_db),
+    mcp_handler: MCPHandler = Depends(get_mcp_handler),
+    services: ServiceContainer = Depends(get_services)
+):
+    """
+    Materializa en el almacén de features las métricas de perfil de uno o varios leads
+    (datos académicos, skills y conteos, sin información personal). Si el lead ya
+    existía, sus features se reemplazan. Las features se guardan en `lead_profile_features`
+    y los demás workers las incorporan en su siguiente sincronización. Los agregados por
+    cohorte de estos leads se recalculan con su cohorte actual.
+    """
+    from ....models.chat import LeadProfileFeatures
+    try:
+        analytics = [
+            (perfil.lead_id, mcp_handler.extract_profile_analytics(perfil.profile))
+            for perfil in profiles
+        ]
+    except (KeyError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"Perfil no válido: {str(e)}")
+    ahora = datetime.utcnow()
+    for lead_id, features in analytics:
+        db.merge(LeadProfileFeatures(lead_id=lead_id, analytics=features, updated_at=ahora))
+    db.commit()
+    procesados = services.feature_store.upsert_many(analytics)
+    await asyncio.get_running_loop().run_in_executor(
+        None, services.cohort_rollups.backfill, services.engine, [lead_id for lead_id, _ in analytics]
+    )
+
+    return {
+        "procesados": procesados,
+        "leads_indexados": services.feature_store.size
+    }
+
+@router.get("/similar-leads", response_model=Dict[str, Any])
+async def similar_leads(
+    lead_id: int,
+    k: int = 10,
+    metric: str = "jaccard",
+    same: List[str] = Query(default=[]),
+    services: ServiceContainer = Depends(get_services),
+    recorder: Optional[TrafficRecorder] = Depends(get_traffic_recorder)
+):
+    """
+    Devuelve los `k` leads con skills más parecidas a las de `lead_id` (Jaccard o coseno
+    sobre los bitsets del almacén de features). Con `same` (p. ej. `same=program_id`)
+    solo se consideran leads que comparten esos campos académicos.
+    """
+    if recorder is not None:
+        recorder.record_request(
+            "analytics.similar_leads", "GET", "/analytics/similar-leads",
+            lead_id=lead_id, params={"k": k, "metric": metric, "same": same}
+        )
+    if k < 1 or k > settings.SIMILAR_LEADS_MAX_K:
+        raise HTTPException(status_code=400, detail=f"k debe estar entre 1 y {settings.SIMILAR_LEADS_MAX_K}")
+
+    store = services.feature_store
+    start = time.perf_counter()
+    try:
+        # El cálculo recorre todos los leads: se hace fuera del event loop (NumPy libera el GIL)
+        resultados = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(store.similar, lead_id, k=k, metric=metric, same=same)
+        )
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "lead_id": lead_id,
+        "metric": metric,
+        "leads_indexados": store.size,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+        "similares": resultados
+    }
+
+@router.get("/cohorts", response_model=Dict[str, Any])
+async def cohort_analytics(
+    dimension: str = "program_id",
+    valor: Optional[str] = None,
+    min_total: int = 1,
+    db: Session = Depends(get_read_db),
+    services: ServiceContainer = Depends(get_services),
+    recorder: Optional[TrafficRecorder] = Depends(get_traffic_recorder)
+):
+    """
+    Distribución de `score_potencial` por cohorte (`university_id`, `faculty_id`,
+    `program_id` o `graduation_year`): conteo, media, desviación, percentiles e histograma.
+    Los agregados se mantienen al insertar cada evaluación, así que la consulta no
+    recorre las evaluaciones.
+    """
+    if recorder is not None:
+        recorder.record_request(
+            "analytics.cohorts", "GET", "/analytics/cohorts",
+            params={"dimension": dimension, "valor": valor, "min_total": min_total}
+        )
+    try:
+        cohortes = services.cohort_rollups.query(db, dimension, valor=valor, min_total=min_total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "dimension": dimension,
+        "max_score": settings.COHORT_MAX_SCORE,
+        "cohortes": cohortes
+    }
+
+@router.get("/llm-usage", response_model=Dict[str, Any])
+async def llm_usage(
+    group_by: List[str] = Query(default=["chatbot", "modelo", "dia"]),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    order_by: str = "costo",
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    services: ServiceContainer = Depends(get_services),
+    recorder: Optional[TrafficRecorder] = Depends(get_traffic_recorder)
+):
+    """
+    Uso del LLM agregado por chatbot, modelo, día u operación: llamadas, tokens, coste en
+    USD, latencia media/máxima (y p95 en PostgreSQL), tasa de aciertos de caché y de errores.
+    `order_by=costo|latencia|llamadas|tokens` permite encontrar los chatbots más caros o lentos.
+    Se lee del primario: el buffer se acaba de volcar ahí y la réplica podría no tenerlo aún.
+    """
+    if recorder is not None:
+        recorder.record_request(
+            "analytics.llm_usage", "GET", "/analytics/llm-usage",
+            params={"group_by": group_by, "desde": desde, "hasta": hasta, "order_by": order_by, "limit": limit}
+        )
+    ledger = services.usage_ledger
+    # Las entradas aún en el buffer se vuelcan para que el informe esté al día
+    ledger.flush()
+    try:
+        filas = ledger.report(
+            db, group_by, desde=desde, hasta=hasta, order_by=order_by, limit=min(limit, 1000)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "group_by": group_by,
+        "order_by": order_by,
+        "filas": filas
+    }
+
+@router.post("/score-leads", response_model=Dict[str, Any])
+async def score_leads(
+    lead_ids: List[int],
+    db: Session = Depends(get_read_db),
+    services: ServiceContainer = Depends(get_services)
+):
+    """
+    Puntúa un lote de leads con el modelo local (sin LLM) e indica cuáles se escalarían
+    al LLM y por qué (`sin_modelo`, `modelo_impreciso`, `incierto`, `alto_valor`, `muestreo`).
+    """
+    scorer = services.lead_scorer
+    if scorer is None:
+        raise HTTPException(status_code=404, detail="El scoring local está desactivado")
+    if not lead_ids or len(lead_ids) > settings.LEAD_SCORING_BATCH_MAX:
+        raise HTTPException(
+            status_code=400, detail=f"Se admiten entre 1 y {settings.LEAD_SCORING_BATCH_MAX} leads por lote"
+        )
+
+    start = time.perf_counter()
+    resultados = scorer.score(db, list(dict.fromkeys(lead_ids)))
+    return {
+        "modelo": scorer.model.info(),
+        "escalados": sum(1 for r in resultados if r["escalar"]),
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+        "leads": resultados
+    }
+
+@router.get("/lead-scoring", response_model=Dict[str, Any])
+async def lead_scoring_stats(services: ServiceContainer = Depends(get_services)):
+    """
+    Estado del scoring local: modelo (muestras, RMSE y acuerdo en validación), evaluaciones
+    resueltas en local y por el LLM desde el arranque del worker, reducción de llamadas al
+    LLM y acuerdo con el LLM en los leads que se evaluaron con ambos.
+    """
+    scorer = services.lead_scorer
+    if scorer is None:
+        raise HTTPException(status_code=404, detail="El scoring local está desactivado")
+    return scorer.stats()
+
+@router.post("/lead-scoring/train", response_model=Dict[str, Any])
+async def train_lead_scoring(
+    db: Session = Depends(get_read_db),
+    services: ServiceContainer = Depends(get_services)
+):
+    """
+    Entrena el modelo local con las últimas `LEAD_SCORING_TRAIN_LIMIT` evaluaciones del LLM
+    (features en el instante de cada evaluación). El modelo nuevo reemplaza al anterior y,
+    con `LEAD_SCORING_MODEL_PATH`, se guarda para los demás arranques.
+    """
+    scorer = services.lead_scorer
+    if scorer is None:
+        raise HTTPException(status_code=404, detail="El scoring local está desactivado")
+
+    start = time.perf_counter()
+    X, Y = scorer.training_set(db)
+    try:
+        # El descenso de gradiente es NumPy puro: fuera del event loop
+        info = await asyncio.get_running_loop().run_in_executor(None, scorer.fit, X, Y)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    return {
+        **info,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 3)
+    }
+
+@router.get("/faq", response_model=Dict[str, Any])
+async def faq_stats(services: ServiceContainer = Depends(get_services)):
+    """
+    Respuestas directas desde `qa_pares` desde el arranque del worker: consultas, aciertos,
+    tasa de aciertos y latencia ahorrada (latencia media del LLM menos la del match).
+    """
+    faq = services.faq
+    if faq is None:
+        raise HTTPException(status_code=404, detail="Las respuestas directas de preguntas frecuentes están desactivadas")
+    return faq.stats()
@@ -0,0 +1,232 @@
+from fastapi import APIRouter, Header, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from typing import Dict, Any, Optional
+import asyncio
+import json
+import jwt
+from contextlib import AsyncExitStack
+from ....core.config import settings
+from ....core.admission import AdmissionRejected
+from ....core.chat_session import ChatSession
+from ....core.concurrency import ConversationBusyError
+from ....core.notifications import missed_messages
+from ....core.services import services
+
+router = APIRouter()
+
+async def _run_turn(websocket: WebSocket, db, session: ChatSession, contenido: str, metadata: dict):
+    mcp_handler = services.mcp_handler
+    llm_handler = services.llm_handler
+
+    session.refresh(db)
+    contenido_sanitizado, metadata_sanitizada = await mcp_handler.anonymize_message(contenido, metadata)
+    # Las preguntas frecuentes se responden con su respuesta ideal, sin LLM ni cuota
+    faq = None
+    if session.chatbot_activo and services.faq is not None:
+        faq = services.faq.match(db, session.chatbot_id, contenido_sanitizado)
+    # Las lecturas anteriores no retienen su conexión del pool mientras se espera la admisión
+    db.rollback()
+    # Solo los turnos que responde el LLM consumen cuota; se admiten antes de guardar el
+    # mensaje para que un rechazo pueda reintentarse sin duplicados, y antes de bloquear la
+    # conversación para que la espera en la cola no retenga la conexión del bloqueo
+    async with AsyncExitStack() as turn_scope:
+        ticket = None
+        if session.chatbot_activo and faq is None:
+            ticket = await turn_scope.enter_async_context(services.admission.admit(session.chatbot_id))
+        await turn_scope.enter_async_context(services.conversation_locks.hold(session.lead_id, session.chatbot_id))
+        mensaje_id, mensaje_sanitizado_id, contenido_sanitizado = session.record_user_message(
+            db, contenido, metadata, contenido_sanitizado, metadata_sanitizada
+        )
+        # La sesión WebSocket guarda su propio historial: el de /sanitize queda obsoleto
+        if services.conversation_state is not None:
+            services.conversation_state.invalidate(lead_id=session.lead_id, chatbot_id=session.chatbot_id)
+        await websocket.send_json({
+            "type": "ack",
+            "mensaje_id": mensaje_id,
+            "mensaje_sanitizado_id": mensaje_sanitizado_id,
+            "contenido_sanitizado": contenido_sanitizado
+        })
+
+        if faq is not None:
+            llm_handler.record_cache_hit("chat", chatbot_id=session.chatbot_id)
+            partes = [faq["respuesta"]]
+            await websocket.send_json({"type": "delta", "content": faq["respuesta"]})
+            metadata_llm = {
+                "model": "faq",
+                "provider": "qa_pares",
+                "streamed": False,
+                "faq": {key: faq[key] for key in ("qa_id", "score", "exacta", "match_ms")}
+            }
+        elif ticket is None:
+            await websocket.send_json({"type": "done", "llm_mensaje_id": None})
+            return
+        else:
+            partes = []
+            async for delta in llm_handler.stream_reply(
+                session.llm_messages(), chatbot_id=session.chatbot_id, ticket=ticket
+            ):
+                partes.append(delta)
+                await websocket.send_json({"type": "delta", "content": delta})
+            metadata_llm = {
+                "model": llm_handler.model,
+                "provider": llm_handler.provider,
+                "streamed": True
+            }
+
+        llm_mensaje_id = session.record_reply(db, "".join(partes), metadata_llm)
+        if services.conversation_state is not None:
+            services.conversation_state.invalidate(lead_id=session.lead_id, chatbot_id=session.chatbot_id)
+        await websocket.send_json({
+            "type": "done",
+            "llm_mensaje_id": llm_mensaje_id,
+            "llm_metadata": metadata_llm
+        })
+
+@router.websocket("/ws")
+async def chat_websocket(
+    websocket: WebSocket,
+    lead_id: int,
+    chatbot_id: int,
+    canal_id: Optional[int] = None,
+    token: Optional[str] = None
+):
+    """
+    Canal de chat por WebSocket. La sesión mantiene en memoria la conversación, el token
+    anónimo, el prompt del chatbot y el historial reciente; la respuesta se envía token a token.
+
+    Mensajes del cliente: {"contenido": str, "metadata": dict}
+    Eventos del servidor: session, ack, delta, done, error
+    """
+    # Los navegadores no permiten cabeceras en WebSocket: el JWT llega como parámetro `token`
+    if settings.AUTH_REQUIRED:
+        try:
+            services.token_verifier.verify(token or "")
+        except jwt.InvalidTokenError:
+            await websocket.close(code=1008)
+            return
+
+    await websocket.accept()
+    db = services.session_factory()
+    try:
+        try:
+            session = ChatSession.open(
+                db, services.mcp_handler, services.llm_handler,
+                lead_id=lead_id, chatbot_id=chatbot_id, canal_id=canal_id
+            )
+        except LookupError as e:
+            await websocket.send_json({"type": "error", "detail": str(e)})
+            await websocket.close(code=1008)
+            return
+
+        await websocket.send_json({
+            "type": "session",
+            "conversacion_id": session.conversacion_id,
+            "token_anonimo": session.token_anonimo,
+            "chatbot_activo": session.chatbot_activo
+        })
+
+        while True:
+            data = await websocket.receive_json()
+            contenido = data.get("contenido") if isinstance(data, dict) else None
+            if not contenido:
+                await websocket.send_json({"type": "error", "detail": "El campo 'contenido' es obligatorio"})
+                continue
+            try:
+                await _run_turn(websocket, db, session, contenido, data.get("metadata") or {})
+            except (ConversationBusyError, AdmissionRejected) as e:
+                await websocket.send_json({"type": "error", "detail": str(e), "retry": True})
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                db.rollback()
+                await websocket.send_json({"type": "error", "detail": f"Error al procesar el mensaje: {str(e)}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        db.close()
+
+def _sse(evento: Dict[str, Any], name: str = "mensaje") -> str:
+    data = json.dumps(evento, ensure_ascii=False, separators=(",", ":"))
+    event_id = f"id: {evento['mensaje_id']}\n" if "mensaje_id" in evento else ""
+    return f"{event_id}event: {name}\ndata: {data}\n\n"
+
+def _load_missed(after_id: int, lead_id: Optional[int], chatbot_id: Optional[int]):
+    db = services.session_factory()
+    try:
+        return missed_messages(
+            db, after_id, lead_id=lead_id, chatbot_id=chatbot_id,
+            limit=settings.MESSAGE_NOTIFY_REPLAY_LIMIT
+        )
+    finally:
+        db.close()
+
+@router.get("/stream")
+async def stream_messages(
+    request: Request,
+    lead_id: Optional[int] = None,
+    chatbot_id: Optional[int] = None,
+    token: Optional[str] = None,
+    authorization: Optional[str] = Header(None),
+    last_event_id: Optional[int] = Header(None, alias="Last-Event-ID")
+):
+    """
+    Mensajes nuevos en tiempo real (Server-Sent Events), filtrados por lead y/o chatbot.
+    Sustituye a la consulta periódica de la tabla `mensajes`: cada worker escucha el canal
+    con una sola conexión y reparte los avisos entre sus suscriptores.
+
+    Eventos: `mensaje` (con `id` = mensaje_id) y `resync` si se perdieron avisos; el
+    cliente que reconecta con la cabecera Last-Event-ID recibe primero los mensajes que
+    no vio. EventSource no admite cabeceras: el JWT puede llegar como parámetro `token`.
+    """
+    if lead_id is None and chatbot_id is None:
+        raise HTTPException(status_code=400, detail="Indique lead_id o chatbot_id")
+    if settings.AUTH_REQUIRED:
+        if token is None and authorization and authorization.lower().startswith("bearer "):
+            token = authorization[7:]
+        try:
+            services.token_verifier.verify(token or "")
+        except jwt.InvalidTokenError:
+            raise HTTPException(status_code=401, detail="Token inválido", headers={"WWW-Authenticate": "Bearer"})
+    notifier = services.message_notifier
+    if notifier is None:
+        raise HTTPException(status_code=503, detail="Las notificaciones de mensajes están desactivadas")
+
+    async def events():
+        # La suscripción se abre antes de leer lo perdido para no dejar huecos entre ambos
+        subscription = notifier.subscribe(lead_id=lead_id, chatbot_id=chatbot_id)
+        try:
+            visto = last_event_id or 0
+            recuperados = set()
+            if last_event_id is not None:
+                perdidos = await asyncio.get_running_loop().run_in_executor(
+                    None, _load_missed, last_event_id, lead_id, chatbot_id
+                )
+                for evento in perdidos:
+                    recuperados.add(evento["mensaje_id"])
+                    visto = max(visto, evento["mensaje_id"])
+                    yield _sse(evento)
+            while not await request.is_disconnected():
+                if subscription.lost:
+                    subscription.lost = False
+                    yield _sse({"ultimo_mensaje_id": visto}, "resync")
+                try:
+                    evento = await asyncio.wait_for(
+                        subscription.queue.get(), timeout=settings.MESSAGE_NOTIFY_HEARTBEAT_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    # Comentario SSE: mantiene abierta la conexión a través de proxies
+                    yield ": ping\n\n"
+                    continue
+                # Un aviso puede llegar también en la recuperación inicial
+                if evento["mensaje_id"] in recuperados:
+                    continue
+                visto = max(visto, evento["mensaje_id"])
+                yield _sse(evento)
+        finally:
+            notifier.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
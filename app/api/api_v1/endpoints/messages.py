@@ -1,6 +1,6 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Header, Request, Response
 from sqlalchemy.orm import Session
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from ....schemas.message import (
     MensajeCreate,
     MensajeSanitizadoResponse,
@@ -17,65 +17,224 @@ from ....schemas.message import (
     MensajeFrontendCreate,
     MensajeFrontendResponse
 )
-from ....core.mcp_handler import MCPHandler
+from ....core.mcp_handler import EvaluationFailedError, MCPHandler
 from ....core.database import get_db
 from ....core.llm_handler import LLMHandler
+from ....core.services import (
+    get_mcp_handler,
+    get_llm_handler,
+    get_conversation_locks,
+    get_admission,
+    get_traffic_recorder,
+    get_evaluation_scheduler,
+    get_conversation_state,
+    get_faq
+)
+from ....core.admission import AdmissionController, AdmissionRejected, AdmissionTicket
+from ....core.concurrency import ConversationLocks, ConversationBusyError
+from ....core.conversation_state import ConversationStateStore
+from ....core.evaluation_scheduler import EvaluationScheduler
+from ....core.faq import FAQMatcher
+from ....core.config import settings
+from ....core.ingestion import INGEST_FORMATS, BulkIngestor, aiter_lines, aparse_lines
+from ....core.traffic import TrafficRecorder
+from ....core.services import get_services, ServiceContainer
+from ....core.idempotency import (
+    IdempotencyConflictError,
+    get_stored_response,
+    request_fingerprint,
+    store_response
+)
+import math
 import uuid
+from contextlib import AsyncExitStack
 from datetime import datetime
 
 router = APIRouter()
-mcp_handler = MCPHandler()
-llm_handler = LLMHandler()
 
 @router.post("/sanitize", response_model=MensajeSanitizadoResponse)
 async def sanitize_message(
     message: MensajeCreate,
-    db: Session = Depends(get_db)
+    response: Response,
+    db: Session = Depends(get_db),
+    mcp_handler: MCPHandler = Depends(get_mcp_handler),
+    llm_handler: LLMHandler = Depends(get_llm_handler),
+    conversation_locks: ConversationLocks = Depends(get_conversation_locks),
+    admission: AdmissionController = Depends(get_admission),
+    recorder: Optional[TrafficRecorder] = Depends(get_traffic_recorder),
+    scheduler: Optional[EvaluationScheduler] = Depends(get_evaluation_scheduler),
+    state_store: Optional[ConversationStateStore] = Depends(get_conversation_state),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """
     Sanitiza un mensaje, lo procesa con el LLM y devuelve tanto el mensaje sanitizado como la respuesta del LLM.
     Todo en una sola llamada.
+
+    Los mensajes de una misma conversación (lead + chatbot) se procesan en orden, uno a la vez.
+    Si se envía la cabecera `Idempotency-Key`, un reintento con la misma clave devuelve la
+    respuesta guardada sin volver a guardar el mensaje ni llamar al LLM.
+    Si el chatbot o el servicio superan su cuota de llamadas al LLM se responde 429.
+    Cada mensaje nuevo programa la reevaluación del lead en segundo plano.
     """
+    request_hash = request_fingerprint(message.model_dump())
     try:
-        from ....models.chat import Conversacion, Mensaje, Chatbot
-        
-        # Verificar si existe una conversación activa
-        conversacion = db.query(Conversacion).filter(
-            Conversacion.lead_id == message.lead_id,
-            Conversacion.chatbot_id == message.chatbot_id,
+        # La cuota del LLM se pide antes del bloqueo: la espera en la cola de admisión no
+        # retiene la conexión del bloqueo. El ticket se libera al salir de este bloque.
+        async with AsyncExitStack() as admission_scope:
+            ticket = None
+            if _chatbot_activo(db, message.lead_id, message.chatbot_id):
+                ticket = await admission_scope.enter_async_context(admission.admit(message.chatbot_id))
+            async with conversation_locks.hold(message.lead_id, message.chatbot_id):
+                # La clave se comprueba dentro del bloqueo: un reintento concurrente espera
+                # a que termine el original y recibe su respuesta
+                if idempotency_key:
+                    stored = get_stored_response(db, "messages.sanitize", idempotency_key, request_hash)
+                    if stored is not None:
+                        if ticket is not None:
+                            ticket.cancel()
+                        response.headers["Idempotent-Replayed"] = "true"
+                        if stored.get("llm_respuesta") is not None:
+                            llm_handler.record_cache_hit("chat", chatbot_id=message.chatbot_id)
+                        return MensajeSanitizadoResponse(**stored)
+
+                resultado = await _procesar_mensaje_entrante(
+                    message, db, mcp_handler, llm_handler, admission, admission_scope, ticket,
+                    recorder, state_store
+                )
+
+                if idempotency_key:
+                    store_response(
+                        db, "messages.sanitize", idempotency_key, request_hash,
+                        resultado.model_dump(mode="json")
+                    )
+                # Una ráfaga de mensajes produce una sola evaluación, fuera del turno de chat
+                if scheduler is not None:
+                    scheduler.schedule(message.lead_id, resultado.token_anonimo)
+                return resultado
+    except ConversationBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+        )
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+def _chatbot_activo(db: Session, lead_id: int, chatbot_id: int) -> bool:
+    """
+    Si el bot responde en la conversación activa del lead (True si aún no existe: se crea
+    con el bot activo). La transacción se cierra para no retener la conexión del pool
+    mientras se espera la admisión.
+    """
+    from ....models.chat import Conversacion
+    try:
+        estado = db.query(Conversacion.chatbot_activo).filter(
+            Conversacion.lead_id == lead_id,
+            Conversacion.chatbot_id == chatbot_id,
             Conversacion.estado == "activo"
         ).first()
+    finally:
+        db.rollback()
+    return estado is None or bool(estado.chatbot_activo)
+
+async def _procesar_mensaje_entrante(
+    message: MensajeCreate,
+    db: Session,
+    mcp_handler: MCPHandler,
+    llm_handler: LLMHandler,
+    admission: AdmissionController,
+    admission_scope: AsyncExitStack,
+    ticket: Optional[AdmissionTicket] = None,
+    recorder: Optional[TrafficRecorder] = None,
+    state_store: Optional[ConversationStateStore] = None
+) -> MensajeSanitizadoResponse:
+    """
+    Guarda el mensaje entrante, su versión sanitizada y la respuesta del chatbot.
+    Con `state_store`, la conversación, el token anónimo y el historial reciente se
+    leen de la base de datos solo en el primer turno y después se sirven de memoria.
+
+    `ticket` es la admisión al LLM que el endpoint pidió antes del bloqueo si el bot estaba
+    activo; se cancela si la conversación resulta atendida por una persona (nunca recibe
+    429) y, si el bot se reactivó entretanto, se pide aquí en `admission_scope`, siempre
+    antes de guardar nada para que un 429 pueda reintentarse sin duplicados.
+    """
+    try:
+        from ....models.chat import Conversacion, Mensaje, Chatbot
         
-        # Si no existe conversación, crearla
-        if not conversacion:
-            conversacion = Conversacion(
-                lead_id=message.lead_id,
-                chatbot_id=message.chatbot_id,
-                canal_id=message.canal_id,
-                estado="activo",
-                chatbot_activo=True,
-                ultimo_mensaje=datetime.now(),
-                metadata={}
+        state = None
+        if state_store is not None:
+            state = state_store.conversation(
+                db, mcp_handler, message.lead_id, message.chatbot_id, message.canal_id
             )
-            db.add(conversacion)
-            db.commit()
-            db.refresh(conversacion)
-        
-        # 1. Generar token anónimo para el lead si no existe
-        token_anonimo = mcp_handler.create_pii_token(db, message.lead_id)
+            conversacion = None
+            conversacion_id = state.conversacion_id
+            chatbot_activo = state.chatbot_activo
+            # 1. Token anónimo del lead (el de la conversación en memoria)
+            token_anonimo = state.token_anonimo
+        else:
+            # Verificar si existe una conversación activa
+            conversacion = db.query(Conversacion).filter(
+                Conversacion.lead_id == message.lead_id,
+                Conversacion.chatbot_id == message.chatbot_id,
+                Conversacion.estado == "activo"
+            ).first()
+            
+            # Si no existe conversación, crearla
+            if not conversacion:
+                conversacion = Conversacion(
+                    lead_id=message.lead_id,
+                    chatbot_id=message.chatbot_id,
+                    canal_id=message.canal_id,
+                    estado="activo",
+                    chatbot_activo=True,
+                    ultimo_mensaje=datetime.now(),
+                    metadata={}
+                )
+                db.add(conversacion)
+                db.commit()
+                db.refresh(conversacion)
+            conversacion_id = conversacion.id
+            chatbot_activo = conversacion.chatbot_activo
+            
+            # 1. Generar token anónimo para el lead si no existe
+            token_anonimo = mcp_handler.create_pii_token(db, message.lead_id)
+        
+        if not chatbot_activo and ticket is not None:
+            ticket.cancel()
+            ticket = None
+        elif chatbot_activo and ticket is None:
+            # El bot se reactivó entre la admisión y el bloqueo
+            ticket = await admission_scope.enter_async_context(admission.admit(message.chatbot_id))
         
         # 2. Sanitizar el mensaje - IMPORTANTE: Este es el paso clave
-        mensaje_sanitizado = mcp_handler.save_sanitized_message(
+        contenido_sanitizado, metadata_sanitizada = await mcp_handler.anonymize_message(
+            message.contenido, message.metadata or {}
+        )
+        if recorder is not None:
+            # El recorder enmascara además los datos personales del texto libre
+            recorder.record_request(
+                "messages.sanitize", "POST", "/messages/sanitize",
+                lead_id=message.lead_id,
+                body={
+                    "chatbot_id": message.chatbot_id,
+                    "canal_id": message.canal_id,
+                    "contenido": contenido_sanitizado,
+                    "metadata": metadata_sanitizada
+                }
+            )
+        mensaje_sanitizado = mcp_handler.store_sanitized_message(
             db=db,
             mensaje_id=uuid.uuid4().int >> 64,  # ID temporal que se actualizará después
             token_anonimo=token_anonimo,
-            contenido_original=message.contenido,
-            metadata=message.metadata or {}
+            sanitized_content=contenido_sanitizado,
+            sanitized_metadata=metadata_sanitizada
         )
         
         # 3. Guardar el mensaje con el contenido original en la tabla de mensajes
         mensaje_usuario = Mensaje(
-            conversacion_id=conversacion.id,
+            conversacion_id=conversacion_id,
             origen="usuario",
             remitente_id=message.lead_id,
             contenido=message.contenido,  # Contenido original
@@ -98,20 +257,20 @@ async def sanitize_message(
         db.commit()
         
         # 5. Actualizar timestamp de último mensaje en la conversación
-        conversacion.ultimo_mensaje = datetime.now()
-        db.commit()
+        _touch_conversation(db, state_store, state, conversacion)
         
         # 6. Actualizar contexto conversacional con el CONTENIDO SANITIZADO
-        mcp_handler.update_conversation_context(
+        contexto_usuario = mcp_handler.update_conversation_context(
             db=db,
             token_anonimo=token_anonimo,
             tipo_contexto="mensaje_usuario",
-            contenido=mensaje_sanitizado.contenido_sanitizado,  # Usamos el contenido sanitizado
-            relevancia=1.0  # Alta relevancia para mensajes recientes
+            contenido=contenido_sanitizado  # Usamos el contenido sanitizado
         )
+        if state is not None:
+            state_store.record_turn(state, contexto_usuario, "mensaje_usuario", contenido_sanitizado)
         
         # 7. Verificar si el chatbot está activo para esta conversación
-        if not conversacion.chatbot_activo:
+        if not chatbot_activo:
             # Si el chatbot no está activo, devolvemos solo el mensaje sanitizado sin respuesta LLM
             return MensajeSanitizadoResponse(
                 id=mensaje_sanitizado.id,
@@ -123,16 +282,22 @@ async def sanitize_message(
         
         # 8. Procesar con el LLM si el chatbot está activo
         # IMPORTANTE: Pasamos el contenido sanitizado al LLM
-        respuesta_llm = llm_handler.process_message(
+        respuesta_llm = await llm_handler.process_message(
             db=db,
             chatbot_id=message.chatbot_id,
             token_anonimo=token_anonimo,
-            contenido_sanitizado=mensaje_sanitizado.contenido_sanitizado  # Usamos el contenido sanitizado
+            contenido_sanitizado=contenido_sanitizado,  # Usamos el contenido sanitizado
+            state=state
         )
+        if respuesta_llm.get("metadata", {}).get("model") == "faq":
+            # Respondido desde qa_pares, sin llamada al LLM
+            ticket.cancel()
+        else:
+            ticket.record_usage(respuesta_llm.get("metadata", {}).get("tokens_used"))
         
         # 9. Guardar la respuesta del LLM como mensaje en la base de datos
         mensaje_respuesta = Mensaje(
-            conversacion_id=conversacion.id,
+            conversacion_id=conversacion_id,
             origen="chatbot",
             remitente_id=message.chatbot_id,
             contenido=respuesta_llm["respuesta"],
@@ -146,8 +311,7 @@ async def sanitize_message(
         db.refresh(mensaje_respuesta)
         
         # 10. Actualizar timestamp de último mensaje en la conversación
-        conversacion.ultimo_mensaje = datetime.now()
-        db.commit()
+        _touch_conversation(db, state_store, state, conversacion)
         
         # 11. Devolver respuesta completa
         return MensajeSanitizadoResponse(
@@ -161,16 +325,26 @@ async def sanitize_message(
             llm_metadata=respuesta_llm.get("metadata", {})
         )
         
+    except AdmissionRejected:
+        raise
     except Exception as e:
         db.rollback()
         import traceback
         error_detail = traceback.format_exc()
         raise HTTPException(status_code=500, detail=f"Error al procesar el mensaje: {str(e)}\n{error_detail}")
 
+def _touch_conversation(db: Session, state_store, state, conversacion) -> None:
+    if state is not None:
+        state_store.touch(db, state)
+    else:
+        conversacion.ultimo_mensaje = datetime.now()
+        db.commit()
+
 @router.post("/activar-chatbot", response_model=ChatbotActivacionResponse)
 async def activar_chatbot_lead(
     activacion: ChatbotActivacionCreate,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    state_store: Optional[ConversationStateStore] = Depends(get_conversation_state)
 ):
     """
     Activa o desactiva un chatbot para un lead específico (pago).
@@ -216,6 +390,8 @@ async def activar_chatbot_lead(
                 conversacion.metadata = {**conversacion.metadata, **activacion.metadata} if conversacion.metadata else activacion.metadata
             db.commit()
             db.refresh(conversacion)
+        if state_store is not None:
+            state_store.invalidate(lead_id=activacion.lead_id, chatbot_id=activacion.chatbot_id)
         
         # Preparar respuesta
         response = ChatbotActivacionResponse(
@@ -236,7 +412,8 @@ async def activar_chatbot_lead(
 @router.post("/send-message", response_model=MensajeFrontendResponse)
 async def send_message_from_frontend(
     mensaje: MensajeFrontendCreate,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    state_store: Optional[ConversationStateStore] = Depends(get_conversation_state)
 ):
     """
     Envía un mensaje desde el frontend (agente humano) a un lead específico.
@@ -263,6 +440,8 @@ async def send_message_from_frontend(
         if conversacion.chatbot_activo:
             conversacion.chatbot_activo = False
             db.commit()
+            if state_store is not None:
+                state_store.invalidate(lead_id=mensaje.lead_id, chatbot_id=conversacion.chatbot_id)
         
         # Guardar el mensaje enviado desde el frontend (agente humano)
         nuevo_mensaje = Mensaje(
@@ -305,7 +484,8 @@ async def send_message_from_frontend(
 @router.post("/chatbot/context", response_model=ChatbotContextoResponse)
 async def create_chatbot_context(
     context: ChatbotContextoCreate,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    state_store: Optional[ConversationStateStore] = Depends(get_conversation_state)
 ):
     """
     Crea o actualiza el contexto de un chatbot
@@ -332,6 +512,9 @@ async def create_chatbot_context(
         db.add(chatbot_context)
         db.commit()
         db.refresh(chatbot_context)
+        # El prompt de sistema del chatbot cambia
+        if state_store is not None:
+            state_store.invalidate(chatbot_id=context.chatbot_id, prompt=True)
         return chatbot_context
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -339,10 +522,12 @@ async def create_chatbot_context(
 @router.post("/qa-pairs", response_model=QAPairResponse)
 async def create_qa_pair(
     qa_pair: QAPairCreate,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    faq: Optional[FAQMatcher] = Depends(get_faq)
 ):
     """
-    Crea un nuevo par pregunta-respuesta para entrenamiento
+    Crea un nuevo par pregunta-respuesta para entrenamiento. La pregunta pasa a
+    responderse directamente (sin LLM) cuando un mensaje coincide con ella.
     """
     try:
         from ....models.chat import QAPar
@@ -359,6 +544,9 @@ async def create_qa_pair(
         db.add(new_qa)
         db.commit()
         db.refresh(new_qa)
+        # El índice de preguntas frecuentes del chatbot se reconstruye en la próxima consulta
+        if faq is not None:
+            faq.invalidate(qa_pair.chatbot_id)
         return new_qa
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -366,14 +554,15 @@ async def create_qa_pair(
 @router.post("/evaluate", response_model=EvaluacionResponse)
 async def evaluate_message(
     evaluacion: EvaluacionCreate,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    mcp_handler: MCPHandler = Depends(get_mcp_handler)
 ):
     """
-    Evalúa un mensaje usando el LLM configurado
+    Evalúa un mensaje usando el LLM configurado (429 si se supera la cuota de llamadas al LLM)
     """
     try:
         # Obtener mensaje sanitizado
-        from ....models.chat import MensajeSanitizado
+        from ....models.chat import Conversacion, MensajeSanitizado
         mensaje = db.query(MensajeSanitizado).filter(
             MensajeSanitizado.mensaje_id == evaluacion.mensaje_id
         ).first()
@@ -381,17 +570,52 @@ async def evaluate_message(
         if not mensaje:
             raise HTTPException(status_code=404, detail="Mensaje no encontrado")
         
-        # Realizar evaluación
-        eval_result = mcp_handler.evaluate_conversation(
+        # Realizar evaluación (atribuida al chatbot de la conversación)
+        chatbot_id = db.query(Conversacion.chatbot_id).filter(
+            Conversacion.id == evaluacion.conversacion_id
+        ).scalar()
+        eval_result = await mcp_handler.evaluate_conversation(
             db=db,
             lead_id=evaluacion.lead_id,
             conversacion_id=evaluacion.conversacion_id,
             mensaje_id=evaluacion.mensaje_id,
             llm_config_id=evaluacion.llm_configuracion_id,
             contenido_sanitizado=mensaje.contenido_sanitizado,
-            prompt_template=evaluacion.prompt_utilizado
+            prompt_template=evaluacion.prompt_utilizado,
+            chatbot_id=chatbot_id
         )
         
         return eval_result
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+        )
+    except EvaluationFailedError as e:
+        raise HTTPException(status_code=502, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/bulk-import", response_model=Dict[str, Any])
+async def bulk_import_messages(
+    request: Request,
+    format: str = "ndjson",
+    services: ServiceContainer = Depends(get_services)
+):
+    """
+    Importa mensajes históricos en bloque (NDJSON o CSV en el cuerpo de la petición).
+    Cada registro lleva lead_id, chatbot_id, contenido y opcionalmente origen, created_at,
+    canal_id y metadata. Los mensajes se sanitizan en paralelo y no se llama al LLM.
+    """
+    if format not in INGEST_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato no soportado. Opciones: {', '.join(INGEST_FORMATS)}")
+    ingestor = BulkIngestor(services.engine, services.process_pool, settings.INGEST_BATCH_SIZE)
+    try:
+        return await ingestor.ingest(aparse_lines(aiter_lines(request.stream()), format))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Entrada no válida: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,24 +1,31 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta
-import jwt
+from typing import Optional
 from ....schemas.token import Token, TokenPayload
 from ....core.config import settings
+from ....core.security import verify_client_secret
+from ....core.services import services
 
 router = APIRouter()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm="HS256")
-    return encoded_jwt
+    # Se firma con la misma clave y algoritmo que usa la verificación
+    return services.token_verifier.create_token(data, expires_delta)
 
 @router.post("/generate", response_model=Token)
-async def generate_token():
+async def generate_token(client_secret: Optional[str] = Header(None, alias="X-Client-Secret")):
+    """
+    Emite un token de acceso para el cliente que presenta la credencial `TOKEN_CLIENT_SECRET`
+    en la cabecera `X-Client-Secret`. Sin esa variable configurada la emisión está desactivada.
+    """
+    if not settings.TOKEN_CLIENT_SECRET:
+        raise HTTPException(status_code=404, detail="La emisión de tokens está desactivada")
+    if not verify_client_secret(client_secret):
+        raise HTTPException(status_code=401, detail="Credencial de cliente inválida")
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": settings.MCP_SERVER_ID}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer"}
\ No newline at end of file
+    return {"access_token": access_token, "token_type": "bearer"}
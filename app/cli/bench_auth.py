@@ -0,0 +1,50 @@
+"""
+Mide el sobrecoste por petición de la verificación de JWT y lo compara con
+AUTH_OVERHEAD_BUDGET_US. Devuelve código de salida 1 si se supera el presupuesto
+en el caso habitual (token ya verificado y en caché).
+
+Uso:
+    python -m app.cli.bench_auth --iterations 100000
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import timedelta
+from app.core.config import settings
+from app.core.security import TokenVerifier
+
+def _per_call_us(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la verificación de JWT")
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--budget-us", type=float, default=settings.AUTH_OVERHEAD_BUDGET_US)
+    args = parser.parse_args()
+
+    verifier = TokenVerifier(settings.SECRET_KEY, settings.ALGORITHM, cache_size=settings.AUTH_CACHE_SIZE)
+    token = verifier.create_token({"sub": settings.MCP_SERVER_ID}, timedelta(minutes=5))
+
+    # Sin caché: cada llamada decodifica y valida la firma
+    uncached = TokenVerifier(settings.SECRET_KEY, settings.ALGORITHM, cache_size=0)
+    miss_us = _per_call_us(lambda: uncached.verify(token), max(1, args.iterations // 10))
+
+    verifier.verify(token)
+    hit_us = _per_call_us(lambda: verifier.verify(token), args.iterations)
+
+    report = {
+        "iterations": args.iterations,
+        "cache_miss_us": round(miss_us, 3),
+        "cache_hit_us": round(hit_us, 3),
+        "budget_us": args.budget_us,
+        "within_budget": hit_us <= args.budget_us
+    }
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["within_budget"] else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Mide el retraso del event loop mientras se sanitizan payloads grandes, primero en
+línea (como antes) y después a través de CPUExecutor, y muestra ambos resultados.
+
+Uso:
+    python -m app.cli.bench_loop_lag --messages 200 --fields 5000 --kind thread
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Dict, Optional
+from app.core import sanitizer
+from app.core.config import settings
+from app.core.executors import CPUExecutor
+from app.core.loop_monitor import EventLoopMonitor
+
+def _payload(fields: int) -> Dict[str, Any]:
+    return {
+        "content": "Hola, quiero información sobre el programa",
+        "metadata": {
+            "historial": [
+                {"email": f"user{i}@example.com", "telefono": f"+57300{i:07d}", "nota": "x" * 20}
+                for i in range(fields)
+            ]
+        }
+    }
+
+async def _run(executor: Optional[CPUExecutor], messages: int, fields: int, interval: float) -> Dict[str, Any]:
+    monitor = EventLoopMonitor(interval=interval)
+    monitor.start()
+    payload = _payload(fields)
+    fields_set = frozenset(sanitizer.SENSITIVE_FIELDS)
+
+    async def one():
+        if executor is None:
+            sanitizer.anonymize_data(payload, fields_set)
+        else:
+            await executor.run(sanitizer.anonymize_data, payload, fields_set, payload=payload)
+        # Deja correr al resto de tareas entre mensajes, como haría una petición real
+        await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(messages)))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(interval * 2)
+    await monitor.stop()
+    return {"segundos": round(elapsed, 3), "loop_lag": monitor.stats()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Retraso del event loop con y sin CPUExecutor")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--fields", type=int, default=5000)
+    parser.add_argument("--kind", choices=["thread", "process"], default=settings.CPU_EXECUTOR_KIND)
+    parser.add_argument("--workers", type=int, default=settings.CPU_EXECUTOR_WORKERS)
+    parser.add_argument("--threshold", type=int, default=settings.CPU_OFFLOAD_THRESHOLD)
+    parser.add_argument("--interval", type=float, default=0.01)
+    args = parser.parse_args()
+
+    executor = CPUExecutor(kind=args.kind, max_workers=args.workers, threshold=args.threshold)
+    try:
+        report = {
+            "messages": args.messages,
+            "fields": args.fields,
+            "inline": asyncio.run(_run(None, args.messages, args.fields, args.interval)),
+            "executor": {
+                "kind": args.kind,
+                **asyncio.run(_run(executor, args.messages, args.fields, args.interval))
+            }
+        }
+    finally:
+        executor.shutdown()
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
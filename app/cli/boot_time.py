@@ -0,0 +1,64 @@
+"""
+Mide el arranque en frío del worker: cada muestra lanza un intérprete nuevo,
+importa `app.main` y ejecuta el lifespan completo de la aplicación.
+
+Uso:
+    python -m app.cli.boot_time --runs 5 [--warmup]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+_CHILD_CODE = """
+import asyncio, json, time
+t0 = time.perf_counter()
+from app.main import app
+from app.core.services import services
+async def main():
+    async with app.router.lifespan_context(app):
+        report = services.boot_report()
+    report["child_total_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    print(json.dumps(report))
+asyncio.run(main())
+"""
+
+def _run_once(warmup: bool) -> dict:
+    env = dict(os.environ, SERVICES_WARMUP="true" if warmup else "false")
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", _CHILD_CODE],
+        env=env, check=True, capture_output=True, text=True
+    ).stdout
+    report = json.loads(output.strip().splitlines()[-1])
+    report["process_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return report
+
+def _summary(values):
+    return {
+        "min": min(values),
+        "median": statistics.median(values),
+        "max": max(values)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide el tiempo de arranque en frío del worker")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warmup", action="store_true", help="Crear los servicios durante el arranque")
+    args = parser.parse_args()
+
+    reports = [_run_once(args.warmup) for _ in range(args.runs)]
+    print(json.dumps({
+        "runs": args.runs,
+        "warmup": args.warmup,
+        "process_ms": _summary([r["process_ms"] for r in reports]),
+        "import_ms": _summary([r["boot_ms"]["import"] for r in reports]),
+        "worker_boot_ms": _summary([r["boot_ms"]["worker_boot"] for r in reports]),
+        "service_init_ms": reports[-1]["service_init_ms"]
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Recalcula los agregados por cohorte (`cohort_rollups`) a partir de la última evaluación
+de cada lead y su perfil en `lead_profile_features`.
+
+Uso:
+    python -m app.cli.cohorts [--rebuild] [--lead-id 1 --lead-id 2]
+
+Con `--rebuild` se vacían antes `cohort_rollups` y `cohort_lead_scores` (necesario una vez
+para migrar agregados que contaban cada evaluación en lugar de cada lead).
+"""
+import argparse
+import asyncio
+import json
+from app.core.services import services
+
+async def _run(args) -> dict:
+    try:
+        engine = services.engine
+        rollups = services.cohort_rollups
+        if args.rebuild:
+            with engine.begin() as conn:
+                rollups.reset(conn)
+        aplicados = rollups.backfill(engine, args.lead_id or None)
+        return {"leads_actualizados": aplicados, "reconstruido": args.rebuild}
+    finally:
+        await services.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcula los agregados por cohorte")
+    parser.add_argument("--rebuild", action="store_true")
+    parser.add_argument("--lead-id", type=int, action="append")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(_run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Exporta datos del servidor MCP sin pasar por la API.
+
+Uso:
+    python -m app.cli.export evaluaciones --format csv --desde 2024-01-01 --chatbot-id 3 -o evaluaciones.csv
+"""
+import argparse
+import sys
+from datetime import datetime
+from app.core.config import settings
+from app.core.export import EXPORT_ENTITIES, EXPORT_FORMATS, stream_export
+from app.core.services import services
+
+def main():
+    parser = argparse.ArgumentParser(description="Exportación masiva en streaming")
+    parser.add_argument("entity", choices=sorted(EXPORT_ENTITIES))
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--desde", type=datetime.fromisoformat)
+    parser.add_argument("--hasta", type=datetime.fromisoformat)
+    parser.add_argument("--chatbot-id", type=int)
+    parser.add_argument("--chunk-size", type=int, default=settings.EXPORT_CHUNK_SIZE)
+    parser.add_argument("-o", "--output", help="Fichero de salida (por defecto stdout)")
+    args = parser.parse_args()
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in stream_export(
+            services.read_engine,
+            args.entity,
+            args.format,
+            desde=args.desde,
+            hasta=args.hasta,
+            chatbot_id=args.chatbot_id,
+            chunk_size=args.chunk_size
+        ):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+        services.engine.dispose()
+        if services.replica_engine is not None:
+            services.replica_engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Servidor compatible con la API de chat de OpenAI que reproduce las latencias y los
+tokens grabados en una traza (TRAFFIC_RECORD_PATH), acelerados `--speed` veces.
+Se usa junto con `app.cli.replay`, arrancando la aplicación con
+LLM_BASE_URL="http://127.0.0.1:9100/v1".
+
+Uso:
+    python -m app.cli.fake_llm --trace trafico.ndjson.gz --speed 10 --port 9100
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from app.core.traffic import OPERATION_HEADER, LatencyProfile
+
+# Respuesta de evaluación con la forma que espera LLMHandler.process_prompt
+_EVALUATION = json.dumps({
+    "score_potencial": 0.5,
+    "score_satisfaccion": 0.5,
+    "interes_productos": {},
+    "palabras_clave": [],
+    "analisis": "Respuesta simulada"
+})
+
+def _content(operacion: str, completion_tokens: int) -> str:
+    if operacion == "evaluacion":
+        return _EVALUATION
+    return " ".join(["respuesta"] * max(1, completion_tokens))
+
+def create_app(profile: LatencyProfile, speed: float) -> FastAPI:
+    app = FastAPI(title="LLM simulado")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        operacion = request.headers.get(OPERATION_HEADER) or ("chat_stream" if body.get("stream") else "chat")
+        latencia_ms, prompt_tokens, completion_tokens = profile.next(operacion)
+        delay = latencia_ms / 1000 / speed
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        model = body.get("model", "fake")
+        content = _content(operacion, completion_tokens)
+
+        if body.get("stream"):
+            fragments = content.split(" ")
+
+            async def events():
+                # La latencia grabada se reparte entre los fragmentos
+                step = delay / len(fragments)
+                for i, fragment in enumerate(fragments):
+                    await asyncio.sleep(step)
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [{
+                            "index": 0,
+                            "delta": {"content": fragment if i == 0 else f" {fragment}"},
+                            "finish_reason": None
+                        }]
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                final = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+                }
+                yield f"data: {json.dumps(final)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        await asyncio.sleep(delay)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM simulado con latencias grabadas")
+    parser.add_argument("--trace", required=True, help="Traza grabada con TRAFFIC_RECORD_PATH")
+    parser.add_argument("--speed", type=float, default=1.0, help="Factor de aceleración (10 = 10x)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed debe ser mayor que 0")
+
+    profile = LatencyProfile.from_trace(args.trace)
+    print(json.dumps({
+        "operaciones": {op: len(values) for op, values in profile.samples.items()},
+        "speed": args.speed
+    }))
+    uvicorn.run(create_app(profile, args.speed), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Importa mensajes históricos desde un fichero NDJSON o CSV sin pasar por el LLM.
+
+Uso:
+    python -m app.cli.ingest historico.ndjson [--format ndjson|csv] [--batch-size 1000]
+"""
+import argparse
+import asyncio
+import json
+from app.core.config import settings
+from app.core.ingestion import INGEST_FORMATS, BulkIngestor, parse_lines
+from app.core.services import services
+
+async def _records(path: str, fmt: str):
+    with open(path, newline="", encoding="utf-8") as handle:
+        for record in parse_lines(handle, fmt):
+            yield record
+
+async def _run(args) -> dict:
+    ingestor = BulkIngestor(services.engine, services.process_pool, args.batch_size)
+    try:
+        return await ingestor.ingest(_records(args.path, args.format))
+    finally:
+        await services.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingesta masiva de mensajes históricos")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=INGEST_FORMATS)
+    parser.add_argument("--batch-size", type=int, default=settings.INGEST_BATCH_SIZE)
+    args = parser.parse_args()
+    if not args.format:
+        args.format = "csv" if args.path.endswith(".csv") else "ndjson"
+
+    print(json.dumps(asyncio.run(_run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
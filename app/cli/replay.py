@@ -0,0 +1,196 @@
+"""
+Reproduce contra la aplicación el tráfico grabado con TRAFFIC_RECORD_PATH, respetando
+los instantes de llegada originales acelerados `--speed` veces (carga en lazo abierto),
+y genera un informe JSON de latencia y throughput por endpoint que puede compararse
+entre builds.
+
+La aplicación debe apuntar al LLM simulado (LLM_BASE_URL, ver `app.cli.fake_llm`).
+Los leads de la traza son ordinales; cada uno se reproduce como lead_id = --lead-base + ordinal.
+
+Uso:
+    python -m app.cli.replay trafico.ndjson.gz --target http://127.0.0.1:8000 --speed 10 \\
+        --output informe.json [--baseline informe_anterior.json --max-regression 10]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from datetime import timedelta
+from typing import Dict, Any, List, Optional
+import httpx
+from app.core.config import settings
+from app.core.security import TokenVerifier
+from app.core.traffic import read_trace
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+def _latency_summary(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "mean": round(sum(values) / len(values), 3) if values else None,
+        "p50": _percentile(values, 0.5),
+        "p90": _percentile(values, 0.9),
+        "p95": _percentile(values, 0.95),
+        "p99": _percentile(values, 0.99),
+        "max": round(max(values), 3) if values else None
+    }
+
+def _build_request(event: Dict[str, Any], lead_base: int) -> Dict[str, Any]:
+    """Método, ruta, parámetros y cuerpo de un evento, con el lead_id reconstruido"""
+    path = event["path"]
+    params = {key: value for key, value in (event.get("params") or {}).items() if value is not None}
+    body = dict(event["body"]) if event.get("body") is not None else None
+    if "lead" in event:
+        lead_id = lead_base + event["lead"]
+        if "{lead_id}" in path:
+            path = path.format(lead_id=lead_id)
+        elif body is not None:
+            body["lead_id"] = lead_id
+        else:
+            params["lead_id"] = lead_id
+    return {"method": event["method"], "url": path, "params": params, "json": body}
+
+async def _replay(args, events: List[Dict[str, Any]], token: Optional[str]) -> Dict[str, Any]:
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: Dict[str, List[float]] = {}
+    statuses: Dict[str, Dict[str, int]] = {}
+    schedule_lag: List[float] = []
+
+    async with httpx.AsyncClient(
+        base_url=args.target.rstrip("/") + settings.API_V1_STR,
+        headers=headers,
+        timeout=args.timeout,
+        limits=httpx.Limits(max_connections=args.concurrency)
+    ) as client:
+        started = time.perf_counter()
+
+        async def send(event: Dict[str, Any]) -> None:
+            # Los instantes de llegada se respetan aunque haya peticiones en curso
+            due = started + event["t"] / args.speed
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            async with semaphore:
+                sent = time.perf_counter()
+                schedule_lag.append((sent - due) * 1000)
+                try:
+                    response = await client.request(**_build_request(event, args.lead_base))
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = (time.perf_counter() - sent) * 1000
+            endpoint = event["endpoint"]
+            latencies.setdefault(endpoint, []).append(elapsed)
+            counts = statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+
+        await asyncio.gather(*(send(event) for event in events))
+        duration = time.perf_counter() - started
+
+    endpoints = {}
+    for endpoint, values in latencies.items():
+        errors = sum(n for status, n in statuses[endpoint].items() if not status.startswith(("2", "3")))
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "errors": errors,
+            "error_rate": round(errors / len(values), 4),
+            "status": statuses[endpoint],
+            "throughput_rps": round(len(values) / duration, 3) if duration else None,
+            "latency_ms": _latency_summary(values)
+        }
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "trace": args.trace,
+        "speed": args.speed,
+        "concurrency": args.concurrency,
+        "requests": total,
+        "errors": sum(item["errors"] for item in endpoints.values()),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(total / duration, 3) if duration else None,
+        "latency_ms": _latency_summary([value for values in latencies.values() for value in values]),
+        "schedule_lag_ms": _latency_summary(schedule_lag),
+        "endpoints": endpoints
+    }
+
+def _pct(new: Optional[float], old: Optional[float]) -> Optional[float]:
+    if new is None or not old:
+        return None
+    return round((new - old) / old * 100, 2)
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Any]:
+    """Variación porcentual de latencias, throughput y errores respecto a un informe anterior"""
+    diff = {}
+    names = sorted(set(report["endpoints"]) | set(baseline["endpoints"]))
+    for name in ["total"] + names:
+        new = report if name == "total" else report["endpoints"].get(name)
+        old = baseline if name == "total" else baseline["endpoints"].get(name)
+        if new is None or old is None:
+            diff[name] = {"solo_en": "actual" if old is None else "baseline"}
+            continue
+        diff[name] = {
+            "p50_pct": _pct(new["latency_ms"]["p50"], old["latency_ms"]["p50"]),
+            "p95_pct": _pct(new["latency_ms"]["p95"], old["latency_ms"]["p95"]),
+            "p99_pct": _pct(new["latency_ms"]["p99"], old["latency_ms"]["p99"]),
+            "throughput_pct": _pct(new["throughput_rps"], old["throughput_rps"]),
+            "errors": new["errors"] - old["errors"]
+        }
+    return diff
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproducción de tráfico grabado")
+    parser.add_argument("trace", help="Traza grabada con TRAFFIC_RECORD_PATH")
+    parser.add_argument("--target", default="http://127.0.0.1:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="Factor de aceleración (10 = 10x)")
+    parser.add_argument("--concurrency", type=int, default=100, help="Peticiones simultáneas como máximo")
+    parser.add_argument("--lead-base", type=int, default=0, help="lead_id = lead-base + ordinal de la traza")
+    parser.add_argument("--endpoint", action="append", default=[], help="Reproducir solo estos endpoints")
+    parser.add_argument("--limit", type=int, default=0, help="Máximo de peticiones (0 = todas)")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--token", default=None, help="JWT; por defecto se emite uno con SECRET_KEY")
+    parser.add_argument("--output", default=None, help="Fichero JSON del informe")
+    parser.add_argument("--baseline", default=None, help="Informe anterior con el que comparar")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="Sale con código 1 si el p95 de algún endpoint empeora más de este porcentaje")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed debe ser mayor que 0")
+
+    events = [
+        event for event in read_trace(args.trace)
+        if event.get("kind") == "request" and (not args.endpoint or event["endpoint"] in args.endpoint)
+    ]
+    if args.limit:
+        events = events[:args.limit]
+    if events:
+        # La reproducción empieza con la primera petición seleccionada
+        offset = events[0]["t"]
+        events = [dict(event, t=event["t"] - offset) for event in events]
+
+    token = args.token
+    if token is None and settings.AUTH_REQUIRED:
+        verifier = TokenVerifier(settings.SECRET_KEY, settings.ALGORITHM)
+        token = verifier.create_token({"sub": settings.MCP_SERVER_ID}, timedelta(hours=1))
+
+    report = asyncio.run(_replay(args, events, token))
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["comparacion"] = compare(report, json.load(f))
+        if args.max_regression is not None:
+            exit_code = int(any(
+                (item.get("p95_pct") or 0) > args.max_regression
+                for item in report["comparacion"].values()
+            ))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+    sys.exit(exit_code)
+
+if __name__ == "__main__":
+    main()
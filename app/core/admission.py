@@ -0,0 +1,175 @@
+from typing import Dict, Optional
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from .metrics import metrics
+
+class AdmissionRejected(Exception):
+    """La petición no puede admitirse: la cola está llena o no se alcanzaría el plazo"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Cubo de fichas con recarga continua. Admite saldo negativo para saldar consumos reales."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Segundos hasta que haya `amount` fichas disponibles"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def give(self, amount: float) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class AdmissionTicket:
+    """Reserva de capacidad de una llamada al LLM admitida"""
+
+    def __init__(self, controller: "AdmissionController", chatbot_id: Optional[int], reserved_tokens: float):
+        self.controller = controller
+        self.chatbot_id = chatbot_id
+        self.reserved_tokens = reserved_tokens
+        self.used_tokens: Optional[float] = None
+        self.cancelled = False
+
+    def record_usage(self, tokens_used: Optional[float]) -> None:
+        """Registra los `tokens_used` reales devueltos por el LLM"""
+        if tokens_used is not None:
+            self.used_tokens = float(tokens_used)
+
+    def cancel(self) -> None:
+        """No se llegó a llamar al LLM: se devuelve toda la reserva"""
+        self.cancelled = True
+
+class AdmissionController:
+    """
+    Control de admisión delante del LLMHandler.
+
+    Cada llamada consume una ficha de petición y una reserva estimada de tokens LLM
+    en los cubos global y del chatbot; al terminar, la reserva se ajusta con los
+    `tokens_used` reales (las llamadas sin chatbot, como las evaluaciones de leads sin
+    conversación, solo cuentan en los cubos globales). Si no hay capacidad la petición espera en una cola acotada
+    con plazo; si la cola está llena o el plazo no se puede cumplir se rechaza de
+    inmediato (HTTP 429).
+    """
+
+    def __init__(
+        self,
+        global_rps: float,
+        global_burst: float,
+        chatbot_rps: float,
+        chatbot_burst: float,
+        global_tpm: float,
+        chatbot_tpm: float,
+        tokens_estimate: float,
+        max_queue: int,
+        queue_timeout: float
+    ):
+        self.chatbot_rps = chatbot_rps
+        self.chatbot_burst = chatbot_burst
+        self.chatbot_tpm = chatbot_tpm
+        self.tokens_estimate = tokens_estimate
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.global_requests = TokenBucket(global_rps, global_burst)
+        self.global_tokens = TokenBucket(global_tpm / 60.0, global_tpm)
+        self._chatbot_requests: Dict[int, TokenBucket] = {}
+        self._chatbot_tokens: Dict[int, TokenBucket] = {}
+        self.queue_depth = 0
+        metrics.register_gauge(
+            "mcp_admission_queue_depth",
+            lambda: self.queue_depth,
+            "Peticiones esperando admisión para llamar al LLM"
+        )
+
+    def _buckets(self, chatbot_id: Optional[int]):
+        if chatbot_id is None:
+            return (
+                (self.global_requests, 1.0),
+                (self.global_tokens, self.tokens_estimate),
+            )
+        if chatbot_id not in self._chatbot_requests:
+            self._chatbot_requests[chatbot_id] = TokenBucket(self.chatbot_rps, self.chatbot_burst)
+            self._chatbot_tokens[chatbot_id] = TokenBucket(self.chatbot_tpm / 60.0, self.chatbot_tpm)
+        return (
+            (self.global_requests, 1.0),
+            (self._chatbot_requests[chatbot_id], 1.0),
+            (self.global_tokens, self.tokens_estimate),
+            (self._chatbot_tokens[chatbot_id], self.tokens_estimate),
+        )
+
+    def _wait_time(self, chatbot_id: Optional[int]) -> float:
+        return max(bucket.wait_time(amount) for bucket, amount in self._buckets(chatbot_id))
+
+    def _take(self, chatbot_id: Optional[int]) -> None:
+        for bucket, amount in self._buckets(chatbot_id):
+            bucket.take(amount)
+
+    def _settle(self, ticket: AdmissionTicket) -> None:
+        token_buckets = [self.global_tokens]
+        request_buckets = [self.global_requests]
+        if ticket.chatbot_id is not None:
+            token_buckets.append(self._chatbot_tokens[ticket.chatbot_id])
+            request_buckets.append(self._chatbot_requests[ticket.chatbot_id])
+        if ticket.cancelled:
+            for bucket in request_buckets:
+                bucket.give(1.0)
+            delta = -ticket.reserved_tokens
+        elif ticket.used_tokens is not None:
+            delta = ticket.used_tokens - ticket.reserved_tokens
+        else:
+            return
+        for bucket in token_buckets:
+            if delta >= 0:
+                bucket.take(delta)
+            else:
+                bucket.give(-delta)
+
+    @asynccontextmanager
+    async def admit(self, chatbot_id: Optional[int] = None):
+        wait = self._wait_time(chatbot_id)
+        if wait > 0:
+            if self.queue_depth >= self.max_queue:
+                metrics.inc("mcp_admission_rejected_total", reason="queue_full")
+                raise AdmissionRejected("Cola de admisión llena", retry_after=wait)
+            deadline = time.monotonic() + self.queue_timeout
+            self.queue_depth += 1
+            try:
+                while wait > 0:
+                    if time.monotonic() + wait > deadline:
+                        metrics.inc("mcp_admission_rejected_total", reason="deadline")
+                        raise AdmissionRejected(
+                            "Capacidad del LLM agotada para este chatbot",
+                            retry_after=wait
+                        )
+                    await asyncio.sleep(wait)
+                    wait = self._wait_time(chatbot_id)
+            finally:
+                self.queue_depth -= 1
+
+        self._take(chatbot_id)
+        metrics.inc("mcp_admission_admitted_total")
+        ticket = AdmissionTicket(self, chatbot_id, self.tokens_estimate)
+        try:
+            yield ticket
+        finally:
+            self._settle(ticket)
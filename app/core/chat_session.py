@@ -0,0 +1,201 @@
+from typing import Dict, Any, Deque, List, Optional, Tuple
+from collections import deque
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+from .config import settings
+from .llm_handler import LLMHandler
+from .mcp_handler import MCPHandler
+from .relevance import relevance
+from ..models.chat import (
+    MensajeSanitizado,
+    ContextoConversacional,
+    ChatbotContexto
+)
+
+class ChatSession:
+    """
+    Estado de una conversación abierta por WebSocket.
+
+    La conversación, el token anónimo, el prompt de sistema y el historial reciente se
+    resuelven una vez al abrir la sesión y se mantienen en memoria; en cada turno solo
+    se escriben en la base de datos los mensajes nuevos.
+    """
+
+    def __init__(
+        self,
+        lead_id: int,
+        chatbot_id: int,
+        conversacion_id: int,
+        chatbot_activo: bool,
+        token_anonimo: str,
+        system_context: str,
+        history: List[Dict[str, str]]
+    ):
+        self.lead_id = lead_id
+        self.chatbot_id = chatbot_id
+        self.conversacion_id = conversacion_id
+        self.chatbot_activo = chatbot_activo
+        self.token_anonimo = token_anonimo
+        self.system_context = system_context
+        self.history: Deque[Dict[str, str]] = deque(history, maxlen=settings.CHAT_SESSION_HISTORY)
+
+    @classmethod
+    def open(
+        cls,
+        db: Session,
+        mcp_handler: MCPHandler,
+        llm_handler: LLMHandler,
+        lead_id: int,
+        chatbot_id: int,
+        canal_id: Optional[int] = None
+    ) -> "ChatSession":
+        """Resuelve la conversación activa (o la crea), el token y la configuración del chatbot"""
+        from ..models.chat import Conversacion, Chatbot
+
+        chatbot = db.query(Chatbot).filter(Chatbot.id == chatbot_id).first()
+        if not chatbot:
+            raise LookupError("Chatbot no encontrado")
+
+        conversacion = db.query(Conversacion).filter(
+            Conversacion.lead_id == lead_id,
+            Conversacion.chatbot_id == chatbot_id,
+            Conversacion.estado == "activo"
+        ).first()
+        if not conversacion:
+            conversacion = Conversacion(
+                lead_id=lead_id,
+                chatbot_id=chatbot_id,
+                canal_id=canal_id,
+                estado="activo",
+                chatbot_activo=True,
+                ultimo_mensaje=datetime.now(),
+                metadata={}
+            )
+            db.add(conversacion)
+            db.commit()
+            db.refresh(conversacion)
+
+        token_anonimo = mcp_handler.get_or_create_pii_token(db, lead_id)
+
+        chatbot_context = db.query(ChatbotContexto).filter(
+            ChatbotContexto.chatbot_id == chatbot_id
+        ).order_by(ChatbotContexto.orden).all()
+
+        recientes = db.query(ContextoConversacional).filter(
+            ContextoConversacional.token_anonimo == token_anonimo
+        ).order_by(ContextoConversacional.created_at.desc()).limit(settings.CHAT_SESSION_HISTORY).all()
+
+        return cls(
+            lead_id=lead_id,
+            chatbot_id=chatbot_id,
+            conversacion_id=conversacion.id,
+            chatbot_activo=bool(conversacion.chatbot_activo),
+            token_anonimo=token_anonimo,
+            system_context=llm_handler.build_system_context(chatbot, chatbot_context),
+            history=[
+                {
+                    "role": "user" if ctx.tipo_contexto == "mensaje_usuario" else "assistant",
+                    "content": ctx.contenido_sanitizado
+                }
+                for ctx in reversed(recientes)
+            ]
+        )
+
+    def refresh(self, db: Session) -> None:
+        """
+        Relee solo el estado del chatbot (una consulta por clave primaria). Se hace en cada
+        turno: si un agente desactiva el bot, el siguiente mensaje ya no lo responde el LLM.
+        """
+        from ..models.chat import Conversacion
+        estado = db.query(Conversacion.chatbot_activo, Conversacion.estado).filter(
+            Conversacion.id == self.conversacion_id
+        ).first()
+        self.chatbot_activo = bool(estado and estado.chatbot_activo and estado.estado == "activo")
+
+    def llm_messages(self) -> List[Dict[str, str]]:
+        return [{"role": "system", "content": self.system_context}] + list(self.history)
+
+    def _touch_conversation(self, db: Session) -> None:
+        from ..models.chat import Conversacion
+        db.query(Conversacion).filter(
+            Conversacion.id == self.conversacion_id
+        ).update({"ultimo_mensaje": datetime.now()}, synchronize_session=False)
+
+    def record_user_message(
+        self,
+        db: Session,
+        contenido: str,
+        metadata: Dict[str, Any],
+        contenido_sanitizado: str,
+        metadata_sanitizada: Dict[str, Any]
+    ) -> Tuple[int, int, str]:
+        """
+        Guarda el mensaje original, su versión sanitizada y el contexto en una sola transacción.
+        La sanitización se hace antes (`MCPHandler.anonymize_message`) para no bloquear el event loop.
+        """
+        from ..models.chat import Mensaje
+
+        mensaje = Mensaje(
+            conversacion_id=self.conversacion_id,
+            origen="usuario",
+            remitente_id=self.lead_id,
+            contenido=contenido,
+            tipo_contenido="texto",
+            metadata=metadata,
+            leido=False,
+            created_at=datetime.now()
+        )
+        db.add(mensaje)
+        db.flush()
+
+        mensaje_sanitizado = MensajeSanitizado(
+            mensaje_id=mensaje.id,
+            token_anonimo=self.token_anonimo,
+            contenido_sanitizado=contenido_sanitizado,
+            metadata_sanitizada=metadata_sanitizada
+        )
+        db.add(mensaje_sanitizado)
+        db.add(ContextoConversacional(
+            token_anonimo=self.token_anonimo,
+            tipo_contexto="mensaje_usuario",
+            contenido_sanitizado=contenido_sanitizado
+        ))
+        relevance.reinforce_last_reply(
+            db, self.token_anonimo, timedelta(minutes=settings.RELEVANCE_ENGAGEMENT_WINDOW_MINUTES)
+        )
+        self._touch_conversation(db)
+        db.flush()
+        # Los ids se leen antes del commit para no recargar los objetos expirados
+        ids = (mensaje.id, mensaje_sanitizado.id)
+        db.commit()
+
+        self.history.append({"role": "user", "content": contenido_sanitizado})
+        return ids[0], ids[1], contenido_sanitizado
+
+    def record_reply(self, db: Session, respuesta: str, metadata: Dict[str, Any]) -> int:
+        """Guarda la respuesta del chatbot y la añade al historial en memoria"""
+        from ..models.chat import Mensaje
+
+        mensaje = Mensaje(
+            conversacion_id=self.conversacion_id,
+            origen="chatbot",
+            remitente_id=self.chatbot_id,
+            contenido=respuesta,
+            tipo_contenido="texto",
+            metadata=metadata,
+            leido=False,
+            created_at=datetime.now()
+        )
+        db.add(mensaje)
+        db.add(ContextoConversacional(
+            token_anonimo=self.token_anonimo,
+            tipo_contexto="respuesta_chatbot",
+            contenido_sanitizado=respuesta
+        ))
+        self._touch_conversation(db)
+        db.flush()
+        mensaje_id = mensaje.id
+        db.commit()
+
+        self.history.append({"role": "assistant", "content": respuesta})
+        return mensaje_id
@@ -0,0 +1,266 @@
+from typing import Dict, Any, Iterable, List, Optional, Sequence, Tuple
+import logging
+import math
+from sqlalchemy import delete, event, insert, or_, select, update
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session, sessionmaker
+from .feature_store import ACADEMIC_FIELDS
+from .lead_scoring import LOCAL_PROMPT
+from .metrics import metrics
+from ..models.chat import CohortLeadScore, CohortRollup, EvaluacionLLM, LeadProfileFeatures
+
+logger = logging.getLogger(__name__)
+
+COHORT_DIMENSIONS = ACADEMIC_FIELDS
+COHORT_PERCENTILES = (0.5, 0.9, 0.99)
+
+def histogram_bin(value: float, bins: int, max_score: float) -> int:
+    """Bin del histograma para un score (los valores fuera de rango van al primer o último bin)"""
+    if max_score <= 0:
+        return 0
+    return min(bins - 1, max(0, int(value / max_score * bins)))
+
+def histogram_percentile(histogram: Sequence[int], q: float, max_score: float) -> Optional[float]:
+    """Percentil aproximado a partir del histograma, interpolando dentro del bin"""
+    total = sum(histogram)
+    if not total:
+        return None
+    width = max_score / len(histogram)
+    target = q * total
+    acumulado = 0
+    for i, count in enumerate(histogram):
+        if count and acumulado + count >= target:
+            return round((i + (target - acumulado) / count) * width, 4)
+        acumulado += count
+    return max_score
+
+def lead_cohort(analytics: Optional[Dict[str, Any]]) -> Dict[str, str]:
+    """Cohorte (campos académicos) de unas features de perfil guardadas en `lead_profile_features`"""
+    info = (analytics or {}).get("academic_info") or {}
+    return {
+        field: str(info[field])
+        for field in COHORT_DIMENSIONS
+        if info.get(field) is not None and info.get(field) != ""
+    }
+
+class CohortRollups:
+    """
+    Agregados de `score_potencial` por cohorte (universidad, facultad, programa y año de
+    graduación) que se actualizan con cada `EvaluacionLLM` insertada en lugar de
+    recalcularse recorriendo todas las evaluaciones. Solo cuentan las evaluaciones del
+    LLM: las del modelo local (`LOCAL_PROMPT`) se predicen a partir de las mismas features
+    y sesgarían los agregados hacia el propio modelo.
+
+    Por cohorte se guarda el conteo, la media y M2 (algoritmo de Welford, para la
+    desviación típica) y un histograma de bins fijos en [0, `max_score`] del que se
+    obtienen los percentiles. Cada lead aporta un solo valor, su última evaluación: la
+    aportación vigente se guarda en `cohort_lead_scores` y, cuando llega una evaluación
+    nueva o cambia la cohorte del lead, la anterior se retira (Welford inverso) antes de
+    sumar la nueva. La cohorte se lee de `lead_profile_features`, común a todos los workers.
+
+    Los agregados se actualizan después del commit de la evaluación, en una transacción
+    corta por lead, para que los bloqueos de las filas de cohorte no se mantengan durante
+    la transacción de la evaluación. `apply` es idempotente: `backfill` puede volver a
+    aplicar cualquier lead (p. ej. al registrar el perfil de un lead ya evaluado).
+    """
+
+    def __init__(self, bins: int = 50, max_score: float = 1.0):
+        self.bins = bins
+        self.max_score = max_score
+
+    def attach(self, session_factory: sessionmaker) -> None:
+        """Registra los listeners en las sesiones creadas por `session_factory`"""
+        if event.contains(session_factory, "after_flush", self._after_flush):
+            return
+        event.listen(session_factory, "after_flush", self._after_flush)
+        event.listen(session_factory, "after_commit", self._after_commit)
+        event.listen(session_factory, "after_rollback", self._after_rollback)
+
+    def _after_flush(self, session: Session, flush_context) -> None:
+        # En after_flush `session.new` todavía contiene los objetos recién insertados
+        leads = {
+            obj.lead_id for obj in session.new
+            if isinstance(obj, EvaluacionLLM)
+            and obj.score_potencial is not None
+            and obj.lead_id is not None
+            and obj.prompt_utilizado != LOCAL_PROMPT
+        }
+        if leads:
+            session.info.setdefault("cohort_pending", set()).update(leads)
+
+    def _after_commit(self, session: Session) -> None:
+        leads = session.info.pop("cohort_pending", None)
+        if leads:
+            self.apply_many(session.get_bind(), leads)
+
+    def _after_rollback(self, session: Session) -> None:
+        session.info.pop("cohort_pending", None)
+
+    def apply_many(self, engine: Engine, lead_ids: Iterable[int]) -> int:
+        """Aplica cada lead en su propia transacción; devuelve cuántos modificaron los agregados"""
+        aplicados = 0
+        for lead_id in sorted(set(lead_ids)):
+            try:
+                with engine.begin() as conn:
+                    aplicados += self.apply(conn, lead_id)
+            except Exception:
+                logger.exception("No se pudieron actualizar las cohortes del lead %s", lead_id)
+                metrics.inc("mcp_cohort_updates_total", result="error")
+        return aplicados
+
+    def backfill(self, engine: Engine, lead_ids: Optional[Iterable[int]] = None) -> int:
+        """Reaplica los leads indicados o, sin `lead_ids`, todos los que tienen evaluaciones"""
+        if lead_ids is None:
+            evaluaciones = EvaluacionLLM.__table__.c
+            with engine.connect() as conn:
+                lead_ids = conn.execute(
+                    select(evaluaciones.lead_id).where(evaluaciones.lead_id.isnot(None)).distinct()
+                ).scalars().all()
+        return self.apply_many(engine, lead_ids)
+
+    def reset(self, conn: Connection) -> None:
+        """Vacía los agregados y las aportaciones (para reconstruirlos con `backfill`)"""
+        conn.execute(delete(CohortLeadScore.__table__))
+        conn.execute(delete(CohortRollup.__table__))
+
+    def _locked_row(self, conn: Connection, table, filtro: tuple, values: Dict[str, Any], *columns):
+        """Fila bloqueada hasta el final de la transacción, creándola con `values` si no existe"""
+        fila = conn.execute(select(*columns).where(*filtro).with_for_update()).first()
+        if fila is None:
+            self._insert_ignore(conn, table, values)
+            fila = conn.execute(select(*columns).where(*filtro).with_for_update()).first()
+        return fila
+
+    def _insert_ignore(self, conn: Connection, table, values: Dict[str, Any]) -> None:
+        if conn.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as pg_insert
+            conn.execute(pg_insert(table).values(**values).on_conflict_do_nothing())
+        elif conn.dialect.name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+            conn.execute(sqlite_insert(table).values(**values).on_conflict_do_nothing())
+        else:
+            conn.execute(insert(table).values(**values))
+
+    def apply(self, conn: Connection, lead_id: int) -> bool:
+        """Sustituye en los agregados la aportación del lead por la de su última evaluación del LLM"""
+        evaluaciones = EvaluacionLLM.__table__.c
+        ultima = conn.execute(
+            select(evaluaciones.id, evaluaciones.score_potencial)
+            .where(
+                evaluaciones.lead_id == lead_id,
+                evaluaciones.score_potencial.isnot(None),
+                or_(evaluaciones.prompt_utilizado.is_(None), evaluaciones.prompt_utilizado != LOCAL_PROMPT)
+            )
+            .order_by(evaluaciones.fecha_evaluacion.desc(), evaluaciones.id.desc())
+            .limit(1)
+        ).first()
+        cohorte = lead_cohort(conn.execute(
+            select(LeadProfileFeatures.__table__.c.analytics)
+            .where(LeadProfileFeatures.__table__.c.lead_id == lead_id)
+        ).scalar())
+
+        # La fila del lead se bloquea para que dos aplicaciones concurrentes no sumen dos veces
+        aportes = CohortLeadScore.__table__
+        previa = self._locked_row(
+            conn, aportes, (aportes.c.lead_id == lead_id,), {"lead_id": lead_id},
+            aportes.c.evaluacion_id, aportes.c.score, aportes.c.cohorte
+        )
+
+        nueva_evaluacion = ultima.id if ultima is not None else None
+        nuevo = ultima.score_potencial if ultima is not None and cohorte else None
+        previa_cohorte = (previa.cohorte or {}) if previa.score is not None else {}
+        nueva_cohorte = cohorte if nuevo is not None else {}
+        if previa.evaluacion_id == nueva_evaluacion and previa_cohorte == nueva_cohorte:
+            return False
+
+        cambios: Dict[Tuple[str, str], List[Tuple[float, int]]] = {}
+        for dimension in COHORT_DIMENSIONS:
+            if previa.score is not None and previa_cohorte.get(dimension) is not None:
+                cambios.setdefault((dimension, previa_cohorte[dimension]), []).append((previa.score, -1))
+            if nuevo is not None and nueva_cohorte.get(dimension) is not None:
+                cambios.setdefault((dimension, nueva_cohorte[dimension]), []).append((nuevo, 1))
+        # Orden fijo de las filas bloqueadas para evitar interbloqueos entre leads
+        for (dimension, valor), valores in sorted(cambios.items()):
+            self._update(conn, dimension, valor, valores)
+
+        conn.execute(
+            update(aportes).where(aportes.c.lead_id == lead_id).values(
+                evaluacion_id=nueva_evaluacion,
+                score=nuevo,
+                cohorte=nueva_cohorte or None
+            )
+        )
+        metrics.inc("mcp_cohort_updates_total", result="aplicada" if cohorte else "sin_cohorte")
+        return bool(cambios)
+
+    def _update(self, conn: Connection, dimension: str, valor: str, valores: List[Tuple[float, int]]) -> None:
+        """Suma (+1) o retira (-1) scores de los agregados de una cohorte"""
+        rollups = CohortRollup.__table__
+        filtro = (rollups.c.dimension == dimension, rollups.c.valor == valor)
+        fila = self._locked_row(
+            conn, rollups, filtro,
+            {"dimension": dimension, "valor": valor, "total": 0, "media": 0.0, "m2": 0.0, "histograma": [0] * self.bins},
+            rollups.c.total, rollups.c.media, rollups.c.m2, rollups.c.histograma
+        )
+
+        total, media, m2 = fila.total or 0, fila.media or 0.0, fila.m2 or 0.0
+        histograma = list(fila.histograma or [0] * self.bins)
+        if len(histograma) != self.bins:
+            histograma = [0] * self.bins
+        for score, signo in valores:
+            if signo > 0:
+                # Welford: media y M2 se actualizan sin guardar los valores anteriores
+                total += 1
+                delta = score - media
+                media += delta / total
+                m2 += delta * (score - media)
+            elif total <= 1:
+                total, media, m2 = 0, 0.0, 0.0
+            else:
+                # Welford inverso: M2(n-1) = M2(n) - (x - media(n-1)) * (x - media(n))
+                media_previa = (total * media - score) / (total - 1)
+                m2 = max(0.0, m2 - (score - media_previa) * (score - media))
+                media = media_previa
+                total -= 1
+            posicion = histogram_bin(score, self.bins, self.max_score)
+            histograma[posicion] = max(0, histograma[posicion] + signo)
+
+        conn.execute(
+            update(rollups).where(*filtro).values(
+                total=total, media=media, m2=m2, histograma=histograma
+            )
+        )
+
+    def query(
+        self,
+        db: Session,
+        dimension: str,
+        valor: Optional[str] = None,
+        min_total: int = 1
+    ) -> List[Dict[str, Any]]:
+        """Agregados de una dimensión (o de una cohorte concreta) ordenados por tamaño"""
+        if dimension not in COHORT_DIMENSIONS:
+            raise ValueError(f"Dimensión no soportada. Opciones: {', '.join(COHORT_DIMENSIONS)}")
+        query = db.query(CohortRollup).filter(
+            CohortRollup.dimension == dimension,
+            CohortRollup.total >= min_total
+        )
+        if valor is not None:
+            query = query.filter(CohortRollup.valor == valor)
+
+        cohortes = []
+        for rollup in query.order_by(CohortRollup.total.desc()).all():
+            histograma = rollup.histograma or []
+            cohortes.append({
+                "valor": rollup.valor,
+                "total": rollup.total,
+                "media": round(rollup.media, 4),
+                "desviacion": round(math.sqrt(rollup.m2 / (rollup.total - 1)), 4) if rollup.total > 1 else 0.0,
+                "percentiles": {
+                    f"p{int(q * 100)}": histogram_percentile(histograma, q, self.max_score)
+                    for q in COHORT_PERCENTILES
+                },
+                "histograma": histograma,
+                "updated_at": rollup.updated_at.isoformat() if rollup.updated_at else None
+            })
+        return cohortes
@@ -0,0 +1,111 @@
+from typing import Dict, Hashable, Optional
+import asyncio
+import hashlib
+import time
+from contextlib import asynccontextmanager
+
+class ConversationBusyError(Exception):
+    """No se pudo obtener el bloqueo de la conversación dentro del tiempo límite"""
+
+def advisory_lock_key(*parts: Hashable) -> int:
+    """Clave estable de 64 bits (con signo) para pg_advisory_lock, igual en todos los workers"""
+    digest = hashlib.sha1(":".join(str(p) for p in parts).encode()).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+class ConversationLocks:
+    """
+    Serializa el procesamiento de mensajes de una misma conversación.
+
+    Dentro del proceso se usa un asyncio.Lock por conversación; entre workers se
+    usa un bloqueo consultivo de PostgreSQL. El bloqueo es de sesión y se mantiene todo
+    el turno, así que no puede compartir la conexión de la sesión ORM (que vuelve al pool
+    en cada commit) ni salir del pool del primario: las conexiones salen de un pool
+    asyncpg propio de `pool_size` conexiones, y esperar una libre (como mucho hasta el
+    plazo del bloqueo) no bloquea el event loop. Sin `dsn` (SQLite) solo se serializa
+    dentro del proceso.
+    """
+
+    def __init__(
+        self,
+        dsn: Optional[str] = None,
+        pool_size: int = 10,
+        timeout: float = 30.0,
+        poll_interval: float = 0.05
+    ):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._refs: Dict[Hashable, int] = {}
+        self._pool = None
+        self._pool_lock: Optional[asyncio.Lock] = None
+
+    @asynccontextmanager
+    async def hold(self, *conversation_key: Hashable):
+        key = tuple(conversation_key)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._refs[key] = self._refs.get(key, 0) + 1
+        deadline = time.monotonic() + self.timeout
+        try:
+            try:
+                await asyncio.wait_for(lock.acquire(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                raise ConversationBusyError(f"Conversación ocupada: {key}")
+            try:
+                async with self._advisory_lock(key, deadline):
+                    yield
+            finally:
+                lock.release()
+        finally:
+            self._refs[key] -= 1
+            if self._refs[key] == 0:
+                del self._refs[key]
+                del self._locks[key]
+
+    async def _get_pool(self):
+        if self._pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    import asyncpg
+                    self._pool = await asyncpg.create_pool(self.dsn, min_size=0, max_size=self.pool_size)
+        return self._pool
+
+    @asynccontextmanager
+    async def _advisory_lock(self, key: tuple, deadline: float):
+        if not self.dsn:
+            yield
+            return
+
+        lock_key = advisory_lock_key("conversacion", *key)
+        pool = await self._get_pool()
+        try:
+            connection = await pool.acquire(timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise ConversationBusyError(f"Sin conexiones libres para bloquear la conversación: {key}")
+        try:
+            # pg_try_advisory_lock no deja la conexión esperando mientras otro worker tiene el bloqueo
+            while not await connection.fetchval("SELECT pg_try_advisory_lock($1)", lock_key):
+                if time.monotonic() >= deadline:
+                    raise ConversationBusyError(f"Conversación ocupada en otro worker: {key}")
+                await asyncio.sleep(self.poll_interval)
+            try:
+                yield
+            finally:
+                await connection.execute("SELECT pg_advisory_unlock($1)", lock_key)
+        finally:
+            # Al devolverla, asyncpg ejecuta pg_advisory_unlock_all: ningún bloqueo sobrevive al turno
+            await pool.release(connection)
+
+    async def close(self) -> None:
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            await pool.close()
+
+    @property
+    def active(self) -> int:
+        return len(self._locks)
@@ -0,0 +1,369 @@
+from typing import Dict, Any, Callable, Deque, List, Optional, Tuple
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+from .metrics import metrics
+from .notifications import PgListener
+from .prompts import build_chatbot_system_prompt
+
+logger = logging.getLogger(__name__)
+
+STATE_CHANNEL = "mcp_estado"
+
+class Turn:
+    """Turno del contexto conversacional en memoria (mismos atributos que ContextoConversacional)"""
+
+    def __init__(self, id: Optional[int], tipo_contexto: str, contenido_sanitizado: str, created_at: datetime):
+        self.id = id
+        self.tipo_contexto = tipo_contexto
+        self.contenido_sanitizado = contenido_sanitizado
+        self.created_at = created_at
+
+    @classmethod
+    def from_context(cls, contexto: Any, tipo_contexto: str, contenido_sanitizado: str) -> "Turn":
+        # Tras el commit los atributos están expirados: el id se toma de la identidad sin recargar
+        identity = inspect(contexto).identity
+        return cls(identity[0] if identity else None, tipo_contexto, contenido_sanitizado, datetime.utcnow())
+
+class ConversationState:
+    """Estado caliente de una conversación activa (lead + chatbot)"""
+
+    def __init__(
+        self,
+        lead_id: int,
+        chatbot_id: int,
+        conversacion_id: int,
+        chatbot_activo: bool,
+        token_anonimo: str,
+        history: List[Turn],
+        max_turns: int
+    ):
+        self.lead_id = lead_id
+        self.chatbot_id = chatbot_id
+        self.conversacion_id = conversacion_id
+        self.chatbot_activo = chatbot_activo
+        self.token_anonimo = token_anonimo
+        self.history: Deque[Turn] = deque(history, maxlen=max_turns)
+        self.loaded_at = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        """Tamaño aproximado en caracteres (lo que domina la memoria)"""
+        return len(self.token_anonimo or "") + sum(len(turn.contenido_sanitizado or "") for turn in self.history)
+
+class StateInvalidator:
+    """
+    Invalidación del estado entre workers. Esta implementación no sale del proceso
+    (un solo worker); `PgNotifyInvalidator` la propaga con NOTIFY.
+    """
+
+    def publish(self, message: Dict[str, Any]) -> None:
+        pass
+
+    def subscribe(self, callback: Callable[[Dict[str, Any]], None], on_gap: Callable[[], None]) -> None:
+        pass
+
+class PgNotifyInvalidator(StateInvalidator):
+    """Propaga las invalidaciones por NOTIFY usando la conexión LISTEN compartida del worker"""
+
+    def __init__(self, listener: PgListener, channel: str = STATE_CHANNEL):
+        self.listener = listener
+        self.channel = channel
+        # Cada worker ignora sus propias invalidaciones (ya las aplicó al publicarlas)
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._callback: Optional[Callable[[Dict[str, Any]], None]] = None
+
+    def publish(self, message: Dict[str, Any]) -> None:
+        self.listener.notify(self.channel, json.dumps(dict(message, origin=self.origin), separators=(",", ":")))
+
+    def subscribe(self, callback: Callable[[Dict[str, Any]], None], on_gap: Callable[[], None]) -> None:
+        self._callback = callback
+        self.listener.listen(self.channel, self._on_payload, on_gap=on_gap)
+
+    def _on_payload(self, payload: str) -> None:
+        message = json.loads(payload)
+        if message.get("origin") != self.origin and self._callback is not None:
+            self._callback(message)
+
+class ConversationStateStore:
+    """
+    Estado caliente de las conversaciones activas del worker: conversación, token anónimo,
+    estado del bot e historial reciente por (lead, chatbot), y prompt de sistema por chatbot.
+    En una conversación de varios turnos las lecturas se hacen en el primer turno y el
+    resto se sirven de memoria.
+
+    - Acotado por número de conversaciones y por tamaño aproximado (caracteres); se
+      expulsa la de actividad más antigua (LRU).
+    - Write-through: el estado se actualiza solo después de que la escritura en la base
+      de datos se confirma; nunca hay datos que existan solo en memoria.
+    - Invalidación entre workers enchufable (`StateInvalidator`): cada escritura invalida
+      la entrada en los demás workers. Como red de seguridad, las conversaciones se
+      recargan pasados `ttl` segundos y los prompts de chatbot pasados `chatbot_ttl`
+      (su configuración puede cambiar directamente en el CRM).
+    """
+
+    def __init__(
+        self,
+        max_conversations: int = 10000,
+        max_chars: int = 20_000_000,
+        history_turns: int = 10,
+        ttl: float = 300.0,
+        chatbot_ttl: float = 60.0,
+        invalidator: Optional[StateInvalidator] = None
+    ):
+        self.max_conversations = max_conversations
+        self.max_chars = max_chars
+        self.history_turns = history_turns
+        self.ttl = ttl
+        self.chatbot_ttl = chatbot_ttl
+        self.invalidator = invalidator or StateInvalidator()
+        self._conversations: "OrderedDict[Tuple[int, int], ConversationState]" = OrderedDict()
+        self._sizes: Dict[Tuple[int, int], int] = {}
+        self._chars = 0
+        self._prompts: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribed = False
+        metrics.register_gauge(
+            "mcp_conversation_state_entries",
+            lambda: len(self._conversations),
+            "Conversaciones con estado en memoria"
+        )
+        metrics.register_gauge(
+            "mcp_conversation_state_chars",
+            lambda: self._chars,
+            "Tamaño aproximado (caracteres) del estado de conversaciones en memoria"
+        )
+
+    def start(self) -> None:
+        """Se suscribe a las invalidaciones de los demás workers; debe llamarse desde el event loop"""
+        if not self._subscribed:
+            self.invalidator.subscribe(self._on_invalidation, on_gap=self.clear)
+            self._subscribed = True
+
+    # Conversaciones
+
+    def conversation(
+        self,
+        db: Session,
+        mcp_handler: Any,
+        lead_id: int,
+        chatbot_id: int,
+        canal_id: Optional[int] = None
+    ) -> ConversationState:
+        """Estado de la conversación activa del lead con el chatbot (la crea si no existe)"""
+        key = (lead_id, chatbot_id)
+        with self._lock:
+            state = self._conversations.get(key)
+            if state is not None and time.monotonic() - state.loaded_at < self.ttl:
+                self._conversations.move_to_end(key)
+            else:
+                state = None
+        if state is not None and not self._refresh_bot_status(db, state):
+            with self._lock:
+                self._drop(key)
+            state = None
+        if state is not None:
+            metrics.inc("mcp_conversation_state_total", result="hit")
+        else:
+            metrics.inc("mcp_conversation_state_total", result="miss")
+            state = self._load(db, mcp_handler, lead_id, chatbot_id, canal_id)
+            self._put(key, state)
+        # Los avisos de mensajes nuevos obtienen de aquí el lead y el chatbot sin consultar la conversación
+        db.info.setdefault("conversaciones", {})[state.conversacion_id] = key
+        return state
+
+    def _refresh_bot_status(self, db: Session, state: ConversationState) -> bool:
+        """
+        Relee `chatbot_activo` por clave primaria en cada turno: las invalidaciones entre
+        workers son avisos sin confirmación que se pierden si la conexión LISTEN está
+        caída, y un bot desactivado por un agente no puede seguir respondiendo hasta el
+        TTL. Devuelve False si la conversación ya no está activa.
+        """
+        from ..models.chat import Conversacion
+        estado = db.query(Conversacion.chatbot_activo, Conversacion.estado).filter(
+            Conversacion.id == state.conversacion_id
+        ).first()
+        if estado is None or estado.estado != "activo":
+            return False
+        state.chatbot_activo = bool(estado.chatbot_activo)
+        return True
+
+    def _load(
+        self,
+        db: Session,
+        mcp_handler: Any,
+        lead_id: int,
+        chatbot_id: int,
+        canal_id: Optional[int]
+    ) -> ConversationState:
+        from ..models.chat import Conversacion, ContextoConversacional
+
+        conversacion = db.query(Conversacion).filter(
+            Conversacion.lead_id == lead_id,
+            Conversacion.chatbot_id == chatbot_id,
+            Conversacion.estado == "activo"
+        ).first()
+        if not conversacion:
+            conversacion = Conversacion(
+                lead_id=lead_id,
+                chatbot_id=chatbot_id,
+                canal_id=canal_id,
+                estado="activo",
+                chatbot_activo=True,
+                ultimo_mensaje=datetime.now(),
+                metadata={}
+            )
+            db.add(conversacion)
+            db.commit()
+            db.refresh(conversacion)
+
+        token_anonimo = mcp_handler.get_or_create_pii_token(db, lead_id)
+        recientes = db.query(
+            ContextoConversacional.id,
+            ContextoConversacional.tipo_contexto,
+            ContextoConversacional.contenido_sanitizado,
+            ContextoConversacional.created_at
+        ).filter(
+            ContextoConversacional.token_anonimo == token_anonimo
+        ).order_by(ContextoConversacional.created_at.desc()).limit(self.history_turns).all()
+
+        return ConversationState(
+            lead_id=lead_id,
+            chatbot_id=chatbot_id,
+            conversacion_id=conversacion.id,
+            chatbot_activo=bool(conversacion.chatbot_activo),
+            token_anonimo=token_anonimo,
+            history=[Turn(*row) for row in reversed(recientes)],
+            max_turns=self.history_turns
+        )
+
+    def _put(self, key: Tuple[int, int], state: ConversationState) -> None:
+        with self._lock:
+            self._conversations[key] = state
+            self._conversations.move_to_end(key)
+            self._resize(key, state)
+            self._evict()
+
+    def _resize(self, key: Tuple[int, int], state: ConversationState) -> None:
+        size = state.size
+        self._chars += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+
+    def _evict(self) -> None:
+        while self._conversations and (
+            len(self._conversations) > self.max_conversations or self._chars > self.max_chars
+        ):
+            key, _ = self._conversations.popitem(last=False)
+            self._chars -= self._sizes.pop(key, 0)
+            metrics.inc("mcp_conversation_state_total", result="expulsada")
+
+    def _drop(self, key: Tuple[int, int]) -> bool:
+        state = self._conversations.pop(key, None)
+        self._chars -= self._sizes.pop(key, 0)
+        return state is not None
+
+    def record_turn(self, state: ConversationState, contexto: Any, tipo_contexto: str, contenido_sanitizado: str) -> None:
+        """Añade al historial un turno ya confirmado en la base de datos y lo avisa a los demás workers"""
+        key = (state.lead_id, state.chatbot_id)
+        with self._lock:
+            state.history.append(Turn.from_context(contexto, tipo_contexto, contenido_sanitizado))
+            if self._conversations.get(key) is state:
+                self._conversations.move_to_end(key)
+                self._resize(key, state)
+                self._evict()
+        self.invalidator.publish({"lead_id": state.lead_id, "chatbot_id": state.chatbot_id})
+
+    def touch(self, db: Session, state: ConversationState) -> None:
+        """Actualiza `ultimo_mensaje` de la conversación sin cargarla"""
+        from ..models.chat import Conversacion
+        db.query(Conversacion).filter(
+            Conversacion.id == state.conversacion_id
+        ).update({"ultimo_mensaje": datetime.now()}, synchronize_session=False)
+        db.commit()
+
+    # Prompts de sistema por chatbot
+
+    def system_prompt(self, db: Session, chatbot_id: int) -> Optional[str]:
+        """Prompt de sistema del chatbot (None si no existe)"""
+        with self._lock:
+            cached = self._prompts.get(chatbot_id)
+            if cached is not None and time.monotonic() - cached[1] < self.chatbot_ttl:
+                self._prompts.move_to_end(chatbot_id)
+                metrics.inc("mcp_conversation_state_total", result="prompt_hit")
+                return cached[0]
+        metrics.inc("mcp_conversation_state_total", result="prompt_miss")
+
+        from ..models.chat import Chatbot, ChatbotContexto
+        chatbot = db.query(Chatbot).filter(Chatbot.id == chatbot_id).first()
+        if not chatbot:
+            return None
+        chatbot_context = db.query(ChatbotContexto).filter(
+            ChatbotContexto.chatbot_id == chatbot_id
+        ).order_by(ChatbotContexto.orden).all()
+        prompt = build_chatbot_system_prompt(chatbot, chatbot_context)
+        with self._lock:
+            self._prompts[chatbot_id] = (prompt, time.monotonic())
+            self._prompts.move_to_end(chatbot_id)
+            # Un prompt por chatbot: el límite solo evita crecer sin control
+            while len(self._prompts) > self.max_conversations:
+                self._prompts.popitem(last=False)
+        return prompt
+
+    # Invalidación
+
+    def invalidate(
+        self,
+        lead_id: Optional[int] = None,
+        chatbot_id: Optional[int] = None,
+        prompt: bool = False,
+        publish: bool = True
+    ) -> int:
+        """
+        Descarta el estado de las conversaciones del lead y/o chatbot indicados (con
+        `prompt`, el prompt del chatbot en lugar de sus conversaciones) en este worker y,
+        con `publish`, en los demás.
+        """
+        with self._lock:
+            if prompt:
+                dropped = int(self._prompts.pop(chatbot_id, None) is not None)
+            else:
+                keys = [
+                    key for key in self._conversations
+                    if (lead_id is None or key[0] == lead_id) and (chatbot_id is None or key[1] == chatbot_id)
+                ]
+                dropped = sum(self._drop(key) for key in keys)
+        if dropped:
+            metrics.inc("mcp_conversation_state_total", dropped, result="invalidada")
+        if publish:
+            self.invalidator.publish({"lead_id": lead_id, "chatbot_id": chatbot_id, "prompt": prompt})
+        return dropped
+
+    def _on_invalidation(self, message: Dict[str, Any]) -> None:
+        self.invalidate(
+            lead_id=message.get("lead_id"),
+            chatbot_id=message.get("chatbot_id"),
+            prompt=bool(message.get("prompt")),
+            publish=False
+        )
+
+    def clear(self) -> None:
+        """Descarta todo (p. ej. si se perdieron invalidaciones al reconectar el listener)"""
+        with self._lock:
+            self._conversations.clear()
+            self._sizes.clear()
+            self._chars = 0
+            self._prompts.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "conversations": len(self._conversations),
+            "chars": self._chars,
+            "chatbot_prompts": len(self._prompts)
+        }
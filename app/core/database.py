@@ -1,26 +1,196 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from typing import Dict, Any, Callable, Optional
+import asyncio
+import logging
+import threading
+import time
 from .config import settings
+from .metrics import metrics
 
-# Configuración de la base de datos
-database_url = settings.DATABASE_URL
+logger = logging.getLogger(__name__)
 
-# Corrección para URLs que comienzan con 'https://'
-if database_url.startswith('https://'):
-    # Convertir de formato https:// a postgresql://
-    database_url = database_url.replace('https://', 'postgresql://')
+Base = declarative_base()
 
-SQLALCHEMY_DATABASE_URL = database_url
+def normalize_database_url(database_url: str) -> str:
+    """Normaliza la URL de conexión a un formato válido para SQLAlchemy"""
+    # Corrección para URLs que comienzan con 'https://'
+    if database_url.startswith('https://'):
+        # Convertir de formato https:// a postgresql://
+        database_url = database_url.replace('https://', 'postgresql://')
+    return database_url
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def create_db_engine(
+    database_url: Optional[str] = None,
+    pool_size: Optional[int] = None,
+    max_overflow: Optional[int] = None,
+    pool_timeout: Optional[float] = None,
+    **engine_kwargs
+) -> Engine:
+    """Crea el motor de base de datos. No se invoca al importar el módulo."""
+    url = normalize_database_url(database_url or settings.DATABASE_URL)
+    # SQLite (desarrollo) no usa QueuePool: los límites del pool solo aplican al resto
+    if not url.startswith("sqlite"):
+        engine_kwargs.setdefault("pool_pre_ping", True)
+        if pool_size is not None:
+            engine_kwargs["pool_size"] = pool_size
+        if max_overflow is not None:
+            engine_kwargs["max_overflow"] = max_overflow
+        if pool_timeout is not None:
+            engine_kwargs["pool_timeout"] = pool_timeout
+    return create_engine(url, **engine_kwargs)
 
-Base = declarative_base()
+def create_session_factory(engine: Engine) -> sessionmaker:
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def pool_stats(engine: Engine) -> Dict[str, Any]:
+    """Conexiones del pool en uso, libres y de desbordamiento (sin abrir ninguna)"""
+    pool = engine.pool
+    if not hasattr(pool, "checkedout"):
+        return {"pool": type(pool).__name__}
+    size = pool.size()
+    max_overflow = getattr(pool, "_max_overflow", 0)
+    checked_out = pool.checkedout()
+    # Con max_overflow negativo el desbordamiento no tiene límite
+    capacity = size + max_overflow if max_overflow >= 0 else None
+    return {
+        "pool": type(pool).__name__,
+        "size": size,
+        "checked_out": checked_out,
+        "checked_in": pool.checkedin(),
+        "overflow": max(0, pool.overflow()),
+        "max_overflow": max_overflow,
+        "usage": round(checked_out / capacity, 4) if capacity else None
+    }
+
+# Retraso de una réplica PostgreSQL; 0 si no está replicando o ya aplicó todo lo recibido
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+class ReplicaRouter:
+    """
+    Decide a qué base de datos van las sesiones de solo lectura.
+
+    Con réplica configurada, las lecturas van a ella mientras su retraso sea menor que
+    `max_lag` segundos; si el retraso es mayor o la réplica no responde, se usa el
+    primario. Con `start()` el retraso se mide en segundo plano (en un hilo, cada
+    `check_interval` segundos) y decidir solo lee el último valor medido, de modo que
+    una réplica caída nunca bloquea el event loop. Sin tarea en segundo plano (CLI,
+    scripts) se mide en línea, como mucho cada `check_interval` segundos.
+    Sin réplica, todas las sesiones van al primario.
+    """
+
+    def __init__(
+        self,
+        primary_factory: Callable[[], sessionmaker],
+        replica_engine: Optional[Engine] = None,
+        max_lag: float = 30.0,
+        check_interval: float = 5.0
+    ):
+        self._primary_factory = primary_factory
+        self.replica_engine = replica_engine
+        self.replica_factory = create_session_factory(replica_engine) if replica_engine is not None else None
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag: Optional[float] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        metrics.register_gauge(
+            "mcp_replica_lag_seconds",
+            lambda: self.lag if self.lag is not None else -1,
+            "Retraso de la réplica de lectura (-1 si no está disponible)"
+        )
+
+    def start(self) -> None:
+        """Mide el retraso en segundo plano; las lecturas dejan de conectar a la réplica"""
+        if self.replica_engine is None:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.to_thread(self.refresh_lag)
+            await asyncio.sleep(self.check_interval)
+
+    def refresh_lag(self) -> Optional[float]:
+        """Consulta el retraso de la réplica (bloqueante; None si no responde)"""
+        if self.replica_engine is None:
+            return None
+        with self._lock:
+            try:
+                with self.replica_engine.connect() as conn:
+                    if conn.dialect.name == "postgresql":
+                        self.lag = float(conn.execute(REPLICA_LAG_SQL).scalar() or 0)
+                    else:
+                        conn.execute(text("SELECT 1"))
+                        self.lag = 0.0
+            except Exception as e:
+                logger.warning("Réplica de lectura no disponible: %s", e)
+                self.lag = None
+            self._checked_at = time.monotonic()
+        return self.lag
+
+    def replica_lag(self) -> Optional[float]:
+        """Retraso de la réplica en segundos (None si no responde o aún no se midió)"""
+        if self.replica_engine is None:
+            return None
+        # Con la medición en segundo plano solo se lee el último valor
+        if self._task is not None and not self._task.done():
+            return self.lag
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return self.lag
+        return self.refresh_lag()
+
+    def use_replica(self) -> bool:
+        lag = self.replica_lag()
+        return lag is not None and lag <= self.max_lag
+
+    def read_engine(self, primary: Engine) -> Engine:
+        if self.use_replica():
+            metrics.inc("mcp_db_reads_total", target="replica")
+            return self.replica_engine
+        metrics.inc("mcp_db_reads_total", target="primary")
+        return primary
+
+    def read_session(self) -> Session:
+        if self.use_replica():
+            metrics.inc("mcp_db_reads_total", target="replica")
+            return self.replica_factory()
+        metrics.inc("mcp_db_reads_total", target="primary")
+        return self._primary_factory()()
 
 def get_db():
-    db = SessionLocal()
+    # El motor se obtiene del contenedor de servicios la primera vez que se necesita
+    from .services import services
+    db = services.session_factory()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_read_db():
+    """Sesión para consultas de solo lectura (réplica si está configurada y al día)"""
+    from .services import services
+    db = services.replica_router.read_session()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
@@ -0,0 +1,168 @@
+from typing import Dict, Any, Callable, List, Optional, Set, Tuple
+import asyncio
+import logging
+from sqlalchemy.orm import sessionmaker
+from .admission import AdmissionRejected
+from .mcp_handler import analysis_response
+from .metrics import metrics
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+class EvaluationScheduler:
+    """
+    Reevalúa leads en segundo plano cuando reciben mensajes nuevos, sin añadir
+    latencia al turno de chat.
+
+    Cada mensaje reinicia un temporizador de `debounce` segundos por lead, así que una
+    ráfaga de mensajes produce una sola evaluación; `max_delay` acota la espera si la
+    conversación no se detiene. La evaluación es la incremental de `MCPHandler.analyze_lead`
+    (cubre todas las conversaciones del lead) y se omite si no hay datos nuevos desde la
+    última. Las evaluaciones vencidas entran en una cola acotada que consumen `workers`
+    tareas; si la cola está llena se descartan (métrica `mcp_background_evaluations_total`).
+    Las llamadas al LLM pasan por el control de admisión: si no hay cuota la evaluación se
+    vuelve a programar. Con `single_flight_provider`, la evaluación usa la misma clave que
+    `/analytics/analyze-lead` (lead, marca de agua, sin `force_full`), así que coincide en
+    una sola llamada al LLM con una petición simultánea del mismo lead.
+    """
+
+    def __init__(
+        self,
+        session_factory_provider: Callable[[], sessionmaker],
+        mcp_handler_provider: Callable[[], Any],
+        single_flight_provider: Optional[Callable[[], SingleFlight]] = None,
+        debounce: float = 30.0,
+        max_delay: float = 300.0,
+        workers: int = 2,
+        max_queue: int = 1000
+    ):
+        self._session_factory_provider = session_factory_provider
+        self._mcp_handler_provider = mcp_handler_provider
+        self._single_flight_provider = single_flight_provider
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.workers = workers
+        self.max_queue = max_queue
+        # lead_id -> (token anónimo, instante del primer mensaje sin evaluar, temporizador)
+        self._pending: Dict[int, Tuple[str, float, asyncio.TimerHandle]] = {}
+        self._queued: Set[int] = set()
+        self._running: Set[int] = set()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        metrics.register_gauge(
+            "mcp_background_evaluations_pending",
+            lambda: len(self._pending) + len(self._queued),
+            "Leads con una evaluación en segundo plano programada o en cola"
+        )
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Cancela los temporizadores y las evaluaciones en curso"""
+        for _, _, handle in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queue = None
+        self._queued.clear()
+
+    def schedule(self, lead_id: int, token_anonimo: str) -> None:
+        """Programa (o pospone) la evaluación del lead; debe llamarse desde el event loop"""
+        self.start()
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        pending = self._pending.get(lead_id)
+        if pending is None:
+            first_at = now
+            metrics.inc("mcp_background_evaluations_total", result="programada")
+        else:
+            _, first_at, handle = pending
+            handle.cancel()
+            metrics.inc("mcp_background_evaluations_total", result="pospuesta")
+        delay = min(self.debounce, max(0.0, first_at + self.max_delay - now))
+        self._pending[lead_id] = (token_anonimo, first_at, loop.call_later(delay, self._due, lead_id))
+
+    def _due(self, lead_id: int) -> None:
+        pending = self._pending.pop(lead_id, None)
+        if pending is None or lead_id in self._queued:
+            return
+        token_anonimo = pending[0]
+        if lead_id in self._running:
+            # La evaluación en curso puede no incluir los últimos mensajes: se vuelve a programar
+            self.schedule(lead_id, token_anonimo)
+            return
+        try:
+            self._queue.put_nowait((lead_id, token_anonimo))
+        except asyncio.QueueFull:
+            metrics.inc("mcp_background_evaluations_total", result="descartada")
+            return
+        self._queued.add(lead_id)
+
+    async def _worker(self) -> None:
+        while True:
+            lead_id, token_anonimo = await self._queue.get()
+            self._queued.discard(lead_id)
+            self._running.add(lead_id)
+            try:
+                await self.evaluate(lead_id, token_anonimo)
+            except AdmissionRejected:
+                metrics.inc("mcp_background_evaluations_total", result="rechazada")
+                self._running.discard(lead_id)
+                self.schedule(lead_id, token_anonimo)
+            except Exception:
+                logger.exception("Falló la evaluación en segundo plano del lead %s", lead_id)
+                metrics.inc("mcp_background_evaluations_total", result="error")
+            finally:
+                self._running.discard(lead_id)
+                self._queue.task_done()
+
+    async def evaluate(self, lead_id: int, token_anonimo: str) -> bool:
+        """Evalúa el lead si tiene datos posteriores a su última evaluación"""
+        mcp_handler = self._mcp_handler_provider()
+        db = self._session_factory_provider()()
+        try:
+            watermark = mcp_handler.lead_data_watermark(db, token_anonimo)
+            if mcp_handler.current_evaluation(db, lead_id, watermark) is not None:
+                metrics.inc("mcp_background_evaluations_total", result="sin_cambios")
+                return False
+
+            async def run_analysis() -> Dict[str, Any]:
+                # Puede seguir corriendo si se cancela este worker (lo esperan otras
+                # peticiones del single-flight): usa su propia sesión
+                analysis_db = self._session_factory_provider()()
+                try:
+                    evaluacion, metadata = await mcp_handler.analyze_lead(analysis_db, lead_id, token_anonimo)
+                    return analysis_response(evaluacion, metadata, cached=False)
+                except Exception:
+                    analysis_db.rollback()
+                    raise
+                finally:
+                    analysis_db.close()
+
+            if self._single_flight_provider is None:
+                await run_analysis()
+            else:
+                await self._single_flight_provider().do((lead_id, watermark, False), run_analysis)
+            metrics.inc("mcp_background_evaluations_total", result="evaluada")
+            return True
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "queued": len(self._queued),
+            "running": len(self._running),
+            "workers": len(self._tasks)
+        }
@@ -0,0 +1,80 @@
+from typing import Any, Callable, Optional
+import asyncio
+import functools
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from .metrics import metrics
+
+def estimate_size(data: Any, limit: int) -> int:
+    """
+    Tamaño aproximado de un payload (caracteres de texto + número de elementos).
+    Deja de contar al superar `limit`, así que su coste está acotado por el umbral.
+    """
+    size = 0
+    stack = [data]
+    while stack and size <= limit:
+        item = stack.pop()
+        if isinstance(item, dict):
+            size += len(item)
+            stack.extend(item.values())
+            stack.extend(k for k in item.keys() if isinstance(k, str))
+        elif isinstance(item, (list, tuple, set)):
+            size += len(item)
+            stack.extend(item)
+        elif isinstance(item, (str, bytes)):
+            size += len(item)
+        else:
+            size += 1
+    return size
+
+class CPUExecutor:
+    """
+    Ejecuta trabajo CPU (sanitización, preparación de contexto) fuera del event loop.
+
+    Los payloads por debajo de `threshold` se procesan en línea, porque enviarlos a un
+    pool cuesta más que procesarlos. Por encima, se envían a un pool de hilos o de
+    procesos según `kind`. Con procesos la función y sus argumentos deben poder
+    serializarse (funciones de módulo, no métodos de objetos con clientes abiertos).
+    """
+
+    def __init__(
+        self,
+        kind: str = "thread",
+        max_workers: Optional[int] = None,
+        threshold: int = 50000,
+        process_pool_provider: Optional[Callable[[], Executor]] = None
+    ):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Tipo de executor no soportado: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.threshold = threshold
+        self._process_pool_provider = process_pool_provider
+        self._own_pool: Optional[Executor] = None
+
+    @property
+    def pool(self) -> Executor:
+        if self.kind == "process" and self._process_pool_provider is not None:
+            return self._process_pool_provider()
+        if self._own_pool is None:
+            if self.kind == "process":
+                self._own_pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._own_pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="mcp-cpu"
+                )
+        return self._own_pool
+
+    async def run(self, fn: Callable[..., Any], *args: Any, payload: Any = None) -> Any:
+        """Ejecuta `fn(*args)`; `payload` es el dato cuyo tamaño decide si se descarga"""
+        if estimate_size(payload if payload is not None else args, self.threshold) <= self.threshold:
+            metrics.inc("mcp_cpu_tasks_total", mode="inline")
+            return fn(*args)
+        metrics.inc("mcp_cpu_tasks_total", mode=self.kind)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, functools.partial(fn, *args))
+
+    def shutdown(self) -> None:
+        if self._own_pool is not None:
+            self._own_pool.shutdown(wait=False, cancel_futures=True)
+            self._own_pool = None
@@ -0,0 +1,204 @@
+from typing import Dict, Any, Iterator, List, Optional
+import csv
+import io
+import json
+from datetime import datetime
+from sqlalchemy import select, JSON, Integer, Float, DateTime, Boolean
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+from ..models.chat import (
+    EvaluacionLLM,
+    MensajeSanitizado,
+    ContextoConversacional,
+    PIIToken,
+    conversaciones_table,
+    mensajes_table
+)
+
+class ExportError(Exception):
+    """Parámetros de exportación no válidos o formato no disponible"""
+
+EXPORT_ENTITIES = {
+    "evaluaciones": (EvaluacionLLM, EvaluacionLLM.fecha_evaluacion),
+    "mensajes_sanitizados": (MensajeSanitizado, MensajeSanitizado.created_at),
+    "contexto_conversacional": (ContextoConversacional, ContextoConversacional.created_at),
+}
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+def build_export_query(
+    entity: str,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    chatbot_id: Optional[int] = None
+) -> Select:
+    """Consulta de exportación filtrada por rango de fechas y chatbot, ordenada por id"""
+    if entity not in EXPORT_ENTITIES:
+        raise ExportError(f"Entidad no soportada: {entity}")
+    model, date_column = EXPORT_ENTITIES[entity]
+
+    query = select(*model.__table__.columns)
+    if desde is not None:
+        query = query.where(date_column >= desde)
+    if hasta is not None:
+        query = query.where(date_column < hasta)
+
+    if chatbot_id is not None:
+        conversaciones_chatbot = select(conversaciones_table.c.id).where(
+            conversaciones_table.c.chatbot_id == chatbot_id
+        )
+        if model is EvaluacionLLM:
+            query = query.where(EvaluacionLLM.conversacion_id.in_(conversaciones_chatbot))
+        elif model is MensajeSanitizado:
+            query = query.where(MensajeSanitizado.mensaje_id.in_(
+                select(mensajes_table.c.id).where(
+                    mensajes_table.c.conversacion_id.in_(conversaciones_chatbot)
+                )
+            ))
+        else:
+            # El contexto solo conoce el token anónimo: se filtra por los leads del chatbot
+            query = query.where(ContextoConversacional.token_anonimo.in_(
+                select(PIIToken.token_anonimo).where(
+                    PIIToken.lead_id.in_(
+                        select(conversaciones_table.c.lead_id).where(
+                            conversaciones_table.c.chatbot_id == chatbot_id
+                        )
+                    )
+                )
+            ))
+
+    return query.order_by(model.id)
+
+def iter_row_chunks(engine: Engine, query: Select, chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Lee la consulta con un cursor del servidor (stream_results) en lotes de
+    `chunk_size` filas, de modo que la memoria no depende del total exportado.
+    """
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=chunk_size).execute(query)
+        for partition in result.mappings().partitions():
+            yield [dict(row) for row in partition]
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def _ndjson(chunks: Iterator[List[Dict[str, Any]]], columns: List[str]) -> Iterator[bytes]:
+    for rows in chunks:
+        yield "".join(
+            json.dumps(row, default=_json_default, ensure_ascii=False) + "\n" for row in rows
+        ).encode()
+
+def _csv(chunks: Iterator[List[Dict[str, Any]]], columns: List[str]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    for rows in chunks:
+        for row in rows:
+            writer.writerow({
+                key: json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list))
+                else value.isoformat() if isinstance(value, datetime)
+                else value
+                for key, value in row.items()
+            })
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Destino de escritura que entrega lo escrito por fragmentos sin retenerlo,
+    manteniendo la posición acumulada que Parquet usa para los offsets del footer.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _require_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportError("El formato parquet requiere el paquete pyarrow")
+    return pa, pq
+
+def _parquet(chunks: Iterator[List[Dict[str, Any]]], model) -> Iterator[bytes]:
+    pa, pq = _require_pyarrow()
+
+    def arrow_type(sql_type):
+        if isinstance(sql_type, Integer):
+            return pa.int64()
+        if isinstance(sql_type, Float):
+            return pa.float64()
+        if isinstance(sql_type, Boolean):
+            return pa.bool_()
+        if isinstance(sql_type, DateTime):
+            return pa.timestamp("us")
+        return pa.string()
+
+    table_columns = list(model.__table__.columns)
+    schema = pa.schema([(col.name, arrow_type(col.type)) for col in table_columns])
+    json_columns = {col.name for col in table_columns if isinstance(col.type, JSON)}
+
+    # Cada lote se escribe como un row group y se emite en cuanto está listo
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for rows in chunks:
+            for row in rows:
+                for name in json_columns:
+                    if row.get(name) is not None:
+                        row[name] = json.dumps(row[name], ensure_ascii=False)
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def stream_export(
+    engine: Engine,
+    entity: str,
+    fmt: str,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    chatbot_id: Optional[int] = None,
+    chunk_size: int = 1000
+) -> Iterator[bytes]:
+    """Genera el contenido exportado por fragmentos, listo para una respuesta chunked"""
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Formato no soportado: {fmt}")
+    query = build_export_query(entity, desde, hasta, chatbot_id)
+    model = EXPORT_ENTITIES[entity][0]
+    columns = [col.name for col in model.__table__.columns]
+    chunks = iter_row_chunks(engine, query, chunk_size)
+
+    if fmt == "ndjson":
+        return _ndjson(chunks, columns)
+    if fmt == "csv":
+        return _csv(chunks, columns)
+    # Se comprueba que pyarrow esté disponible antes de empezar a responder
+    _require_pyarrow()
+    return _parquet(chunks, model)
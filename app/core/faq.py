@@ -0,0 +1,254 @@
+from typing import Dict, Any, List, Optional, Tuple
+from collections import OrderedDict
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from sqlalchemy.orm import Session
+from .conversation_state import StateInvalidator
+from .metrics import metrics
+from ..models.chat import QAPar
+
+FAQ_CHANNEL = "mcp_faq"
+
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+# Palabras que no cambian la pregunta (sin tildes, como quedan tras normalizar). Las
+# negaciones (no, ni, nunca, sin...), los números ("uno" incluido), los interrogativos
+# (cuando, donde, cuanto, como...) y las preposiciones que acotan (desde, hasta, entre...)
+# no están aquí a propósito.
+STOPWORDS = frozenset("""
+    a al con de del el en es esta este esto la las le les lo los me mi mis o para por que se
+    su sus te tu tus u un una unas unos y
+    favor porfa hola buenas buenos dias tardes noches gracias quisiera quiero saber podrias puedes
+    """.split())
+
+def normalize_question(text: Optional[str]) -> str:
+    """Minúsculas, sin tildes ni signos de puntuación y con los espacios colapsados"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    return _NON_WORD.sub(" ", text).strip()
+
+def question_hash(normalized: str) -> bytes:
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest()
+
+def content_words(normalized: str) -> frozenset:
+    """Palabras de la pregunta normalizada sin las de `STOPWORDS`"""
+    return frozenset(word for word in normalized.split() if word not in STOPWORDS)
+
+def trigrams(normalized: str) -> frozenset:
+    """Trigramas de caracteres (con un espacio de relleno en los extremos)"""
+    padded = f" {normalized} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+class FAQIndex:
+    """
+    Índice de las preguntas activas de un chatbot: hash de la pregunta normalizada para
+    las coincidencias exactas y listas invertidas de trigramas para las casi exactas
+    (Jaccard sobre los conjuntos de trigramas, contando solo las preguntas que comparten
+    alguno con el mensaje). Una pregunta casi exacta solo se acepta si tiene las mismas
+    palabras que el mensaje salvo las de `STOPWORDS`: una negación o un número distintos
+    cambian la pregunta aunque los trigramas apenas varíen.
+    """
+
+    def __init__(self, pairs: List[Tuple[int, str, str]]):
+        self.ids: List[int] = []
+        self.answers: List[str] = []
+        self.sizes: List[int] = []
+        self.words: List[frozenset] = []
+        self.exact: Dict[bytes, int] = {}
+        self.postings: Dict[str, List[int]] = {}
+        # Por orden de id: con preguntas repetidas gana la más reciente
+        for qa_id, pregunta, respuesta in sorted(pairs):
+            normalized = normalize_question(pregunta)
+            if not normalized or not respuesta:
+                continue
+            key = question_hash(normalized)
+            if key in self.exact:
+                idx = self.exact[key]
+                self.ids[idx], self.answers[idx] = qa_id, respuesta
+                continue
+            idx = len(self.ids)
+            grams = trigrams(normalized)
+            self.ids.append(qa_id)
+            self.answers.append(respuesta)
+            self.sizes.append(len(grams))
+            self.words.append(content_words(normalized))
+            self.exact[key] = idx
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(idx)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def match(self, normalized: str, fuzzy: bool = True) -> Optional[Tuple[int, float, bool]]:
+        """(índice, similitud, exacta) de la pregunta más parecida, o None"""
+        idx = self.exact.get(question_hash(normalized))
+        if idx is not None:
+            return idx, 1.0, True
+        if not fuzzy:
+            return None
+        grams = trigrams(normalized)
+        shared: Dict[int, int] = {}
+        for gram in grams:
+            for candidate in self.postings.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        words = content_words(normalized)
+        best, best_score = None, 0.0
+        for candidate, count in shared.items():
+            if self.words[candidate] != words:
+                continue
+            score = count / (len(grams) + self.sizes[candidate] - count)
+            if score > best_score:
+                best, best_score = candidate, score
+        if best is None:
+            return None
+        return best, best_score, False
+
+class FAQMatcher:
+    """
+    Respuesta directa a las preguntas frecuentes: si el mensaje sanitizado coincide con
+    una pregunta activa de `qa_pares` del chatbot, se devuelve su `respuesta_ideal` sin
+    llamar al LLM. Por defecto solo vale la coincidencia exacta tras normalizar; con
+    `fuzzy` también una pregunta con similitud de trigramas de al menos `threshold` y las
+    mismas palabras salvo las de `STOPWORDS` (ver `FAQIndex`).
+
+    Los índices se construyen por chatbot en la primera consulta y se guardan en un LRU de
+    `max_chatbots`; se reconstruyen al crear un par (`invalidate`, propagado a los demás
+    workers por `invalidator`) y, como red de seguridad, pasados `ttl` segundos. Los
+    mensajes de menos de `min_chars` caracteres solo admiten la coincidencia exacta.
+    """
+
+    def __init__(
+        self,
+        fuzzy: bool = False,
+        threshold: float = 0.8,
+        min_chars: int = 12,
+        ttl: float = 300.0,
+        max_chatbots: int = 1000,
+        invalidator: Optional[StateInvalidator] = None
+    ):
+        self.fuzzy = fuzzy
+        self.threshold = threshold
+        self.min_chars = min_chars
+        self.ttl = ttl
+        self.max_chatbots = max_chatbots
+        self.invalidator = invalidator or StateInvalidator()
+        self._lock = threading.Lock()
+        self._indexes: "OrderedDict[int, Tuple[FAQIndex, float]]" = OrderedDict()
+        self._started = False
+        self.hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+        self.match_ms = 0.0
+        # Media móvil de la latencia de las respuestas del LLM (estimación de lo ahorrado por acierto)
+        self.llm_latency_ms: Optional[float] = None
+        metrics.register_gauge(
+            "mcp_faq_hit_ratio",
+            lambda: self.hit_rate() or 0.0,
+            "Fracción de mensajes respondidos desde qa_pares sin llamar al LLM"
+        )
+
+    def start(self) -> None:
+        """Se suscribe a las invalidaciones de los demás workers; debe llamarse desde el event loop"""
+        if not self._started:
+            self._started = True
+            self.invalidator.subscribe(self._on_invalidation, on_gap=self.clear)
+
+    def index(self, db: Session, chatbot_id: int) -> FAQIndex:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._indexes.get(chatbot_id)
+            if cached is not None and now - cached[1] < self.ttl:
+                self._indexes.move_to_end(chatbot_id)
+                return cached[0]
+        pairs = db.query(QAPar.id, QAPar.pregunta, QAPar.respuesta_ideal).filter(
+            QAPar.chatbot_id == chatbot_id,
+            QAPar.is_active == True
+        ).all()
+        index = FAQIndex([tuple(pair) for pair in pairs])
+        with self._lock:
+            self._indexes[chatbot_id] = (index, now)
+            self._indexes.move_to_end(chatbot_id)
+            while len(self._indexes) > self.max_chatbots:
+                self._indexes.popitem(last=False)
+        metrics.inc("mcp_faq_index_builds_total")
+        return index
+
+    def match(self, db: Session, chatbot_id: int, contenido: str) -> Optional[Dict[str, Any]]:
+        """Respuesta ideal de la pregunta que coincide con el mensaje, o None si no hay suficiente confianza"""
+        start = time.perf_counter()
+        normalized = normalize_question(contenido)
+        index, found = None, None
+        if normalized:
+            index = self.index(db, chatbot_id)
+            found = index.match(normalized, fuzzy=self.fuzzy and len(normalized) >= self.min_chars)
+        if found is not None and found[1] < self.threshold:
+            found = None
+        elapsed = (time.perf_counter() - start) * 1000
+
+        if found is None:
+            with self._lock:
+                self.misses += 1
+            metrics.inc("mcp_faq_total", result="miss")
+            return None
+
+        idx, score, exacta = found
+        saved = max(0.0, (self.llm_latency_ms or 0.0) - elapsed)
+        with self._lock:
+            self.hits += 1
+            self.match_ms += elapsed
+            self.saved_ms += saved
+        metrics.inc("mcp_faq_total", result="exacta" if exacta else "similar")
+        metrics.inc("mcp_faq_latency_saved_ms_total", saved)
+        return {
+            "qa_id": index.ids[idx],
+            "respuesta": index.answers[idx],
+            "score": round(score, 4),
+            "exacta": exacta,
+            "match_ms": round(elapsed, 3)
+        }
+
+    def observe_llm_latency(self, latency_ms: float, alpha: float = 0.1) -> None:
+        with self._lock:
+            if self.llm_latency_ms is None:
+                self.llm_latency_ms = latency_ms
+            else:
+                self.llm_latency_ms += alpha * (latency_ms - self.llm_latency_ms)
+
+    # Invalidación
+
+    def invalidate(self, chatbot_id: int, publish: bool = True) -> None:
+        """Descarta el índice del chatbot en este worker y, con `publish`, en los demás"""
+        with self._lock:
+            self._indexes.pop(chatbot_id, None)
+        if publish:
+            self.invalidator.publish({"chatbot_id": chatbot_id})
+
+    def _on_invalidation(self, message: Dict[str, Any]) -> None:
+        self.invalidate(message.get("chatbot_id"), publish=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+
+    def hit_rate(self) -> Optional[float]:
+        total = self.hits + self.misses
+        return round(self.hits / total, 4) if total else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "consultas": self.hits + self.misses,
+                "aciertos": self.hits,
+                "tasa_aciertos": self.hit_rate(),
+                "latencia_ahorrada_ms": round(self.saved_ms, 3),
+                "latencia_media_llm_ms": round(self.llm_latency_ms, 3) if self.llm_latency_ms is not None else None,
+                "latencia_media_match_ms": round(self.match_ms / self.hits, 3) if self.hits else None,
+                "chatbots_indexados": len(self._indexes),
+                "similares": self.fuzzy,
+                "umbral": self.threshold
+            }
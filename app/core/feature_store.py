@@ -0,0 +1,342 @@
+from typing import Dict, Any, Callable, Iterable, List, Optional, Sequence, Tuple
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy.orm import Session, sessionmaker
+from .metrics import metrics
+from ..models.chat import LeadProfileFeatures
+
+ACADEMIC_FIELDS = ("university_id", "faculty_id", "program_id", "graduation_year")
+COUNT_FIELDS = ("experience_count", "certification_count", "publication_count", "awards_count")
+SIMILARITY_METRICS = ("jaccard", "cosine")
+
+# Margen al releer `lead_profile_features`: cubre filas confirmadas tarde con un updated_at anterior
+SYNC_OVERLAP = timedelta(seconds=60)
+
+# Tabla de bits por byte para NumPy < 2.0 (sin np.bitwise_count)
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    """Número de bits activos de cada elemento de un vector uint64"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    return _POPCOUNT8[words.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+class LeadFeatureStore:
+    """
+    Almacén columnar en memoria de las features de perfil de los leads
+    (las que produce `extract_profile_analytics`).
+
+    Cada lead ocupa una fila: códigos de los campos académicos, conteos y sus skills
+    codificadas como bitset (`uint64`, un bit por skill del vocabulario). Los bitsets se
+    guardan por palabra (`skills[palabra, fila]`) para que cada palabra sea un vector
+    contiguo. La búsqueda de leads similares calcula la intersección con AND + popcount
+    solo sobre las palabras en las que el lead consultado tiene skills, y puntúa únicamente
+    las filas con alguna skill en común: coste lineal en leads, sin bucles en Python.
+
+    Las actualizaciones son incrementales (upsert por lead). La fuente de verdad es la
+    tabla `lead_profile_features`: cada worker mantiene su copia en memoria y, con `attach`,
+    incorpora cada `sync_interval` segundos los perfiles escritos por los demás (filas con
+    `updated_at` posterior a su última sincronización). La instantánea de `save` es solo
+    una caché de arranque: cualquier instantánea completa más la sincronización desde su
+    `synced_at` reconstruye el mismo almacén, así que da igual qué worker la escribió último.
+    """
+
+    def __init__(self, capacity: int = 1024, words: int = 1):
+        self._lock = threading.RLock()
+        self.vocab: Dict[str, int] = {}
+        self.skill_names: List[str] = []
+        # Códigos enteros por valor de cada campo académico (los ids pueden ser UUID)
+        self.codes: Dict[str, Dict[str, int]] = {field: {} for field in ACADEMIC_FIELDS}
+        self.code_values: Dict[str, List[str]] = {field: [] for field in ACADEMIC_FIELDS}
+        self.rows: Dict[int, int] = {}
+        self.size = 0
+        self.lead_ids = np.full(capacity, -1, dtype=np.int64)
+        self.academic = np.full((capacity, len(ACADEMIC_FIELDS)), -1, dtype=np.int32)
+        self.counts = np.zeros((capacity, len(COUNT_FIELDS)), dtype=np.float32)
+        self.skills = np.zeros((words, capacity), dtype=np.uint64)
+        self.skill_counts = np.zeros(capacity, dtype=np.int32)
+        # Mayor updated_at de lead_profile_features ya incorporado
+        self.synced_at: Optional[datetime] = None
+        self._source: Optional[Callable[[], sessionmaker]] = None
+        self.sync_interval = 0.0
+        self._next_sync = 0.0
+        metrics.register_gauge(
+            "mcp_feature_store_leads",
+            lambda: self.size,
+            "Leads materializados en el almacén de features"
+        )
+
+    def _grow(self, rows: int, words: int) -> None:
+        current_words, capacity = self.skills.shape
+        if rows > capacity:
+            new_capacity = max(rows, capacity * 2)
+            extra = new_capacity - capacity
+            self.lead_ids = np.concatenate([self.lead_ids, np.full(extra, -1, dtype=np.int64)])
+            self.academic = np.vstack([self.academic, np.full((extra, self.academic.shape[1]), -1, dtype=np.int32)])
+            self.counts = np.vstack([self.counts, np.zeros((extra, self.counts.shape[1]), dtype=np.float32)])
+            self.skills = np.hstack([self.skills, np.zeros((current_words, extra), dtype=np.uint64)])
+            self.skill_counts = np.concatenate([self.skill_counts, np.zeros(extra, dtype=np.int32)])
+        if words > current_words:
+            self.skills = np.vstack([
+                self.skills,
+                np.zeros((words - current_words, self.skills.shape[1]), dtype=np.uint64)
+            ])
+
+    def _code(self, field: str, value: Any) -> int:
+        if value is None or value == "":
+            return -1
+        codes = self.codes[field]
+        key = str(value)
+        if key not in codes:
+            codes[key] = len(codes)
+            self.code_values[field].append(key)
+        return codes[key]
+
+    def _skill_bits(self, names: Iterable[str]) -> List[int]:
+        bits = []
+        for name in names:
+            key = name.strip().lower()
+            if not key:
+                continue
+            if key not in self.vocab:
+                self.vocab[key] = len(self.skill_names)
+                self.skill_names.append(key)
+            bits.append(self.vocab[key])
+        return bits
+
+    def upsert_many(self, items: Iterable[Tuple[int, Dict[str, Any]]]) -> int:
+        """Inserta o reemplaza las features de varios leads; devuelve cuántos se procesaron"""
+        with self._lock:
+            lead_ids, rows, academic, counts, masks, skill_counts = [], [], [], [], [], []
+            for lead_id, analytics in items:
+                info = analytics.get("academic_info") or {}
+                bits = set(self._skill_bits(
+                    skill.get("name") or "" for skill in analytics.get("skills") or []
+                ))
+                row = self.rows.get(lead_id)
+                if row is None:
+                    row = self.rows[lead_id] = self.size
+                    self.size += 1
+                lead_ids.append(lead_id)
+                rows.append(row)
+                academic.append([self._code(field, info.get(field)) for field in ACADEMIC_FIELDS])
+                counts.append([analytics.get(field) or 0 for field in COUNT_FIELDS])
+                masks.append(sum(1 << bit for bit in bits))
+                skill_counts.append(len(bits))
+            if not rows:
+                return 0
+
+            words = max(1, (len(self.skill_names) + 63) // 64)
+            self._grow(self.size, words)
+            index = np.array(rows, dtype=np.int64)
+            self.lead_ids[index] = lead_ids
+            self.academic[index] = academic
+            self.counts[index] = counts
+            self.skill_counts[index] = skill_counts
+            for word in range(self.skills.shape[0]):
+                self.skills[word, index] = [mask >> (64 * word) & 0xFFFFFFFFFFFFFFFF for mask in masks]
+        return len(rows)
+
+    def upsert(self, lead_id: int, analytics: Dict[str, Any]) -> None:
+        self.upsert_many([(lead_id, analytics)])
+
+    # Sincronización con la base de datos
+
+    def attach(self, session_factory_provider: Callable[[], sessionmaker], interval: float) -> None:
+        """Activa la sincronización periódica con `lead_profile_features` (ver `maybe_sync`)"""
+        self._source = session_factory_provider
+        self.sync_interval = interval
+
+    def sync(self, db: Session) -> int:
+        """Incorpora los perfiles guardados desde la última sincronización; devuelve cuántos leyó"""
+        query = db.query(
+            LeadProfileFeatures.lead_id,
+            LeadProfileFeatures.analytics,
+            LeadProfileFeatures.updated_at
+        )
+        if self.synced_at is not None:
+            query = query.filter(LeadProfileFeatures.updated_at >= self.synced_at - SYNC_OVERLAP)
+        rows = query.order_by(LeadProfileFeatures.updated_at).all()
+        if not rows:
+            return 0
+        self.upsert_many((row.lead_id, row.analytics or {}) for row in rows)
+        with self._lock:
+            latest = rows[-1].updated_at
+            if latest is not None and (self.synced_at is None or latest > self.synced_at):
+                self.synced_at = latest
+        metrics.inc("mcp_feature_store_synced_total", len(rows))
+        return len(rows)
+
+    def maybe_sync(self) -> None:
+        """Sincroniza si pasaron `sync_interval` segundos desde la última vez"""
+        if self._source is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sync:
+                return
+            self._next_sync = now + self.sync_interval
+        db = self._source()()
+        try:
+            self.sync(db)
+        finally:
+            db.close()
+
+    def academic_info(self, lead_id: int) -> Dict[str, str]:
+        """Campos académicos registrados de un lead (vacío si no tiene features)"""
+        with self._lock:
+            row = self.rows.get(lead_id)
+            if row is None:
+                return {}
+            return {
+                field: self.code_values[field][code]
+                for field, code in zip(ACADEMIC_FIELDS, self.academic[row].tolist())
+                if code >= 0
+            }
+
+    def profile_matrix(self, lead_ids: Sequence[int]) -> np.ndarray:
+        """
+        Conteos, número de skills y un indicador de perfil registrado por lead, en el orden
+        de `lead_ids` (fila de ceros para los leads sin features)
+        """
+        self.maybe_sync()
+        lead_ids = list(lead_ids)
+        result = np.zeros((len(lead_ids), len(COUNT_FIELDS) + 2), dtype=np.float32)
+        with self._lock:
+            pairs = [(i, self.rows[lead_id]) for i, lead_id in enumerate(lead_ids) if lead_id in self.rows]
+            if not pairs:
+                return result
+            positions, rows = (np.array(values, dtype=np.int64) for values in zip(*pairs))
+            result[positions, :len(COUNT_FIELDS)] = self.counts[rows]
+            result[positions, len(COUNT_FIELDS)] = self.skill_counts[rows]
+        result[positions, -1] = 1.0
+        return result
+
+    def similar(
+        self,
+        lead_id: int,
+        k: int = 10,
+        metric: str = "jaccard",
+        same: Sequence[str] = ()
+    ) -> List[Dict[str, Any]]:
+        """
+        Los `k` leads con más skills en común con `lead_id` según Jaccard o coseno sobre
+        los bitsets. `same` restringe los candidatos a quienes comparten esos campos académicos.
+        """
+        if metric not in SIMILARITY_METRICS:
+            raise ValueError(f"Métrica no soportada: {metric}")
+        unknown = [field for field in same if field not in ACADEMIC_FIELDS]
+        if unknown:
+            raise ValueError(f"Campos no soportados: {', '.join(unknown)}")
+
+        self.maybe_sync()
+        with self._lock:
+            row = self.rows.get(lead_id)
+            if row is None:
+                raise LookupError(f"Lead {lead_id} sin features registradas")
+            n = self.size
+            skills = self.skills[:, :n]
+            skill_counts = self.skill_counts[:n]
+            academic = self.academic[:n]
+            lead_ids = self.lead_ids[:n]
+            query = skills[:, row].copy()
+            query_academic = academic[row].copy()
+
+        # Intersección solo sobre las palabras en las que el lead consultado tiene skills
+        inter = np.zeros(n, dtype=np.uint16)
+        for word in np.flatnonzero(query):
+            inter += _popcount(skills[word] & query[word])
+        inter[row] = 0
+        candidates = np.flatnonzero(inter)
+        for field in same:
+            col = ACADEMIC_FIELDS.index(field)
+            candidates = candidates[academic[candidates, col] == query_academic[col]]
+        if k <= 0 or len(candidates) == 0:
+            return []
+
+        shared = inter[candidates].astype(np.float32)
+        own = np.float32(skill_counts[row])
+        if metric == "jaccard":
+            scores = shared / (skill_counts[candidates] + own - shared)
+        else:
+            scores = shared / np.sqrt(skill_counts[candidates].astype(np.float32) * own)
+
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        results = []
+        for idx in top:
+            candidate = candidates[idx]
+            common = (skills[:, candidate] & query).tolist()
+            results.append({
+                "lead_id": int(lead_ids[candidate]),
+                "score": round(float(scores[idx]), 4),
+                "skills_compartidas": [
+                    self.skill_names[word * 64 + bit]
+                    for word, value in enumerate(common) if value
+                    for bit in range(64) if value >> bit & 1
+                ]
+            })
+        return results
+
+    def save(self, path: str) -> None:
+        """
+        Guarda el almacén en `path/store.npz` (columnas, vocabularios y `synced_at`). El fichero
+        se escribe con un nombre temporal propio del proceso y se reemplaza de forma atómica:
+        aunque varios workers guarden a la vez, queda siempre una instantánea completa.
+        """
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            n = self.size
+            meta = {
+                "skills": self.skill_names,
+                "codes": self.codes,
+                "synced_at": self.synced_at.isoformat() if self.synced_at else None
+            }
+            arrays = {
+                "lead_ids": self.lead_ids[:n].copy(),
+                "academic": self.academic[:n].copy(),
+                "counts": self.counts[:n].copy(),
+                "skills": self.skills[:, :n].copy()
+            }
+        tmp = os.path.join(path, f"store.{os.getpid()}.tmp.npz")
+        np.savez(tmp, meta=np.array(json.dumps(meta, ensure_ascii=False)), **arrays)
+        os.replace(tmp, os.path.join(path, "store.npz"))
+
+    @classmethod
+    def load(cls, path: str) -> "LeadFeatureStore":
+        """Carga un almacén guardado con `save`; si no existe devuelve uno vacío"""
+        snapshot = os.path.join(path, "store.npz")
+        if not os.path.exists(snapshot):
+            return cls()
+        with np.load(snapshot) as data:
+            meta = json.loads(str(data["meta"]))
+            lead_ids = data["lead_ids"]
+            academic = data["academic"]
+            counts = data["counts"]
+            skills = data["skills"]
+        n = len(lead_ids)
+
+        store = cls(capacity=max(1024, n), words=max(1, skills.shape[0]))
+        store.skill_names = list(meta["skills"])
+        store.vocab = {name: i for i, name in enumerate(store.skill_names)}
+        store.codes = {field: dict(meta["codes"].get(field, {})) for field in ACADEMIC_FIELDS}
+        store.code_values = {
+            field: sorted(codes, key=codes.get) for field, codes in store.codes.items()
+        }
+        if meta.get("synced_at"):
+            store.synced_at = datetime.fromisoformat(meta["synced_at"])
+        store.lead_ids[:n] = lead_ids
+        store.academic[:n] = academic
+        store.counts[:n] = counts
+        store.skills[:skills.shape[0], :n] = skills
+        for word in range(skills.shape[0]):
+            store.skill_counts[:n] += _popcount(skills[word])
+        store.rows = {int(lead_id): i for i, lead_id in enumerate(lead_ids.tolist())}
+        store.size = n
+        return store
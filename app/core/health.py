@@ -0,0 +1,47 @@
+from typing import Dict, Any, List, Optional
+from .config import settings
+from .database import pool_stats
+
+def _check(name: str, value: Optional[float], limit: float, failures: List[str]) -> Dict[str, Any]:
+    ok = value is None or value <= limit
+    if not ok:
+        failures.append(name)
+    return {"value": value, "limit": limit, "ok": ok}
+
+def readiness_report(services) -> Dict[str, Any]:
+    """
+    Estado de saturación del worker: uso del pool de conexiones, retraso reciente del
+    event loop, llamadas al LLM en curso y profundidad de las colas. El worker deja de
+    estar listo si alguno supera su umbral (READY_MAX_*). No abre conexiones ni llama al
+    LLM: solo lee contadores en memoria.
+    """
+    failures: List[str] = []
+    primary = pool_stats(services.engine)
+    replica_engine = services.replica_engine
+    admission = services.admission
+    scheduler = services.evaluation_scheduler
+    loop_lag = services.loop_monitor.recent_max(settings.READY_LOOP_LAG_WINDOW_SECONDS)
+
+    checks = {
+        "db_pool_usage": _check("db_pool_usage", primary.get("usage"), settings.READY_MAX_DB_POOL_USAGE, failures),
+        "event_loop_lag_ms": _check("event_loop_lag_ms", loop_lag, settings.READY_MAX_LOOP_LAG_MS, failures),
+        "llm_inflight": _check("llm_inflight", services.llm_handler.inflight, settings.READY_MAX_LLM_INFLIGHT, failures),
+        "admission_queue_depth": _check(
+            "admission_queue_depth", admission.queue_depth, settings.READY_MAX_QUEUE_DEPTH, failures
+        )
+    }
+    return {
+        "status": "ready" if not failures else "unready",
+        "failed": failures,
+        "checks": checks,
+        "db_pool": {
+            "primary": primary,
+            "replica": pool_stats(replica_engine) if replica_engine is not None else None
+        },
+        "event_loop": services.loop_monitor.stats(),
+        "queues": {
+            "admission": admission.queue_depth,
+            "background_evaluations": scheduler.stats() if scheduler is not None else None,
+            "llm_usage_buffer": services.usage_ledger.buffered
+        }
+    }
@@ -0,0 +1,90 @@
+from typing import Iterable, Optional
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request, Response
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
+from .metrics import metrics
+
+# GET condicional: el cliente revalida con If-None-Match / If-Modified-Since y, si la
+# marca de agua del recurso no cambió, recibe un 304 sin cuerpo
+
+def make_etag(*parts: object) -> str:
+    """ETag débil: la misma marca de agua admite varias codificaciones (con y sin gzip)"""
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+def http_date(value: datetime) -> str:
+    # Las fechas de la base de datos son UTC sin zona horaria
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # La comparación débil ignora el prefijo W/
+    actual = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith("W/") else candidate) == actual:
+            return True
+    return False
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    """If-None-Match tiene prioridad; If-Modified-Since solo se usa si no viene"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    # Las fechas HTTP tienen resolución de segundos
+    return last_modified.replace(microsecond=0) <= since
+
+def set_validators(response: Response, etag: str, last_modified: Optional[datetime] = None) -> None:
+    response.headers["ETag"] = etag
+    if last_modified is not None:
+        response.headers["Last-Modified"] = http_date(last_modified)
+    # El cliente puede guardar la respuesta pero debe revalidarla en cada uso
+    response.headers["Cache-Control"] = "private, no-cache"
+
+def not_modified(endpoint: str, etag: str, last_modified: Optional[datetime] = None) -> Response:
+    response = Response(status_code=304)
+    set_validators(response, etag, last_modified)
+    metrics.inc("mcp_http_conditional_total", endpoint=endpoint, result="304")
+    return response
+
+class CompressionMiddleware:
+    """
+    GZip para respuestas de al menos `minimum_size` bytes. Los flujos SSE se excluyen:
+    el compresor retendría los eventos hasta llenar su buffer.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        compresslevel: int = 6,
+        exclude_paths: Iterable[str] = ()
+    ):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=compresslevel)
+        self.exclude_paths = tuple(exclude_paths)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            headers = Headers(scope=scope)
+            if (
+                "text/event-stream" not in headers.get("accept", "")
+                and not scope["path"].startswith(self.exclude_paths)
+            ):
+                await self.gzip(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
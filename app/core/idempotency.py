@@ -0,0 +1,61 @@
+from typing import Dict, Any, Optional
+import hashlib
+import json
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from .config import settings
+from ..models.chat import IdempotencyKey
+
+class IdempotencyConflictError(Exception):
+    """La clave de idempotencia ya se usó con un cuerpo de petición distinto"""
+
+def request_fingerprint(payload: Dict[str, Any]) -> str:
+    """Hash estable del cuerpo de la petición"""
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+def get_stored_response(
+    db: Session,
+    scope: str,
+    key: str,
+    request_hash: str
+) -> Optional[Dict[str, Any]]:
+    """Devuelve la respuesta guardada para una clave repetida, o None si no existe o expiró"""
+    stored = db.query(IdempotencyKey).filter(
+        IdempotencyKey.scope == scope,
+        IdempotencyKey.key == key
+    ).first()
+    if not stored:
+        return None
+    if stored.expires_at and stored.expires_at < datetime.utcnow():
+        db.delete(stored)
+        db.commit()
+        return None
+    if stored.request_hash != request_hash:
+        raise IdempotencyConflictError(
+            "La clave de idempotencia ya se utilizó con un mensaje diferente"
+        )
+    return stored.respuesta
+
+def store_response(
+    db: Session,
+    scope: str,
+    key: str,
+    request_hash: str,
+    respuesta: Dict[str, Any]
+) -> None:
+    """Guarda la respuesta asociada a la clave de idempotencia"""
+    db.add(IdempotencyKey(
+        scope=scope,
+        key=key,
+        request_hash=request_hash,
+        respuesta=respuesta,
+        expires_at=datetime.utcnow() + timedelta(hours=settings.IDEMPOTENCY_TTL_HOURS)
+    ))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Otra petición con la misma clave ya guardó su respuesta
+        db.rollback()
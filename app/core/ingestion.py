@@ -0,0 +1,290 @@
+from typing import Dict, Any, AsyncIterator, Deque, Iterable, List, Optional, Tuple
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import Executor
+from datetime import datetime
+from sqlalchemy import insert, select
+from sqlalchemy.engine import Connection, Engine
+from .relevance import relevance
+from .sanitizer import sanitize_records
+from ..models.chat import (
+    MensajeSanitizado,
+    ContextoConversacional,
+    PIIToken,
+    conversaciones_table,
+    mensajes_table
+)
+
+class IngestionError(Exception):
+    """Entrada de ingesta masiva no válida"""
+
+INGEST_FORMATS = ("ndjson", "csv")
+
+def parse_lines(lines: Iterable[str], fmt: str) -> Iterable[Dict[str, Any]]:
+    """Convierte líneas NDJSON o CSV (con cabecera) en registros de mensaje"""
+    if fmt not in INGEST_FORMATS:
+        raise IngestionError(f"Formato no soportado: {fmt}")
+    if fmt == "ndjson":
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        yield from csv.DictReader(lines)
+
+class _LineFeed:
+    """Iterador reanudable que alimenta a un único `csv.reader` con las líneas recibidas"""
+
+    def __init__(self):
+        self.lines: Deque[str] = deque()
+
+    def __iter__(self) -> "_LineFeed":
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+async def aparse_lines(lines: AsyncIterator[str], fmt: str) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Versión asíncrona de `parse_lines` para cuerpos de petición en streaming. En CSV las
+    líneas se acumulan hasta completar un registro (comillas equilibradas), de modo que
+    los campos entre comillas pueden contener saltos de línea.
+    """
+    if fmt not in INGEST_FORMATS:
+        raise IngestionError(f"Formato no soportado: {fmt}")
+    feed = _LineFeed()
+    reader = csv.reader(feed)
+    header: Optional[List[str]] = None
+    pending: List[str] = []
+    quotes = 0
+    async for line in lines:
+        if fmt == "ndjson":
+            if line.strip():
+                yield json.loads(line)
+            continue
+        if not pending and not line.strip():
+            continue
+        pending.append(line)
+        quotes += line.count('"')
+        if quotes % 2:
+            continue
+        feed.lines.extend(pending)
+        pending, quotes = [], 0
+        row = next(reader)
+        if header is None:
+            header = row
+        else:
+            yield dict(zip(header, row))
+    if pending:
+        raise IngestionError("CSV incompleto: un campo entre comillas no se cerró")
+
+async def aiter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Divide en líneas un cuerpo de petición recibido por fragmentos"""
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8") + "\n"
+    if pending:
+        yield pending.decode("utf-8")
+
+def _parse_datetime(value: Any) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    if value:
+        return datetime.fromisoformat(str(value))
+    return datetime.utcnow()
+
+class BulkIngestor:
+    """
+    Carga masiva de mensajes históricos sin pasar por el LLM.
+
+    Los lotes se sanitizan en un pool de procesos (`sanitize_records`) mientras el lote
+    anterior se inserta en la base de datos: `mensajes` con un INSERT multi-fila que
+    devuelve los ids, y `mensajes_sanitizados`/`contexto_conversacional` con COPY en
+    PostgreSQL (o inserciones por lotes en otros motores).
+    """
+
+    def __init__(self, engine: Engine, executor: Executor, batch_size: int = 1000):
+        self.engine = engine
+        self.executor = executor
+        self.batch_size = batch_size
+        self._conversaciones: Dict[Tuple[int, int], int] = {}
+        self._tokens: Dict[int, str] = {}
+        self.stats = {"recibidos": 0, "insertados": 0, "errores": 0, "pii": {}}
+
+    def _conversacion_id(self, conn: Connection, lead_id: int, chatbot_id: int, canal_id: Optional[int]) -> int:
+        key = (lead_id, chatbot_id)
+        if key not in self._conversaciones:
+            conversaciones = conversaciones_table.c
+            existente = conn.execute(
+                select(conversaciones.id).where(
+                    conversaciones.lead_id == lead_id,
+                    conversaciones.chatbot_id == chatbot_id
+                ).order_by(conversaciones.ultimo_mensaje.desc()).limit(1)
+            ).scalar()
+            if existente is None:
+                existente = conn.execute(
+                    insert(conversaciones_table).values(
+                        lead_id=lead_id,
+                        chatbot_id=chatbot_id,
+                        canal_id=canal_id,
+                        estado="activo",
+                        chatbot_activo=True,
+                        ultimo_mensaje=datetime.now()
+                    ).returning(conversaciones.id)
+                ).scalar()
+            self._conversaciones[key] = existente
+        return self._conversaciones[key]
+
+    def _token_anonimo(self, conn: Connection, lead_id: int) -> str:
+        if lead_id not in self._tokens:
+            token = conn.execute(
+                select(PIIToken.token_anonimo).where(
+                    PIIToken.lead_id == lead_id,
+                    PIIToken.is_active == True
+                ).limit(1)
+            ).scalar()
+            if token is None:
+                token = hashlib.sha256(f"{lead_id}-{datetime.utcnow().timestamp()}".encode()).hexdigest()
+                conn.execute(insert(PIIToken.__table__).values(
+                    lead_id=lead_id,
+                    token_anonimo=token,
+                    created_at=datetime.utcnow(),
+                    expires_at=datetime.utcnow(),
+                    is_active=True
+                ))
+            self._tokens[lead_id] = token
+        return self._tokens[lead_id]
+
+    def _copy_rows(self, conn: Connection, table, rows: List[Dict[str, Any]]) -> None:
+        if not rows:
+            return
+        if conn.dialect.name != "postgresql":
+            conn.execute(insert(table), rows)
+            return
+        columns = list(rows[0].keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([
+                json.dumps(row[col], ensure_ascii=False) if isinstance(row[col], (dict, list))
+                else "" if row[col] is None
+                else row[col]
+                for col in columns
+            ])
+        buffer.seek(0)
+        cursor = conn.connection.dbapi_connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                buffer
+            )
+        finally:
+            cursor.close()
+
+    def load_batch(self, records: List[Dict[str, Any]], sanitized: List[Dict[str, Any]]) -> int:
+        """Inserta un lote ya sanitizado en una sola transacción"""
+        with self.engine.begin() as conn:
+            mensajes = []
+            validos = []
+            for record, limpio in zip(records, sanitized):
+                try:
+                    lead_id = int(record["lead_id"])
+                    chatbot_id = int(record["chatbot_id"])
+                    canal_id = int(record["canal_id"]) if record.get("canal_id") else None
+                    origen = record.get("origen") or "usuario"
+                    created_at = _parse_datetime(record.get("created_at"))
+                    # Una metadata mal formada descarta solo su registro, no el lote
+                    metadata = record.get("metadata") or {}
+                    if isinstance(metadata, str):
+                        metadata = json.loads(metadata) if metadata else {}
+                except (KeyError, TypeError, ValueError):
+                    self.stats["errores"] += 1
+                    continue
+                mensajes.append({
+                    "conversacion_id": self._conversacion_id(conn, lead_id, chatbot_id, canal_id),
+                    "origen": origen,
+                    "remitente_id": lead_id if origen == "usuario" else chatbot_id if origen == "chatbot" else None,
+                    "contenido": record.get("contenido") or "",
+                    "tipo_contenido": record.get("tipo_contenido") or "texto",
+                    "metadata": metadata,
+                    "leido": True,
+                    "created_at": created_at
+                })
+                validos.append((lead_id, origen, created_at, limpio))
+
+            if not mensajes:
+                return 0
+
+            ids = conn.execute(
+                insert(mensajes_table).returning(mensajes_table.c.id, sort_by_parameter_order=True),
+                mensajes
+            ).scalars().all()
+
+            sanitizados = []
+            contextos = []
+            for mensaje_id, (lead_id, origen, created_at, limpio) in zip(ids, validos):
+                token = self._token_anonimo(conn, lead_id)
+                sanitizados.append({
+                    "mensaje_id": mensaje_id,
+                    "token_anonimo": token,
+                    "contenido_sanitizado": limpio["contenido_sanitizado"],
+                    "metadata_sanitizada": limpio["metadata_sanitizada"],
+                    "created_at": created_at
+                })
+                tipo_contexto = "mensaje_usuario" if origen == "usuario" else "respuesta_chatbot"
+                contextos.append({
+                    "token_anonimo": token,
+                    "tipo_contexto": tipo_contexto,
+                    "contenido_sanitizado": limpio["contenido_sanitizado"],
+                    **relevance.row_values(tipo_contexto, limpio["contenido_sanitizado"], created_at),
+                    "created_at": created_at,
+                    "updated_at": created_at
+                })
+                for kind, count in limpio["pii"].items():
+                    self.stats["pii"][kind] = self.stats["pii"].get(kind, 0) + count
+
+            self._copy_rows(conn, MensajeSanitizado.__table__, sanitizados)
+            self._copy_rows(conn, ContextoConversacional.__table__, contextos)
+        return len(ids)
+
+    async def ingest(self, records: AsyncIterator[Dict[str, Any]]) -> Dict[str, Any]:
+        """Sanitiza y carga los registros; la sanitización del lote N+1 se solapa con la carga del lote N"""
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        pending_load: Optional[asyncio.Future] = None
+
+        async def flush(batch: List[Dict[str, Any]]):
+            nonlocal pending_load
+            sanitized = await loop.run_in_executor(self.executor, sanitize_records, batch)
+            if pending_load is not None:
+                self.stats["insertados"] += await pending_load
+            # La carga bloquea en la base de datos: se ejecuta en el threadpool por defecto
+            pending_load = loop.run_in_executor(None, self.load_batch, batch, sanitized)
+
+        batch: List[Dict[str, Any]] = []
+        async for record in records:
+            batch.append(record)
+            self.stats["recibidos"] += 1
+            if len(batch) >= self.batch_size:
+                await flush(batch)
+                batch = []
+        if batch:
+            await flush(batch)
+        if pending_load is not None:
+            self.stats["insertados"] += await pending_load
+
+        elapsed = time.perf_counter() - start
+        return {
+            **self.stats,
+            "segundos": round(elapsed, 3),
+            "mensajes_por_segundo": round(self.stats["insertados"] / elapsed, 1) if elapsed > 0 else None
+        }
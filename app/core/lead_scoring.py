@@ -0,0 +1,462 @@
+from typing import Dict, Any, Callable, List, Optional, Sequence, Tuple
+from datetime import datetime
+import json
+import os
+import threading
+import time
+import numpy as np
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+from .metrics import metrics
+from ..models.chat import ContextoConversacional, EvaluacionLLM, MensajeSanitizado, PIIToken
+
+# Marca de las evaluaciones resueltas por el modelo local (se excluyen del entrenamiento)
+LOCAL_PROMPT = "modelo_local"
+
+MESSAGE_FEATURES = (
+    "mensajes", "longitud_media", "turnos_contexto", "horas_desde_ultimo", "score_previo", "tiene_evaluacion"
+)
+PROFILE_FEATURES = (
+    "experience_count", "certification_count", "publication_count", "awards_count", "skills", "tiene_perfil"
+)
+FEATURE_NAMES = MESSAGE_FEATURES + PROFILE_FEATURES
+TARGETS = ("score_potencial", "score_satisfaccion")
+
+def build_features(stats: np.ndarray, profile: np.ndarray) -> np.ndarray:
+    """
+    Matriz de features a partir de las estadísticas de mensajes (conteo, longitud media,
+    turnos de contexto, horas desde el último mensaje y score previo, NaN si no hay) y de
+    la matriz de perfil del almacén de features. Los conteos se comprimen con log1p.
+    """
+    stats = np.asarray(stats, dtype=np.float64).reshape(-1, 5)
+    profile = np.asarray(profile, dtype=np.float64).reshape(len(stats), len(PROFILE_FEATURES))
+    previo = stats[:, 4]
+    tiene_previo = ~np.isnan(previo)
+    return np.column_stack([
+        np.log1p(np.nan_to_num(stats[:, :4]).clip(min=0)),
+        np.where(tiene_previo, previo, 0.0),
+        tiene_previo.astype(np.float64),
+        np.log1p(profile[:, :-1]),
+        profile[:, -1]
+    ])
+
+def _sigmoid(z: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30, 30)))
+
+class LeadScoringModel:
+    """
+    Regresión logística multisalida (potencial y satisfacción en [0, 1]) entrenada por
+    descenso de gradiente por lotes completos sobre los scores del LLM, con las features
+    estandarizadas. Guarda el error y el acuerdo medidos en una partición de validación.
+    """
+
+    def __init__(self):
+        self.mean: Optional[np.ndarray] = None
+        self.std: Optional[np.ndarray] = None
+        self.weights: Optional[np.ndarray] = None
+        self.bias: Optional[np.ndarray] = None
+        self.samples = 0
+        self.rmse: Optional[float] = None
+        self.agreement: Optional[float] = None
+        self.trained_at: Optional[str] = None
+
+    @property
+    def trained(self) -> bool:
+        return self.weights is not None
+
+    def fit(
+        self,
+        X: np.ndarray,
+        Y: np.ndarray,
+        epochs: int = 500,
+        learning_rate: float = 0.5,
+        l2: float = 1e-3,
+        holdout: float = 0.2,
+        tolerance: float = 0.15,
+        seed: int = 0
+    ) -> Dict[str, Any]:
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.clip(np.asarray(Y, dtype=np.float64), 0.0, 1.0)
+        order = np.random.default_rng(seed).permutation(len(X))
+        n_val = int(len(X) * holdout) if len(X) >= 10 else 0
+        val, train = order[:n_val], order[n_val:]
+
+        self.mean = X[train].mean(axis=0)
+        std = X[train].std(axis=0)
+        self.std = np.where(std > 1e-9, std, 1.0)
+        Xs = (X[train] - self.mean) / self.std
+        weights = np.zeros((X.shape[1], Y.shape[1]))
+        # El sesgo parte del logit de la media: el modelo sin features predice el score medio
+        media = Y[train].mean(axis=0).clip(1e-3, 1 - 1e-3)
+        bias = np.log(media / (1 - media))
+        for _ in range(epochs):
+            # Entropía cruzada con objetivos continuos: el gradiente es (p - y)
+            error = _sigmoid(Xs @ weights + bias) - Y[train]
+            weights -= learning_rate * (Xs.T @ error / len(train) + l2 * weights)
+            bias -= learning_rate * error.mean(axis=0)
+        self.weights, self.bias = weights, bias
+
+        evaluado = val if n_val else train
+        diff = self.predict(X[evaluado])[:, 0] - Y[evaluado, 0]
+        self.samples = len(X)
+        self.rmse = round(float(np.sqrt(np.mean(diff ** 2))), 4)
+        self.agreement = round(float(np.mean(np.abs(diff) <= tolerance)), 4)
+        self.trained_at = datetime.utcnow().isoformat()
+        return self.info()
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """Scores en [0, 1], una fila por lead y una columna por objetivo"""
+        Xs = (np.asarray(X, dtype=np.float64) - self.mean) / self.std
+        return _sigmoid(Xs @ self.weights + self.bias)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "entrenado": self.trained,
+            "muestras": self.samples,
+            "rmse_validacion": self.rmse,
+            "acuerdo_validacion": self.agreement,
+            "entrenado_en": self.trained_at
+        }
+
+    def save(self, path: str) -> None:
+        """Guarda el modelo en un .npz (escritura atómica)"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Nombre temporal por proceso: dos workers pueden entrenar a la vez
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp,
+            mean=self.mean,
+            std=self.std,
+            weights=self.weights,
+            bias=self.bias,
+            meta=np.array(json.dumps({
+                "features": FEATURE_NAMES,
+                "samples": self.samples,
+                "rmse": self.rmse,
+                "agreement": self.agreement,
+                "trained_at": self.trained_at
+            }))
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LeadScoringModel":
+        """Carga un modelo guardado con `save`; sin fichero (o con otras features) devuelve uno sin entrenar"""
+        model = cls()
+        if not path or not os.path.exists(path):
+            return model
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            if tuple(meta.get("features") or ()) != FEATURE_NAMES:
+                return model
+            model.mean, model.std = data["mean"], data["std"]
+            model.weights, model.bias = data["weights"], data["bias"]
+        model.samples = meta["samples"]
+        model.rmse = meta["rmse"]
+        model.agreement = meta["agreement"]
+        model.trained_at = meta["trained_at"]
+        return model
+
+def _llm_evaluations():
+    return or_(EvaluacionLLM.prompt_utilizado.is_(None), EvaluacionLLM.prompt_utilizado != LOCAL_PROMPT)
+
+class LeadScorer:
+    """
+    Primer nivel de la evaluación de leads: un modelo local puntúa los leads por lotes
+    (una consulta agregada por tipo de dato y un producto de matrices) y solo los
+    inciertos o de alto valor se escalan al LLM.
+
+    Un lead se escala si el modelo no está entrenado o su error de validación supera
+    `max_rmse`, si el score de potencial está a menos de `margin` de 0.5 o si supera
+    `high_value` (umbrales y tolerancias sobre la escala [0, 1]). Una fracción `shadow_rate`
+    de los resueltos en local se escala igualmente para medir el acuerdo con el LLM en
+    producción. Las features de perfil las da `profile_provider` (normalmente
+    `LeadFeatureStore.profile_matrix`).
+
+    Un entrenamiento solo publica el modelo en el worker que lo ejecuta; los demás lo
+    recargan de `model_path` cuando cambia su fecha de modificación (se comprueba como
+    mucho cada `reload_interval` segundos, antes de puntuar).
+    """
+
+    def __init__(
+        self,
+        profile_provider: Callable[[Sequence[int]], np.ndarray],
+        model: Optional[LeadScoringModel] = None,
+        model_path: str = "",
+        max_score: float = 1.0,
+        margin: float = 0.15,
+        high_value: float = 0.7,
+        max_rmse: float = 0.2,
+        tolerance: float = 0.15,
+        shadow_rate: float = 0.05,
+        min_samples: int = 200,
+        train_limit: int = 20000,
+        reload_interval: float = 10.0
+    ):
+        self.profile_provider = profile_provider
+        self.model = model or LeadScoringModel()
+        self.model_path = model_path
+        self.max_score = max_score
+        self.margin = margin
+        self.high_value = high_value
+        self.max_rmse = max_rmse
+        self.tolerance = tolerance
+        self.shadow_rate = shadow_rate
+        self.min_samples = min_samples
+        self.train_limit = train_limit
+        self.reload_interval = reload_interval
+        self._model_mtime = self._mtime()
+        self._checked_at = time.monotonic()
+        self._rng = np.random.default_rng()
+        self._lock = threading.Lock()
+        self._decisions: Dict[str, int] = {"local": 0, "llm": 0}
+        self._reasons: Dict[str, int] = {}
+        self._compared = 0
+        self._agreed = 0
+        self._abs_error = 0.0
+        metrics.register_gauge(
+            "mcp_lead_scoring_llm_reduction",
+            lambda: self.reduction() or 0.0,
+            "Fracción de evaluaciones de leads resueltas sin llamar al LLM"
+        )
+
+    def _mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.model_path).st_mtime if self.model_path else None
+        except OSError:
+            return None
+
+    def maybe_reload(self) -> bool:
+        """Recarga el modelo de `model_path` si otro worker guardó uno más reciente"""
+        now = time.monotonic()
+        if not self.model_path or now - self._checked_at < self.reload_interval:
+            return False
+        self._checked_at = now
+        mtime = self._mtime()
+        if mtime is None or mtime == self._model_mtime:
+            return False
+        model = LeadScoringModel.load(self.model_path)
+        with self._lock:
+            self.model, self._model_mtime = model, mtime
+        metrics.inc("mcp_lead_scoring_reloads_total")
+        return True
+
+    def lead_stats(self, db: Session, lead_ids: Sequence[int], now: Optional[datetime] = None) -> np.ndarray:
+        """Estadísticas de mensajes actuales de cada lead (ver `build_features`)"""
+        now = now or datetime.utcnow()
+        index = {lead_id: i for i, lead_id in enumerate(lead_ids)}
+        stats = np.zeros((len(index), 5))
+        stats[:, 3] = np.nan
+        stats[:, 4] = np.nan
+        if not index:
+            return stats
+
+        mensajes = db.query(
+            PIIToken.lead_id,
+            func.count(MensajeSanitizado.id),
+            func.avg(func.length(MensajeSanitizado.contenido_sanitizado)),
+            func.max(MensajeSanitizado.created_at)
+        ).join(
+            MensajeSanitizado, MensajeSanitizado.token_anonimo == PIIToken.token_anonimo
+        ).filter(PIIToken.lead_id.in_(index)).group_by(PIIToken.lead_id)
+        for lead_id, total, longitud, ultimo in mensajes:
+            row = index[lead_id]
+            stats[row, 0] = total
+            stats[row, 1] = longitud or 0
+            if ultimo is not None:
+                stats[row, 3] = (now - ultimo).total_seconds() / 3600
+
+        contexto = db.query(PIIToken.lead_id, func.count(ContextoConversacional.id)).join(
+            ContextoConversacional, ContextoConversacional.token_anonimo == PIIToken.token_anonimo
+        ).filter(PIIToken.lead_id.in_(index)).group_by(PIIToken.lead_id)
+        for lead_id, total in contexto:
+            stats[index[lead_id], 2] = total
+
+        # Score de la última evaluación hecha por el LLM
+        ultimas = db.query(func.max(EvaluacionLLM.id)).filter(
+            EvaluacionLLM.lead_id.in_(index), _llm_evaluations()
+        ).group_by(EvaluacionLLM.lead_id).scalar_subquery()
+        previas = db.query(EvaluacionLLM.lead_id, EvaluacionLLM.score_potencial).filter(
+            EvaluacionLLM.id.in_(ultimas)
+        )
+        for lead_id, score in previas:
+            if score is not None:
+                stats[index[lead_id], 4] = score / self.max_score
+        return stats
+
+    def features(self, db: Session, lead_ids: Sequence[int]) -> np.ndarray:
+        lead_ids = list(lead_ids)
+        return build_features(self.lead_stats(db, lead_ids), self.profile_provider(lead_ids))
+
+    def training_set(self, db: Session) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Features y scores de las últimas `train_limit` evaluaciones del LLM. Las estadísticas
+        de mensajes se calculan en el instante de cada evaluación (solo mensajes anteriores),
+        y el score previo es el de la evaluación anterior del mismo lead.
+        """
+        evaluaciones = db.query(
+            EvaluacionLLM.id,
+            EvaluacionLLM.lead_id,
+            EvaluacionLLM.fecha_evaluacion,
+            EvaluacionLLM.score_potencial,
+            EvaluacionLLM.score_satisfaccion
+        ).filter(
+            _llm_evaluations(),
+            EvaluacionLLM.score_potencial.isnot(None),
+            EvaluacionLLM.score_satisfaccion.isnot(None),
+            EvaluacionLLM.fecha_evaluacion.isnot(None)
+        ).order_by(EvaluacionLLM.id.desc()).limit(self.train_limit).all()
+        if not evaluaciones:
+            return np.zeros((0, len(FEATURE_NAMES))), np.zeros((0, len(TARGETS)))
+        evaluaciones.sort(key=lambda e: (e.lead_id, e.fecha_evaluacion, e.id))
+        index = {e.id: i for i, e in enumerate(evaluaciones)}
+        stats = np.zeros((len(evaluaciones), 5))
+        stats[:, 3] = np.nan
+        stats[:, 4] = np.nan
+        for i in range(1, len(evaluaciones)):
+            if evaluaciones[i].lead_id == evaluaciones[i - 1].lead_id:
+                stats[i, 4] = evaluaciones[i - 1].score_potencial / self.max_score
+
+        mensajes = db.query(
+            EvaluacionLLM.id,
+            func.count(MensajeSanitizado.id),
+            func.avg(func.length(MensajeSanitizado.contenido_sanitizado)),
+            func.max(MensajeSanitizado.created_at)
+        ).join(PIIToken, PIIToken.lead_id == EvaluacionLLM.lead_id).join(
+            MensajeSanitizado,
+            (MensajeSanitizado.token_anonimo == PIIToken.token_anonimo)
+            & (MensajeSanitizado.created_at <= EvaluacionLLM.fecha_evaluacion)
+        ).filter(EvaluacionLLM.id.in_(index)).group_by(EvaluacionLLM.id)
+        for evaluacion_id, total, longitud, ultimo in mensajes:
+            row = index[evaluacion_id]
+            stats[row, 0] = total
+            stats[row, 1] = longitud or 0
+            if ultimo is not None:
+                stats[row, 3] = (evaluaciones[row].fecha_evaluacion - ultimo).total_seconds() / 3600
+
+        contexto = db.query(EvaluacionLLM.id, func.count(ContextoConversacional.id)).join(
+            PIIToken, PIIToken.lead_id == EvaluacionLLM.lead_id
+        ).join(
+            ContextoConversacional,
+            (ContextoConversacional.token_anonimo == PIIToken.token_anonimo)
+            & (ContextoConversacional.created_at <= EvaluacionLLM.fecha_evaluacion)
+        ).filter(EvaluacionLLM.id.in_(index)).group_by(EvaluacionLLM.id)
+        for evaluacion_id, total in contexto:
+            stats[index[evaluacion_id], 2] = total
+
+        X = build_features(stats, self.profile_provider([e.lead_id for e in evaluaciones]))
+        Y = np.array(
+            [[e.score_potencial, e.score_satisfaccion] for e in evaluaciones], dtype=np.float64
+        ) / self.max_score
+        return X, Y
+
+    def fit(self, X: np.ndarray, Y: np.ndarray) -> Dict[str, Any]:
+        """Entrena un modelo nuevo y lo publica (y guarda) solo si hay muestras suficientes"""
+        if len(X) < self.min_samples:
+            raise ValueError(
+                f"Se necesitan al menos {self.min_samples} evaluaciones del LLM para entrenar (hay {len(X)})"
+            )
+        model = LeadScoringModel()
+        info = model.fit(X, Y, tolerance=self.tolerance)
+        if self.model_path:
+            model.save(self.model_path)
+        with self._lock:
+            self.model, self._model_mtime = model, self._mtime()
+        metrics.inc("mcp_lead_scoring_trainings_total")
+        return info
+
+    def predict(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        """
+        Scores (en la escala de `max_score`), máscara de escalado al LLM y motivo por lead.
+        Las reglas se aplican de forma vectorizada sobre todo el lote.
+        """
+        model = self.model
+        n = len(X)
+        if not model.trained:
+            return np.full((n, len(TARGETS)), np.nan), np.ones(n, dtype=bool), ["sin_modelo"] * n
+        scores = model.predict(X)
+        if model.rmse is not None and model.rmse > self.max_rmse:
+            return scores * self.max_score, np.ones(n, dtype=bool), ["modelo_impreciso"] * n
+
+        potencial = scores[:, 0]
+        alto_valor = potencial >= self.high_value
+        incierto = np.abs(potencial - 0.5) < self.margin
+        muestreo = ~(alto_valor | incierto) & (self._rng.random(n) < self.shadow_rate)
+        motivos = np.select(
+            [alto_valor, incierto, muestreo], ["alto_valor", "incierto", "muestreo"], default="local"
+        )
+        return scores * self.max_score, alto_valor | incierto | muestreo, motivos.tolist()
+
+    def score(self, db: Session, lead_ids: Sequence[int]) -> List[Dict[str, Any]]:
+        """Puntúa un lote de leads con el modelo local y decide cuáles escalar al LLM"""
+        lead_ids = list(lead_ids)
+        self.maybe_reload()
+        if not self.model.trained:
+            # Sin modelo todos se escalan: no hace falta consultar sus features
+            return [
+                {
+                    "lead_id": lead_id,
+                    "score_potencial": None,
+                    "score_satisfaccion": None,
+                    "escalar": True,
+                    "motivo": "sin_modelo"
+                }
+                for lead_id in lead_ids
+            ]
+        scores, escalar, motivos = self.predict(self.features(db, lead_ids))
+        return [
+            {
+                "lead_id": lead_id,
+                "score_potencial": None if np.isnan(fila[0]) else round(float(fila[0]), 4),
+                "score_satisfaccion": None if np.isnan(fila[1]) else round(float(fila[1]), 4),
+                "escalar": bool(escala),
+                "motivo": motivo
+            }
+            for lead_id, fila, escala, motivo in zip(lead_ids, scores, escalar, motivos)
+        ]
+
+    def record_decision(self, escalar: bool, motivo: str) -> None:
+        tier = "llm" if escalar else "local"
+        with self._lock:
+            self._decisions[tier] += 1
+            self._reasons[motivo] = self._reasons.get(motivo, 0) + 1
+        metrics.inc("mcp_lead_scoring_total", tier=tier, motivo=motivo)
+
+    def record_agreement(self, local_score: Optional[float], llm_score: Optional[float]) -> None:
+        """Compara la predicción local con el score que dio el LLM para el mismo lead"""
+        if local_score is None or llm_score is None:
+            return
+        error = abs(local_score - llm_score) / self.max_score
+        agreed = error <= self.tolerance
+        with self._lock:
+            self._compared += 1
+            self._agreed += int(agreed)
+            self._abs_error += error
+        metrics.inc("mcp_lead_scoring_agreement_total", result="acuerdo" if agreed else "desacuerdo")
+
+    def reduction(self) -> Optional[float]:
+        total = self._decisions["local"] + self._decisions["llm"]
+        return round(self._decisions["local"] / total, 4) if total else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "modelo": self.model.info(),
+                "evaluaciones": dict(self._decisions),
+                "motivos": dict(self._reasons),
+                "reduccion_llamadas_llm": self.reduction(),
+                "acuerdo": {
+                    "comparadas": self._compared,
+                    "tasa": round(self._agreed / self._compared, 4) if self._compared else None,
+                    "error_medio": round(self._abs_error / self._compared, 4) if self._compared else None,
+                    "tolerancia": self.tolerance
+                },
+                "umbrales": {
+                    "margen": self.margin,
+                    "alto_valor": self.high_value,
+                    "max_rmse": self.max_rmse,
+                    "muestreo": self.shadow_rate
+                }
+            }
@@ -1,47 +1,175 @@
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, AsyncIterator, List, Optional
+import threading
+from contextlib import nullcontext
+import time
 import openai
+from .admission import AdmissionController, AdmissionRejected, AdmissionTicket
 from .config import settings
+from .conversation_state import ConversationState, ConversationStateStore
+from .faq import FAQMatcher
+from .metrics import metrics
+from .prompts import (
+    EVALUATION_INCREMENTAL_PROMPT,
+    EVALUATION_OUTPUT_PROMPT,
+    EVALUATION_SYSTEM_PROMPT,
+    build_chatbot_system_prompt,
+    build_prompt_messages,
+    prefix_fingerprint
+)
+from .semantic_memory import SemanticMemory
+from .traffic import OPERATION_HEADER, TrafficRecorder
+from .usage_ledger import UsageLedger
 from sqlalchemy.orm import Session
 
 class LLMHandler:
-    def __init__(self):
+    def __init__(
+        self,
+        client: Optional[openai.OpenAI] = None,
+        async_client: Optional[openai.AsyncOpenAI] = None,
+        memory: Optional[SemanticMemory] = None,
+        ledger: Optional[UsageLedger] = None,
+        recorder: Optional[TrafficRecorder] = None,
+        state_store: Optional[ConversationStateStore] = None,
+        faq: Optional[FAQMatcher] = None,
+        admission: Optional[AdmissionController] = None
+    ):
         self.provider = settings.DEFAULT_LLM_PROVIDER
         self.model = settings.DEFAULT_LLM_MODEL
-        openai.api_key = settings.LLM_API_KEY
+        # Los clientes HTTP los inyecta el contenedor de servicios; si no se
+        # proporcionan se crean en el primer uso (sin tocar el estado global de openai)
+        self._client = client
+        self._async_client = async_client
+        # Con memoria semántica el historial del prompt se elige por relevancia, no solo por recencia
+        self.memory = memory
+        # Registro de uso (tokens, latencia, coste) de cada llamada al LLM
+        self.ledger = ledger
+        # Grabación de los tiempos de cada llamada para reproducirlos con el LLM simulado
+        self.recorder = recorder
+        # Estado caliente de las conversaciones (prompt del chatbot e historial reciente en memoria)
+        self.state_store = state_store
+        # Respuestas directas desde qa_pares para las preguntas frecuentes
+        self.faq = faq
+        # Cuotas de llamadas al LLM para las evaluaciones (los turnos de chat se admiten en el endpoint)
+        self.admission = admission
+        # Llamadas al LLM en curso (para la comprobación de disponibilidad del worker)
+        self.inflight = 0
+        self._inflight_lock = threading.Lock()
+        metrics.register_gauge(
+            "mcp_llm_inflight",
+            lambda: self.inflight,
+            "Llamadas al LLM en curso"
+        )
+
+    @staticmethod
+    def cached_tokens(usage: Any) -> Optional[int]:
+        """Tokens del prompt servidos desde la caché de prefijos del proveedor (`prompt_tokens_details`)"""
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            return details.get("cached_tokens")
+        return getattr(details, "cached_tokens", None)
+
+    @property
+    def client(self) -> openai.OpenAI:
+        if self._client is None:
+            self._client = openai.OpenAI(
+                api_key=settings.LLM_API_KEY, base_url=settings.LLM_BASE_URL or None
+            )
+        return self._client
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        if self._async_client is None:
+            self._async_client = openai.AsyncOpenAI(
+                api_key=settings.LLM_API_KEY, base_url=settings.LLM_BASE_URL or None
+            )
+        return self._async_client
+
+    def _begin_call(self) -> float:
+        """Marca el inicio de una llamada; `_record_usage` la da por terminada"""
+        with self._inflight_lock:
+            self.inflight += 1
+        return time.perf_counter()
+
+    def _record_usage(
+        self,
+        operacion: str,
+        started: float,
+        usage: Any = None,
+        chatbot_id: Optional[int] = None,
+        exito: bool = True,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None
+    ) -> None:
+        latencia_ms = (time.perf_counter() - started) * 1000
+        with self._inflight_lock:
+            self.inflight = max(0, self.inflight - 1)
+        prompt_tokens = getattr(usage, "prompt_tokens", prompt_tokens)
+        completion_tokens = getattr(usage, "completion_tokens", completion_tokens)
+        cached_tokens = self.cached_tokens(usage)
+        if self.recorder is not None:
+            self.recorder.record_llm(operacion, latencia_ms, prompt_tokens, completion_tokens, exito)
+        if self.ledger is None:
+            return
+        self.ledger.record(
+            operacion=operacion,
+            modelo=self.model,
+            provider=self.provider,
+            chatbot_id=chatbot_id,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cached_tokens=cached_tokens,
+            latencia_ms=latencia_ms,
+            exito=exito
+        )
+
+    def record_cache_hit(self, operacion: str, chatbot_id: Optional[int] = None) -> None:
+        """Registra una respuesta servida sin llamar al LLM (caché, idempotencia)"""
+        if self.ledger is not None:
+            self.ledger.record(
+                operacion=operacion,
+                modelo=self.model,
+                provider=self.provider,
+                chatbot_id=chatbot_id,
+                prompt_tokens=0,
+                completion_tokens=0,
+                latencia_ms=0.0,
+                cache_hit=True
+            )
 
     async def process_prompt(
         self,
         prompt_template: str,
         context: Dict[str, Any],
-        system_context: Optional[str] = None
+        system_context: Optional[str] = None,
+        chatbot_id: Optional[int] = None
     ) -> Dict[str, Any]:
         """
-        Procesa un prompt con el LLM configurado, asegurando que no se envíen datos personales
+        Procesa un prompt con el LLM configurado, asegurando que no se envíen datos personales.
+        El sistema y la plantilla forman un prefijo fijo; el contexto va serializado al final.
+
+        Con control de admisión la llamada consume la cuota de `chatbot_id` (o solo la global);
+        si no hay capacidad se propaga `AdmissionRejected` en lugar de devolver un error.
         """
         try:
-            messages = []
-            
-            # Añadir contexto del sistema si existe
-            if system_context:
-                messages.append({
-                    "role": "system",
-                    "content": system_context
-                })
-            
-            # Añadir el contexto procesado
-            context_str = str(context)
-            messages.append({
-                "role": "user",
-                "content": f"{prompt_template}\n\nContexto:\n{context_str}"
-            })
+            messages = build_prompt_messages(prompt_template, context, system_context)
             
             # Realizar la llamada al LLM
-            response = await openai.ChatCompletion.acreate(
-                model=self.model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=2000
-            )
+            async with self._admit(chatbot_id) as ticket:
+                started = self._begin_call()
+                try:
+                    response = await self.async_client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=2000,
+                        extra_headers={OPERATION_HEADER: "evaluacion"}
+                    )
+                except Exception:
+                    self._record_usage("evaluacion", started, exito=False)
+                    raise
+                self._record_usage("evaluacion", started, response.usage)
+                if ticket is not None:
+                    ticket.record_usage(response.usage.total_tokens)
             
             # Procesar la respuesta
             content = response.choices[0].message.content
@@ -65,10 +193,13 @@ class LLMHandler:
                 "metadata": {
                     "model": self.model,
                     "provider": self.provider,
-                    "tokens_used": response.usage.total_tokens
+                    "tokens_used": response.usage.total_tokens,
+                    "cached_tokens": self.cached_tokens(response.usage)
                 }
             }
             
+        except AdmissionRejected:
+            raise
         except Exception as e:
             return {
                 "success": False,
@@ -83,53 +214,100 @@ class LLMHandler:
 
     async def evaluate_conversation(
         self,
-        conversation_context: Dict[str, Any]
+        conversation_context: Dict[str, Any],
+        incremental: bool = False,
+        chatbot_id: Optional[int] = None
     ) -> Dict[str, Any]:
         """
-        Evalúa una conversación completa para determinar el potencial del lead
+        Evalúa una conversación completa para determinar el potencial del lead.
+        Con `incremental` el contexto solo trae los mensajes nuevos y la evaluación previa.
         """
-        system_context = """Eres un analista experto en evaluación de leads. 
-        Tu tarea es analizar la conversación proporcionada y evaluar:
-        1. El potencial del lead (0.0 a 1.0)
-        2. El nivel de satisfacción actual (0.0 a 1.0)
-        3. Interés en productos específicos
-        4. Palabras clave relevantes
-        
-        IMPORTANTE: No uses ni reveles información personal en tu análisis.
-        Céntrate en patrones de comportamiento e intereses."""
-        
-        evaluation_prompt = """Analiza el siguiente contexto conversacional y proporciona:
-        {
-            "score_potencial": float,
-            "score_satisfaccion": float,
-            "interes_productos": {
-                "producto_name": float  // nivel de interés de 0 a 1
-            },
-            "palabras_clave": ["keyword1", "keyword2"],
-            "analisis": "Breve análisis sin datos personales"
-        }"""
+        # Las instrucciones son constantes: el prefijo del prompt es el mismo en cada evaluación
+        system_context = EVALUATION_SYSTEM_PROMPT
+        if incremental:
+            system_context += "\n\n" + EVALUATION_INCREMENTAL_PROMPT
         
         return await self.process_prompt(
-            prompt_template=evaluation_prompt,
+            prompt_template=EVALUATION_OUTPUT_PROMPT,
             context=conversation_context,
-            system_context=system_context
+            system_context=system_context,
+            chatbot_id=chatbot_id
         )
 
-    def process_message(
+    def _admit(self, chatbot_id: Optional[int]):
+        if self.admission is None:
+            return nullcontext()
+        return self.admission.admit(chatbot_id)
+
+    def build_system_context(self, chatbot: Any, chatbot_context: List[Any]) -> str:
+        """
+        Construye el prompt de sistema del chatbot a partir de su configuración. El resultado
+        es idéntico byte a byte mientras la configuración no cambie, para que el proveedor
+        pueda reutilizar el prefijo cacheado.
+        """
+        return build_chatbot_system_prompt(chatbot, chatbot_context)
+
+    async def stream_reply(
+        self,
+        messages: List[Dict[str, str]],
+        chatbot_id: Optional[int] = None,
+        ticket: Optional[AdmissionTicket] = None
+    ) -> AsyncIterator[str]:
+        """
+        Genera la respuesta del chatbot token a token. El streaming no devuelve el uso, así
+        que en el registro los tokens son estimados (fragmentos recibidos y ~4 caracteres por token).
+        La misma estimación salda la reserva del `ticket` de admisión.
+        """
+        started = self._begin_call()
+        fragmentos = 0
+        exito = False
+        try:
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1000,
+                stream=True,
+                extra_headers={OPERATION_HEADER: "chat_stream"}
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    fragmentos += 1
+                    yield chunk.choices[0].delta.content
+            exito = True
+        finally:
+            prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4
+            self._record_usage(
+                "chat_stream",
+                started,
+                chatbot_id=chatbot_id,
+                exito=exito,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=fragmentos
+            )
+            if ticket is not None:
+                ticket.record_usage(prompt_tokens + fragmentos)
+
+    async def process_message(
         self,
         db: Session,
         chatbot_id: int,
         token_anonimo: str,
-        contenido_sanitizado: str
+        contenido_sanitizado: str,
+        state: Optional[ConversationState] = None
     ) -> Dict[str, Any]:
         """
-        Procesa un mensaje de un usuario y genera una respuesta utilizando el chatbot configurado
+        Procesa un mensaje de un usuario y genera una respuesta utilizando el chatbot configurado.
+        Si el mensaje coincide con una pregunta frecuente del chatbot (`faq`), se responde
+        con su respuesta ideal sin llamar al LLM.
         
         Args:
             db: Sesión de base de datos
             chatbot_id: ID del chatbot que procesará el mensaje
             token_anonimo: Token anónimo del lead
             contenido_sanitizado: Contenido del mensaje sanitizado
+            state: Estado caliente de la conversación; si se pasa, el historial reciente
+                sale de memoria y la respuesta se añade a él
             
         Returns:
             Dict con la respuesta del chatbot
@@ -137,53 +315,75 @@ class LLMHandler:
         try:
             from ..models.chat import Chatbot, ChatbotContexto, ContextoConversacional
             
-            # Obtener configuración del chatbot
-            chatbot = db.query(Chatbot).filter(Chatbot.id == chatbot_id).first()
-            if not chatbot:
-                return {
-                    "success": False,
-                    "error": "Chatbot no encontrado",
-                    "respuesta": "Lo siento, no puedo procesar tu mensaje en este momento."
-                }
+            if self.state_store is not None:
+                # El prompt de sistema del chatbot se guarda en memoria entre turnos
+                system_context = self.state_store.system_prompt(db, chatbot_id)
+                if system_context is None:
+                    return {
+                        "success": False,
+                        "error": "Chatbot no encontrado",
+                        "respuesta": "Lo siento, no puedo procesar tu mensaje en este momento."
+                    }
+            else:
+                # Obtener configuración del chatbot
+                chatbot = db.query(Chatbot).filter(Chatbot.id == chatbot_id).first()
+                if not chatbot:
+                    return {
+                        "success": False,
+                        "error": "Chatbot no encontrado",
+                        "respuesta": "Lo siento, no puedo procesar tu mensaje en este momento."
+                    }
+                    
+                # Obtener contexto del chatbot
+                chatbot_context = db.query(ChatbotContexto).filter(
+                    ChatbotContexto.chatbot_id == chatbot_id
+                ).order_by(ChatbotContexto.orden).all()
                 
-            # Obtener contexto del chatbot
-            chatbot_context = db.query(ChatbotContexto).filter(
-                ChatbotContexto.chatbot_id == chatbot_id
-            ).order_by(ChatbotContexto.orden).all()
-            
-            # Construir sistema de contexto
-            system_context = f"""Eres un asistente virtual para {chatbot.nombre}. 
-            
-            PERSONALIDAD: {chatbot.personalidad or 'Amigable y profesional'}
-            
-            TONO: {chatbot.tono or 'Formal pero cercano'}
-            
-            INSTRUCCIONES: {chatbot.instrucciones or 'Responde de manera útil y concisa'}
+                # Construir sistema de contexto
+                system_context = self.build_system_context(chatbot, chatbot_context)
             
-            CONTEXTO: {chatbot.contexto or 'Eres un asistente virtual de atención al cliente'}
+            # Preguntas frecuentes: la respuesta ideal se devuelve sin construir el prompt
+            if self.faq is not None:
+                faq = self.faq.match(db, chatbot_id, contenido_sanitizado)
+                if faq is not None:
+                    self.record_cache_hit("chat", chatbot_id=chatbot_id)
+                    self._store_reply(db, token_anonimo, faq["respuesta"], state)
+                    return {
+                        "success": True,
+                        "respuesta": faq["respuesta"],
+                        "metadata": {
+                            "model": "faq",
+                            "provider": "qa_pares",
+                            "tokens_used": 0,
+                            "faq": {key: faq[key] for key in ("qa_id", "score", "exacta", "match_ms")}
+                        }
+                    }
             
-            IMPORTANTE: Nunca reveles que eres una IA. Responde como si fueras un agente humano representando a la empresa.
-            """
+            # Obtener historial de conversación: turnos recientes y los más relevantes para el mensaje
+            if self.memory is not None:
+                conversation_history = self.memory.select_context(
+                    db,
+                    token_anonimo,
+                    contenido_sanitizado,
+                    k=settings.MEMORY_TOP_K,
+                    recent=settings.MEMORY_RECENT_TURNS,
+                    recent_turns=list(state.history) if state is not None else None
+                )
+            elif state is not None:
+                conversation_history = list(state.history)[-10:]
+            else:
+                conversation_history = list(reversed(db.query(ContextoConversacional).filter(
+                    ContextoConversacional.token_anonimo == token_anonimo
+                ).order_by(ContextoConversacional.created_at.desc()).limit(10).all()))
             
-            # Añadir contexto adicional de ChatbotContexto si está disponible
-            for ctx in chatbot_context:
-                if ctx.general_context:
-                    system_context += f"\n\n{ctx.general_context}"
-                if ctx.special_instructions:
-                    system_context += f"\n\nINSTRUCCIONES ESPECIALES: {ctx.special_instructions}"
-            
-            # Obtener historial de conversación reciente
-            conversation_history = db.query(ContextoConversacional).filter(
-                ContextoConversacional.token_anonimo == token_anonimo
-            ).order_by(ContextoConversacional.created_at.desc()).limit(10).all()
-            
-            # Construir mensajes para el LLM
+            # Construir mensajes para el LLM: el prompt de sistema fijo primero y lo que
+            # cambia en cada turno (historial y mensaje actual) al final
             messages = [
                 {"role": "system", "content": system_context}
             ]
             
-            # Añadir historia conversacional
-            for msg in reversed(conversation_history):
+            # Añadir historia conversacional (en orden cronológico)
+            for msg in conversation_history:
                 role = "user" if msg.tipo_contexto == "mensaje_usuario" else "assistant"
                 messages.append({
                     "role": role,
@@ -197,25 +397,26 @@ class LLMHandler:
             })
             
             # Realizar llamada a la API
-            response = openai.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=1000
-            )
+            started = self._begin_call()
+            try:
+                response = await self.async_client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=1000,
+                    extra_headers={OPERATION_HEADER: "chat"}
+                )
+            except Exception:
+                self._record_usage("chat", started, chatbot_id=chatbot_id, exito=False)
+                raise
+            if self.faq is not None:
+                self.faq.observe_llm_latency((time.perf_counter() - started) * 1000)
+            self._record_usage("chat", started, response.usage, chatbot_id=chatbot_id)
             
             respuesta_contenido = response.choices[0].message.content
             
             # Registrar respuesta en contexto conversacional
-            from ..models.chat import ContextoConversacional
-            nuevo_contexto = ContextoConversacional(
-                token_anonimo=token_anonimo,
-                tipo_contexto="respuesta_chatbot",
-                contenido_sanitizado=respuesta_contenido,
-                relevancia_score=1.0
-            )
-            db.add(nuevo_contexto)
-            db.commit()
+            self._store_reply(db, token_anonimo, respuesta_contenido, state)
             
             return {
                 "success": True,
@@ -223,7 +424,9 @@ class LLMHandler:
                 "metadata": {
                     "model": self.model,
                     "provider": self.provider,
-                    "tokens_used": response.usage.total_tokens
+                    "tokens_used": response.usage.total_tokens,
+                    "cached_tokens": self.cached_tokens(response.usage),
+                    "prompt_prefix": prefix_fingerprint(messages)
                 }
             }
         
@@ -234,4 +437,23 @@ class LLMHandler:
                 "error": str(e),
                 "traceback": traceback.format_exc(),
                 "respuesta": "Lo siento, ha ocurrido un error al procesar tu mensaje. Por favor, inténtalo de nuevo más tarde."
-            }
\ No newline at end of file
+            }
+
+    def _store_reply(
+        self,
+        db: Session,
+        token_anonimo: str,
+        respuesta: str,
+        state: Optional[ConversationState]
+    ) -> None:
+        """Guarda la respuesta como turno del contexto conversacional (y en el estado en memoria)"""
+        from ..models.chat import ContextoConversacional
+        nuevo_contexto = ContextoConversacional(
+            token_anonimo=token_anonimo,
+            tipo_contexto="respuesta_chatbot",
+            contenido_sanitizado=respuesta
+        )
+        db.add(nuevo_contexto)
+        db.commit()
+        if state is not None and self.state_store is not None:
+            self.state_store.record_turn(state, nuevo_contexto, "respuesta_chatbot", respuesta)
\ No newline at end of file
@@ -0,0 +1,60 @@
+from typing import Dict, Optional
+import asyncio
+from collections import deque
+from .metrics import metrics
+
+class EventLoopMonitor:
+    """
+    Sonda en segundo plano que mide el retraso del event loop: programa un sleep de
+    `interval` segundos y mide cuánto tarda realmente en despertar.
+    """
+
+    def __init__(self, interval: float = 0.25, window: int = 240):
+        self.interval = interval
+        self.samples: deque = deque(maxlen=window)
+        self.last_ms = 0.0
+        self._task: Optional[asyncio.Task] = None
+        metrics.register_gauge(
+            "mcp_event_loop_lag_ms",
+            lambda: self.last_ms,
+            "Retraso de la última medición del event loop (ms)"
+        )
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_ms = max(0.0, (loop.time() - start - self.interval) * 1000)
+            self.samples.append(self.last_ms)
+
+    def recent_max(self, seconds: float) -> float:
+        """Mayor retraso medido en los últimos `seconds` segundos"""
+        count = max(1, int(seconds / self.interval))
+        recientes = list(self.samples)[-count:]
+        return round(max(recientes), 3) if recientes else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"last_ms": 0.0, "max_ms": 0.0, "p50_ms": 0.0, "p99_ms": 0.0, "samples": 0}
+        return {
+            "last_ms": round(self.last_ms, 3),
+            "max_ms": round(ordered[-1], 3),
+            "p50_ms": round(ordered[len(ordered) // 2], 3),
+            "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 3),
+            "samples": len(ordered)
+        }
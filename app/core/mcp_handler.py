@@ -1,7 +1,8 @@
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, FrozenSet, List, Optional, Tuple
 import hashlib
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from ..models.chat import (
     MensajeSanitizado,
@@ -9,18 +10,101 @@ from ..models.chat import (
     PIIToken,
     ChatbotContexto,
     QAPar,
-    EvaluacionLLM
+    EvaluacionLLM,
+    LeadWatermark
 )
+from . import sanitizer
+from .config import settings
+from .executors import CPUExecutor
+from .lead_scoring import LOCAL_PROMPT, LeadScorer
 from .llm_handler import LLMHandler
+from .relevance import relevance
 
-class MCPHandler:
-    def __init__(self):
-        self.sensitive_fields = {
-            'email', 'first_name', 'last_name', 'phone', 'viewer_ip',
-            'viewer_profile_id', 'profile_id', 'user_id', 'nombre',
-            'apellido', 'telefono', 'direccion', 'ciudad', 'pais'
+# Grupo de single-flight que comparten /analytics/analyze-lead y las evaluaciones en segundo plano
+ANALYZE_LEAD_FLIGHT = "analyze-lead"
+
+def analysis_response(evaluacion: EvaluacionLLM, metadata: Dict[str, Any], cached: bool) -> Dict[str, Any]:
+    """
+    Resultado de un análisis de lead. Se construye dentro del single-flight para que los
+    que esperan no lean la evaluación de una sesión ajena.
+    """
+    return {
+        "analysis_id": evaluacion.id,
+        "timestamp": datetime.now().isoformat(),
+        "cached": cached,
+        "lead_analysis": {
+            "score_potencial": evaluacion.score_potencial,
+            "score_satisfaccion": evaluacion.score_satisfaccion,
+            "intereses": evaluacion.interes_productos,
+            "palabras_clave": evaluacion.palabras_clave,
+            "metadata": metadata
+        }
+    }
+
+class EvaluationFailedError(Exception):
+    """El LLM no devolvió una evaluación utilizable (error de la llamada o respuesta no JSON)"""
+
+# Funciones de módulo para que puedan ejecutarse también en un pool de procesos
+def extract_profile_analytics(profile_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Extrae datos analíticos relevantes sin información personal"""
+    analytics = {
+        "timestamp": datetime.now().isoformat(),
+        "academic_info": {
+            "university_id": profile_data.get("university_id"),
+            "faculty_id": profile_data.get("faculty_id"),
+            "program_id": profile_data.get("program_id"),
+            "graduation_year": profile_data.get("graduation_date", "")[:4] if profile_data.get("graduation_date") else None
+        },
+        "skills": [
+            {"name": skill["name"], "category": skill["category"], "proficiency": skill["proficiency"]}
+            for skill in profile_data.get("skills", [])
+        ],
+        "experience_count": len(profile_data.get("work_experience", [])),
+        "certification_count": len(profile_data.get("certifications", [])),
+        "publication_count": len(profile_data.get("publications", [])),
+        "awards_count": len(profile_data.get("awards", []))
+    }
+    return analytics
+
+def build_llm_context(data: Dict[str, Any], sensitive_fields: FrozenSet[str]) -> Dict[str, Any]:
+    """Prepara los datos para ser procesados por el LLM"""
+    # Primero anonimizamos los datos
+    anonymized_data = sanitizer.anonymize_data(data, sensitive_fields)
+    
+    # Extraemos métricas y análisis relevantes
+    analytics = extract_profile_analytics(data)
+    
+    # Preparamos el contexto para el LLM
+    llm_context = {
+        "analytics": analytics,
+        "anonymized_data": anonymized_data,
+        "metadata": {
+            "timestamp": datetime.now().isoformat(),
+            "data_version": "1.0",
+            "context_type": "crm_profile_analysis"
         }
-        self.llm_handler = LLMHandler()
+    }
+    
+    return llm_context
+
+class MCPHandler:
+    def __init__(
+        self,
+        llm_handler: Optional[LLMHandler] = None,
+        executor: Optional[CPUExecutor] = None,
+        lead_scorer: Optional[LeadScorer] = None
+    ):
+        self.sensitive_fields = set(sanitizer.SENSITIVE_FIELDS)
+        self._llm_handler = llm_handler
+        self.executor = executor
+        self.lead_scorer = lead_scorer
+
+    @property
+    def llm_handler(self) -> LLMHandler:
+        # Se crea en el primer uso para no abrir clientes HTTP si solo se anonimiza
+        if self._llm_handler is None:
+            self._llm_handler = LLMHandler()
+        return self._llm_handler
 
     def create_pii_token(self, db: Session, lead_id: int) -> str:
         """Crea un token anónimo para un lead"""
@@ -34,64 +118,50 @@ class MCPHandler:
         db.commit()
         return token
 
+    def get_or_create_pii_token(self, db: Session, lead_id: int) -> str:
+        """Devuelve el token anónimo activo del lead, o crea uno nuevo"""
+        pii_token = db.query(PIIToken).filter(
+            PIIToken.lead_id == lead_id,
+            PIIToken.is_active == True
+        ).first()
+        if pii_token:
+            return pii_token.token_anonimo
+        return self.create_pii_token(db, lead_id)
+
     def anonymize_data(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Anonimiza datos sensibles reemplazándolos con hashes"""
-        anonymized = {}
-        for key, value in data.items():
-            if key in self.sensitive_fields and value:
-                anonymized[key] = hashlib.sha256(str(value).encode()).hexdigest()[:16]
-            elif isinstance(value, dict):
-                anonymized[key] = self.anonymize_data(value)
-            elif isinstance(value, list):
-                anonymized[key] = [
-                    self.anonymize_data(item) if isinstance(item, dict) else item 
-                    for item in value
-                ]
-            else:
-                anonymized[key] = value
-        return anonymized
+        return sanitizer.anonymize_data(data, self.sensitive_fields)
 
     def extract_profile_analytics(self, profile_data: Dict[str, Any]) -> Dict[str, Any]:
         """Extrae datos analíticos relevantes sin información personal"""
-        analytics = {
-            "timestamp": datetime.now().isoformat(),
-            "academic_info": {
-                "university_id": profile_data.get("university_id"),
-                "faculty_id": profile_data.get("faculty_id"),
-                "program_id": profile_data.get("program_id"),
-                "graduation_year": profile_data.get("graduation_date", "")[:4] if profile_data.get("graduation_date") else None
-            },
-            "skills": [
-                {"name": skill["name"], "category": skill["category"], "proficiency": skill["proficiency"]}
-                for skill in profile_data.get("skills", [])
-            ],
-            "experience_count": len(profile_data.get("work_experience", [])),
-            "certification_count": len(profile_data.get("certifications", [])),
-            "publication_count": len(profile_data.get("publications", [])),
-            "awards_count": len(profile_data.get("awards", []))
-        }
-        return analytics
+        return extract_profile_analytics(profile_data)
 
     def prepare_data_for_llm(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Prepara los datos para ser procesados por el LLM"""
-        # Primero anonimizamos los datos
-        anonymized_data = self.anonymize_data(data)
-        
-        # Extraemos métricas y análisis relevantes
-        analytics = self.extract_profile_analytics(data)
-        
-        # Preparamos el contexto para el LLM
-        llm_context = {
-            "analytics": analytics,
-            "anonymized_data": anonymized_data,
-            "metadata": {
-                "timestamp": datetime.now().isoformat(),
-                "data_version": "1.0",
-                "context_type": "crm_profile_analysis"
-            }
-        }
-        
-        return llm_context
+        return build_llm_context(data, frozenset(self.sensitive_fields))
+
+    async def _run_cpu(self, fn, *args):
+        # Los payloads grandes se procesan fuera del event loop si hay executor configurado
+        if self.executor is None:
+            return fn(*args)
+        return await self.executor.run(fn, *args, payload=args[0])
+
+    async def anonymize_message(
+        self,
+        contenido: str,
+        metadata: Dict[str, Any]
+    ) -> Tuple[str, Dict[str, Any]]:
+        """Anonimiza contenido y metadata de un mensaje sin bloquear el event loop"""
+        resultado = await self._run_cpu(
+            sanitizer.anonymize_data,
+            {"content": contenido, "metadata": metadata},
+            frozenset(self.sensitive_fields)
+        )
+        return resultado["content"], resultado["metadata"]
+
+    async def prepare_data_for_llm_async(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Versión de `prepare_data_for_llm` que descarga los payloads grandes al executor"""
+        return await self._run_cpu(build_llm_context, data, frozenset(self.sensitive_fields))
 
     def prepare_chatbot_context(
         self, 
@@ -109,10 +179,14 @@ class MCPHandler:
             QAPar.is_active == True
         ).all()
 
+        # Top-k por relevancia actual: el score guardado ya incluye el decaimiento. El orden
+        # DESC (sin NULLS LAST) es el del índice (token, score) recorrido al revés, así que
+        # PostgreSQL lee solo k filas; las filas sin score (anteriores a la migración) se excluyen
         conversation_context = db.query(ContextoConversacional).filter(
-            ContextoConversacional.token_anonimo == conversation_token
+            ContextoConversacional.token_anonimo == conversation_token,
+            ContextoConversacional.relevancia_log.isnot(None)
         ).order_by(
-            ContextoConversacional.relevancia_score.desc()
+            ContextoConversacional.relevancia_log.desc()
         ).limit(5).all()
 
         return {
@@ -137,7 +211,7 @@ class MCPHandler:
                 {
                     "tipo": ctx.tipo_contexto,
                     "contenido": ctx.contenido_sanitizado,
-                    "relevancia": ctx.relevancia_score
+                    "relevancia": relevance.current(ctx.relevancia_log)
                 }
                 for ctx in conversation_context
             ]
@@ -154,7 +228,19 @@ class MCPHandler:
         """Guarda una versión sanitizada del mensaje"""
         sanitized_content = self.anonymize_data({"content": contenido_original})["content"]
         sanitized_metadata = self.anonymize_data(metadata)
+        return self.store_sanitized_message(
+            db, mensaje_id, token_anonimo, sanitized_content, sanitized_metadata
+        )
 
+    def store_sanitized_message(
+        self,
+        db: Session,
+        mensaje_id: int,
+        token_anonimo: str,
+        sanitized_content: str,
+        sanitized_metadata: Dict[str, Any]
+    ) -> MensajeSanitizado:
+        """Guarda un mensaje ya sanitizado"""
         mensaje_sanitizado = MensajeSanitizado(
             mensaje_id=mensaje_id,
             token_anonimo=token_anonimo,
@@ -173,9 +259,18 @@ class MCPHandler:
         mensaje_id: int,
         llm_config_id: int,
         contenido_sanitizado: str,
-        prompt_template: str
+        prompt_template: str,
+        evaluacion_previa: Optional[EvaluacionLLM] = None,
+        peso_nuevo: float = 1.0,
+        chatbot_id: Optional[int] = None
     ) -> EvaluacionLLM:
-        """Evalúa una conversación usando el LLM configurado"""
+        """
+        Evalúa una conversación usando el LLM configurado.
+        Si se indica `evaluacion_previa`, el resultado se fusiona con ella usando `peso_nuevo`.
+        La llamada se atribuye a `chatbot_id` en la admisión y en `llm_usage`.
+        Si el LLM falla o su respuesta no es JSON se lanza `EvaluationFailedError` sin guardar
+        nada: unos scores a cero no deben llegar a las cohortes ni al entrenamiento del modelo local.
+        """
         # Preparar el contexto para el LLM
         context = {
             "contenido_sanitizado": contenido_sanitizado,
@@ -186,17 +281,29 @@ class MCPHandler:
         }
         
         # Obtener evaluación del LLM
-        llm_response = await self.llm_handler.evaluate_conversation(context)
+        llm_response = await self.llm_handler.evaluate_conversation(
+            context,
+            incremental=evaluacion_previa is not None,
+            chatbot_id=chatbot_id
+        )
+        if not llm_response.get("success"):
+            raise EvaluationFailedError(f"Error del LLM al evaluar: {llm_response.get('error')}")
+        resultado = llm_response["content"]
+        if "raw_response" in resultado:
+            raise EvaluationFailedError("El LLM devolvió una evaluación que no es JSON")
+        if evaluacion_previa is not None:
+            resultado = self.merge_evaluations(evaluacion_previa, resultado, peso_nuevo)
         
         # Crear la evaluación
         evaluacion = EvaluacionLLM(
             lead_id=lead_id,
             conversacion_id=conversacion_id,
             mensaje_id=mensaje_id,
-            score_potencial=llm_response["content"]["score_potencial"],
-            score_satisfaccion=llm_response["content"]["score_satisfaccion"],
-            interes_productos=llm_response["content"]["interes_productos"],
-            palabras_clave=llm_response["content"]["palabras_clave"],
+            score_potencial=resultado["score_potencial"],
+            score_satisfaccion=resultado["score_satisfaccion"],
+            interes_productos=resultado["interes_productos"],
+            palabras_clave=resultado["palabras_clave"],
+            comentario=resultado.get("analisis"),
             llm_configuracion_id=llm_config_id,
             prompt_utilizado=prompt_template
         )
@@ -205,15 +312,266 @@ class MCPHandler:
         db.commit()
         return evaluacion
 
+    def merge_evaluations(
+        self,
+        previa: EvaluacionLLM,
+        nueva: Dict[str, Any],
+        peso_nuevo: float
+    ) -> Dict[str, Any]:
+        """Fusiona una evaluación incremental con la evaluación acumulada del lead"""
+        def blend(anterior: Optional[float], actual: Optional[float]) -> float:
+            if anterior is None:
+                return actual or 0.0
+            if actual is None:
+                return anterior
+            return anterior * (1 - peso_nuevo) + actual * peso_nuevo
+
+        intereses = dict(previa.interes_productos or {})
+        for producto, nivel in (nueva.get("interes_productos") or {}).items():
+            intereses[producto] = blend(intereses.get(producto), nivel)
+
+        palabras_clave = []
+        for palabra in list(nueva.get("palabras_clave") or []) + list(previa.palabras_clave or []):
+            if palabra not in palabras_clave:
+                palabras_clave.append(palabra)
+
+        return {
+            "score_potencial": blend(previa.score_potencial, nueva.get("score_potencial")),
+            "score_satisfaccion": blend(previa.score_satisfaccion, nueva.get("score_satisfaccion")),
+            "interes_productos": intereses,
+            "palabras_clave": palabras_clave[:20],
+            "analisis": nueva.get("analisis") or previa.comentario
+        }
+
+    def lead_data_watermark(self, db: Session, token_anonimo: str) -> Tuple[Optional[datetime], Optional[datetime]]:
+        """Fecha del último mensaje sanitizado y del último contexto del lead"""
+        ultimo_mensaje = db.query(func.max(MensajeSanitizado.created_at)).filter(
+            MensajeSanitizado.token_anonimo == token_anonimo
+        ).scalar()
+        ultimo_contexto = db.query(func.max(ContextoConversacional.created_at)).filter(
+            ContextoConversacional.token_anonimo == token_anonimo
+        ).scalar()
+        return ultimo_mensaje, ultimo_contexto
+
+    def current_evaluation(
+        self,
+        db: Session,
+        lead_id: int,
+        data_watermark: Tuple[Optional[datetime], Optional[datetime]]
+    ) -> Optional[EvaluacionLLM]:
+        """Devuelve la última evaluación del lead si no hay datos posteriores a ella"""
+        marca = db.query(LeadWatermark).filter(LeadWatermark.lead_id == lead_id).first()
+        if not marca or not marca.evaluacion_id:
+            return None
+        ultimo_mensaje, ultimo_contexto = data_watermark
+        if ultimo_mensaje and (not marca.ultimo_mensaje_at or ultimo_mensaje > marca.ultimo_mensaje_at):
+            return None
+        if ultimo_contexto and (not marca.ultimo_contexto_at or ultimo_contexto > marca.ultimo_contexto_at):
+            return None
+        return db.query(EvaluacionLLM).filter(EvaluacionLLM.id == marca.evaluacion_id).first()
+
+    def lead_chatbot(self, db: Session, lead_id: int) -> Optional[int]:
+        """Chatbot de la conversación más reciente del lead (None si no tiene)"""
+        from ..models.chat import Conversacion
+        return db.query(Conversacion.chatbot_id).filter(
+            Conversacion.lead_id == lead_id
+        ).order_by(Conversacion.ultimo_mensaje.desc().nullslast(), Conversacion.id.desc()).limit(1).scalar()
+
+    async def analyze_lead(
+        self,
+        db: Session,
+        lead_id: int,
+        token_anonimo: str,
+        force_full: bool = False,
+        chatbot_id: Optional[int] = None
+    ) -> Tuple[EvaluacionLLM, Dict[str, Any]]:
+        """
+        Evalúa un lead enviando al LLM solo los mensajes posteriores a su marca de agua,
+        junto con los scores y el resumen de la evaluación anterior. Con `force_full`, o si
+        el lead no tiene evaluación previa, se envía todo el historial. Si la evaluación del
+        LLM falla (`EvaluationFailedError`) la marca de agua no se mueve.
+
+        Con `lead_scorer`, el modelo local puntúa antes el lead y solo los inciertos o de
+        alto valor llegan al LLM; el resto se guarda como evaluación local. Si la evaluación
+        previa fue local, la siguiente del LLM es completa.
+
+        La llamada al LLM se atribuye a `chatbot_id` o, si no se indica, al chatbot de la
+        conversación más reciente del lead.
+        """
+        marca = db.query(LeadWatermark).filter(LeadWatermark.lead_id == lead_id).first()
+        evaluacion_previa = None
+        if marca and marca.evaluacion_id and not force_full:
+            evaluacion_previa = db.query(EvaluacionLLM).filter(
+                EvaluacionLLM.id == marca.evaluacion_id
+            ).first()
+
+        decision = None
+        if self.lead_scorer is not None:
+            if force_full:
+                self.lead_scorer.record_decision(True, "forzada")
+            else:
+                decision = self.lead_scorer.score(db, [lead_id])[0]
+                self.lead_scorer.record_decision(decision["escalar"], decision["motivo"])
+                if not decision["escalar"]:
+                    return self.store_local_evaluation(db, lead_id, token_anonimo, marca, evaluacion_previa, decision)
+        if evaluacion_previa is not None and evaluacion_previa.prompt_utilizado == LOCAL_PROMPT:
+            evaluacion_previa = None
+        incremental = evaluacion_previa is not None
+
+        mensajes_query = db.query(MensajeSanitizado).filter(
+            MensajeSanitizado.token_anonimo == token_anonimo
+        )
+        contexto_query = db.query(ContextoConversacional).filter(
+            ContextoConversacional.token_anonimo == token_anonimo
+        )
+        if incremental:
+            if marca.ultimo_mensaje_at:
+                mensajes_query = mensajes_query.filter(MensajeSanitizado.created_at > marca.ultimo_mensaje_at)
+            if marca.ultimo_contexto_at:
+                contexto_query = contexto_query.filter(ContextoConversacional.created_at > marca.ultimo_contexto_at)
+            contexto_query = contexto_query.order_by(ContextoConversacional.created_at)
+        else:
+            contexto_query = contexto_query.order_by(ContextoConversacional.relevancia_log.desc())
+        mensajes = mensajes_query.order_by(MensajeSanitizado.created_at).all()
+        contexto = contexto_query.all()
+
+        # Preparar datos para análisis
+        data_for_analysis = {
+            "mensajes_sanitizados": [
+                {
+                    "contenido": msg.contenido_sanitizado,
+                    "metadata": msg.metadata_sanitizada,
+                    "timestamp": msg.created_at.isoformat()
+                }
+                for msg in mensajes
+            ],
+            "contexto_relevante": [
+                {
+                    "tipo": ctx.tipo_contexto,
+                    "contenido": ctx.contenido_sanitizado,
+                    "relevancia": relevance.current(ctx.relevancia_log)
+                }
+                for ctx in contexto
+            ]
+        }
+
+        mensajes_previos = (marca.mensajes_evaluados or 0) if incremental else 0
+        if incremental:
+            data_for_analysis["evaluacion_previa"] = {
+                "score_potencial": evaluacion_previa.score_potencial,
+                "score_satisfaccion": evaluacion_previa.score_satisfaccion,
+                "interes_productos": evaluacion_previa.interes_productos,
+                "palabras_clave": evaluacion_previa.palabras_clave,
+                "resumen": evaluacion_previa.comentario,
+                "mensajes_evaluados": mensajes_previos
+            }
+
+        # Procesar con el LLM (la preparación de historiales largos sale del event loop)
+        llm_context = await self.prepare_data_for_llm_async(data_for_analysis)
+        llm_context["metadata"]["evaluation_mode"] = "incremental" if incremental else "full"
+        llm_context["metadata"]["mensajes_enviados"] = len(mensajes)
+
+        # La evaluación nueva pesa en proporción a los mensajes que aporta, con un mínimo
+        nuevos = len(mensajes) + len(contexto)
+        peso_nuevo = 1.0
+        if incremental:
+            peso_nuevo = max(
+                settings.INCREMENTAL_EVAL_MIN_WEIGHT,
+                nuevos / max(1, nuevos + mensajes_previos)
+            )
+
+        evaluacion = await self.evaluate_conversation(
+            db=db,
+            lead_id=lead_id,
+            conversacion_id=0,  # Se puede actualizar si es necesario
+            mensaje_id=0,  # Se puede actualizar si es necesario
+            llm_config_id=1,  # Usar configuración por defecto
+            contenido_sanitizado=str(llm_context),
+            prompt_template="Análisis incremental de lead" if incremental else "Análisis completo de lead",
+            evaluacion_previa=evaluacion_previa,
+            peso_nuevo=peso_nuevo,
+            chatbot_id=chatbot_id if chatbot_id is not None else self.lead_chatbot(db, lead_id)
+        )
+
+        # Actualizar la marca de agua del lead
+        if not marca:
+            marca = LeadWatermark(lead_id=lead_id, mensajes_evaluados=0)
+            db.add(marca)
+        if not incremental:
+            marca.mensajes_evaluados = 0
+            marca.ultimo_mensaje_at = None
+            marca.ultimo_contexto_at = None
+        marca.evaluacion_id = evaluacion.id
+        marca.mensajes_evaluados = (marca.mensajes_evaluados or 0) + nuevos
+        if mensajes:
+            marca.ultimo_mensaje_at = max(msg.created_at for msg in mensajes)
+        if contexto:
+            marca.ultimo_contexto_at = max(ctx.created_at for ctx in contexto)
+        db.commit()
+
+        if decision is not None:
+            self.lead_scorer.record_agreement(decision["score_potencial"], evaluacion.score_potencial)
+            llm_context["metadata"]["scoring"] = decision
+        return evaluacion, llm_context["metadata"]
+
+    def store_local_evaluation(
+        self,
+        db: Session,
+        lead_id: int,
+        token_anonimo: str,
+        marca: Optional[LeadWatermark],
+        evaluacion_previa: Optional[EvaluacionLLM],
+        decision: Dict[str, Any]
+    ) -> Tuple[EvaluacionLLM, Dict[str, Any]]:
+        """
+        Guarda el score del modelo local como evaluación del lead (sin llamar al LLM).
+        Conserva los intereses y palabras clave de la evaluación previa y avanza la marca
+        de agua para que los mismos datos no se vuelvan a puntuar.
+        """
+        evaluacion = EvaluacionLLM(
+            lead_id=lead_id,
+            conversacion_id=0,
+            mensaje_id=0,
+            score_potencial=decision["score_potencial"],
+            score_satisfaccion=decision["score_satisfaccion"],
+            interes_productos=evaluacion_previa.interes_productos if evaluacion_previa else {},
+            palabras_clave=evaluacion_previa.palabras_clave if evaluacion_previa else [],
+            comentario="Score del modelo local (sin análisis del LLM)",
+            llm_configuracion_id=None,
+            prompt_utilizado=LOCAL_PROMPT
+        )
+        db.add(evaluacion)
+        db.flush()
+
+        ultimo_mensaje, ultimo_contexto = self.lead_data_watermark(db, token_anonimo)
+        if not marca:
+            marca = LeadWatermark(lead_id=lead_id, mensajes_evaluados=0)
+            db.add(marca)
+        marca.evaluacion_id = evaluacion.id
+        marca.ultimo_mensaje_at = ultimo_mensaje or marca.ultimo_mensaje_at
+        marca.ultimo_contexto_at = ultimo_contexto or marca.ultimo_contexto_at
+        db.commit()
+
+        return evaluacion, {
+            "timestamp": datetime.now().isoformat(),
+            "data_version": "1.0",
+            "context_type": "crm_profile_analysis",
+            "evaluation_mode": "local",
+            "scoring": decision
+        }
+
     def update_conversation_context(
         self,
         db: Session,
         token_anonimo: str,
         tipo_contexto: str,
         contenido: str,
-        relevancia: float
+        relevancia: Optional[float] = None
     ) -> ContextoConversacional:
-        """Actualiza el contexto de la conversación"""
+        """
+        Actualiza el contexto de la conversación. Sin `relevancia`, el peso base lo calcula
+        el modelo de relevancia a partir del tipo de turno y del contenido.
+        """
         contexto = ContextoConversacional(
             token_anonimo=token_anonimo,
             tipo_contexto=tipo_contexto,
@@ -221,6 +579,10 @@ class MCPHandler:
             relevancia_score=relevancia
         )
         db.add(contexto)
+        if tipo_contexto == "mensaje_usuario":
+            relevance.reinforce_last_reply(
+                db, token_anonimo, timedelta(minutes=settings.RELEVANCE_ENGAGEMENT_WINDOW_MINUTES)
+            )
         db.commit()
         return contexto
 
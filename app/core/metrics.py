@@ -0,0 +1,80 @@
+from typing import Callable, Dict, Tuple
+import threading
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+def _labels(labels: Dict[str, object]) -> LabelSet:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+class MetricsRegistry:
+    """
+    Registro mínimo de métricas del worker (contadores y gauges) en memoria.
+    Se expone en formato de texto de Prometheus en /api/v1/metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelSet, float]] = {}
+        self._gauges: Dict[str, Dict[LabelSet, float]] = {}
+        self._gauge_callbacks: Dict[str, Callable[[], float]] = {}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, help_text: str) -> None:
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def register_gauge(self, name: str, callback: Callable[[], float], help_text: str = "") -> None:
+        """Gauge calculado en el momento de leerlo"""
+        self._gauge_callbacks[name] = callback
+        if help_text:
+            self.describe(name, help_text)
+
+    def value(self, name: str, **labels) -> float:
+        if name in self._gauge_callbacks:
+            return float(self._gauge_callbacks[name]())
+        key = _labels(labels)
+        for store in (self._counters, self._gauges):
+            if name in store and key in store[name]:
+                return store[name][key]
+        return 0.0
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        result: Dict[str, Dict[str, float]] = {}
+        with self._lock:
+            for store in (self._counters, self._gauges):
+                for name, series in store.items():
+                    for key, value in series.items():
+                        label = ",".join(f"{k}={v}" for k, v in key)
+                        result.setdefault(name, {})[label] = value
+        for name, callback in self._gauge_callbacks.items():
+            result.setdefault(name, {})[""] = float(callback())
+        return result
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            stores = [
+                ("counter", {n: dict(s) for n, s in self._counters.items()}),
+                ("gauge", {n: dict(s) for n, s in self._gauges.items()}),
+            ]
+        stores.append(("gauge", {n: {(): float(cb())} for n, cb in self._gauge_callbacks.items()}))
+        for metric_type, store in stores:
+            for name in sorted(store):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for key, value in store[name].items():
+                    label = ",".join(f'{k}="{v}"' for k, v in key)
+                    lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
@@ -0,0 +1,345 @@
+from typing import Dict, Any, Callable, Iterable, List, Optional, Set
+import asyncio
+import json
+import logging
+from sqlalchemy import event, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session, sessionmaker
+from .metrics import metrics
+from ..models.chat import conversaciones_table, mensajes_table
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_CHANNEL = "mcp_mensajes"
+
+# PostgreSQL limita la carga de NOTIFY a 8000 bytes
+MAX_PAYLOAD_BYTES = 7900
+
+def asyncpg_dsn(database_url: str) -> str:
+    """URL de SQLAlchemy sin el driver (`postgresql+psycopg2://` -> `postgresql://`)"""
+    scheme, sep, rest = database_url.partition("://")
+    return scheme.split("+", 1)[0] + sep + rest
+
+def message_event(
+    mensaje_id: int,
+    conversacion_id: int,
+    lead_id: Optional[int],
+    chatbot_id: Optional[int],
+    origen: Optional[str],
+    tipo_contenido: Optional[str],
+    contenido: Optional[str],
+    created_at: Any
+) -> Dict[str, Any]:
+    return {
+        "mensaje_id": mensaje_id,
+        "conversacion_id": conversacion_id,
+        "lead_id": lead_id,
+        "chatbot_id": chatbot_id,
+        "origen": origen,
+        "tipo_contenido": tipo_contenido,
+        "contenido": contenido,
+        "created_at": created_at.isoformat() if hasattr(created_at, "isoformat") else created_at
+    }
+
+def encode_event(evento: Dict[str, Any]) -> str:
+    """Carga de NOTIFY; si no cabe se recorta el contenido y se marca `contenido_truncado`"""
+    payload = json.dumps(evento, ensure_ascii=False, separators=(",", ":"))
+    contenido = evento.get("contenido") or ""
+    while len(payload.encode("utf-8")) > MAX_PAYLOAD_BYTES and contenido:
+        contenido = contenido[:len(contenido) // 2]
+        payload = json.dumps(
+            dict(evento, contenido=contenido, contenido_truncado=True),
+            ensure_ascii=False, separators=(",", ":")
+        )
+    return payload
+
+class Subscription:
+    """Suscriptor del canal de mensajes, filtrado por lead y/o chatbot"""
+
+    def __init__(self, lead_id: Optional[int], chatbot_id: Optional[int], max_queue: int):
+        self.lead_id = lead_id
+        self.chatbot_id = chatbot_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        # Se perdieron eventos (cola llena o reconexión del listener): el cliente debe resincronizar
+        self.lost = False
+
+    def matches(self, evento: Dict[str, Any]) -> bool:
+        return (
+            (self.lead_id is None or evento.get("lead_id") == self.lead_id)
+            and (self.chatbot_id is None or evento.get("chatbot_id") == self.chatbot_id)
+        )
+
+    def offer(self, evento: Dict[str, Any]) -> bool:
+        try:
+            self.queue.put_nowait(evento)
+            return True
+        except asyncio.QueueFull:
+            self.lost = True
+            return False
+
+class PgListener:
+    """
+    Conexión asyncpg del worker con LISTEN sobre los canales registrados. Una sola
+    conexión sirve a todos los consumidores (avisos de mensajes, invalidación del estado
+    de conversaciones) y se reconecta sola; tras una desconexión se avisa con `on_gap`,
+    porque lo notificado mientras tanto se perdió. También publica con NOTIFY sin usar
+    el pool de SQLAlchemy.
+    """
+
+    def __init__(self, dsn: str, reconnect_delay: float = 5.0):
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self.connected = False
+        self._handlers: Dict[str, Callable[[str], None]] = {}
+        self._gap_handlers: List[Callable[[], None]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connection = None
+        metrics.register_gauge(
+            "mcp_pg_listener_connected",
+            lambda: int(self.connected),
+            "1 si la conexión LISTEN del worker está activa"
+        )
+
+    def listen(self, channel: str, handler: Callable[[str], None], on_gap: Optional[Callable[[], None]] = None) -> None:
+        """Registra un canal; debe llamarse desde el event loop"""
+        if channel in self._handlers:
+            return
+        self._handlers[channel] = handler
+        if on_gap is not None:
+            self._gap_handlers.append(on_gap)
+        if self._connection is not None and not self._connection.is_closed():
+            self._loop.create_task(self._connection.add_listener(channel, self._on_notify))
+        self.start()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._task = self._loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self._loop = None
+
+    def notify(self, channel: str, payload: str) -> None:
+        """NOTIFY por la conexión del listener (seguro desde cualquier hilo; se descarta si no hay conexión)"""
+        loop, connection = self._loop, self._connection
+        if loop is None or loop.is_closed() or connection is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._notify(connection, channel, payload), loop)
+
+    async def _notify(self, connection, channel: str, payload: str) -> None:
+        try:
+            await connection.execute("SELECT pg_notify($1, $2)", channel, payload)
+        except Exception as e:
+            logger.warning("No se pudo publicar en %s: %s", channel, e)
+
+    def _on_notify(self, connection, pid: int, channel: str, payload: str) -> None:
+        handler = self._handlers.get(channel)
+        if handler is None:
+            return
+        try:
+            handler(payload)
+        except Exception:
+            logger.exception("Error al procesar una notificación de %s", channel)
+
+    async def _run(self) -> None:
+        import asyncpg
+
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                for channel in list(self._handlers):
+                    await connection.add_listener(channel, self._on_notify)
+                self._connection = connection
+                self.connected = True
+                await closed.wait()
+                logger.warning("Conexión LISTEN cerrada; reconectando")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Error en la conexión LISTEN: %s", e)
+            finally:
+                self.connected = False
+                self._connection = None
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            for on_gap in self._gap_handlers:
+                on_gap()
+            await asyncio.sleep(self.reconnect_delay)
+
+class MessageNotifier:
+    """
+    Avisa en tiempo real de los mensajes nuevos de cada conversación, para que los
+    agentes no tengan que consultar la tabla `mensajes` periódicamente.
+
+    Escritura: las sesiones de `session_factory` emiten un `pg_notify` por cada fila de
+    `mensajes` que insertan, dentro de la misma transacción (se entrega al hacer commit
+    y se descarta con un rollback). Lectura: el canal se escucha con la conexión única
+    del worker (`PgListener`) y los eventos se reparten entre sus suscriptores (SSE),
+    filtrados por lead o chatbot. Fuera de PostgreSQL (desarrollo con SQLite) los
+    eventos se reparten solo dentro del propio worker al hacer commit.
+
+    Si un suscriptor no consume a tiempo o la conexión de LISTEN se pierde, se le marca
+    `lost` para que se reconecte con Last-Event-ID y recupere los mensajes desde la base
+    de datos.
+    """
+
+    def __init__(
+        self,
+        listener: Optional[PgListener],
+        channel: str = MESSAGE_CHANNEL,
+        max_queue: int = 100
+    ):
+        # Sin listener (base de datos que no es PostgreSQL) los avisos no salen del worker
+        self.listener = listener
+        self.channel = channel
+        self.max_queue = max_queue
+        self._subscriptions: Set[Subscription] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        metrics.register_gauge(
+            "mcp_notify_subscribers",
+            lambda: len(self._subscriptions),
+            "Suscriptores del canal de mensajes nuevos"
+        )
+
+    # Escritura
+
+    def attach(self, session_factory: sessionmaker) -> None:
+        """Notifica las filas de `mensajes` insertadas por las sesiones de `session_factory`"""
+        if event.contains(session_factory, "after_flush", self._after_flush):
+            return
+        event.listen(session_factory, "after_flush", self._after_flush)
+        event.listen(session_factory, "after_commit", self._after_commit)
+        event.listen(session_factory, "after_rollback", self._after_rollback)
+
+    def _after_flush(self, session: Session, flush_context) -> None:
+        # Mensaje es un modelo del CRM: se identifica por su tabla
+        nuevos = [obj for obj in session.new if getattr(obj, "__tablename__", None) == "mensajes"]
+        if not nuevos:
+            return
+        connection = session.connection()
+        conversaciones = self._conversations(session, connection, {obj.conversacion_id for obj in nuevos})
+        eventos = []
+        for obj in nuevos:
+            lead_id, chatbot_id = conversaciones.get(obj.conversacion_id, (None, None))
+            eventos.append(message_event(
+                obj.id, obj.conversacion_id, lead_id, chatbot_id,
+                obj.origen, obj.tipo_contenido, obj.contenido, obj.created_at
+            ))
+        if connection.dialect.name == "postgresql":
+            for evento in eventos:
+                connection.execute(
+                    text("SELECT pg_notify(:channel, :payload)"),
+                    {"channel": self.channel, "payload": encode_event(evento)}
+                )
+            metrics.inc("mcp_notify_events_total", len(eventos), result="publicado")
+        else:
+            session.info.setdefault("notify_pending", []).extend(eventos)
+
+    def _conversations(self, session: Session, connection: Connection, ids: Set[int]) -> Dict[int, tuple]:
+        """
+        (lead_id, chatbot_id) de cada conversación: primero las que la sesión ya conoce
+        (`session.info["conversaciones"]` o cargadas en ella) y después de la base de datos
+        """
+        conocidas = session.info.get("conversaciones", {})
+        resultado = {conversacion_id: conocidas[conversacion_id] for conversacion_id in ids if conversacion_id in conocidas}
+        for obj in session.identity_map.values():
+            if getattr(obj, "__tablename__", None) == "conversaciones" and obj.id in ids:
+                resultado[obj.id] = (obj.lead_id, obj.chatbot_id)
+        faltan = ids - set(resultado)
+        if faltan:
+            c = conversaciones_table.c
+            for row in connection.execute(select(c.id, c.lead_id, c.chatbot_id).where(c.id.in_(faltan))):
+                resultado[row.id] = (row.lead_id, row.chatbot_id)
+        return resultado
+
+    def _after_commit(self, session: Session) -> None:
+        eventos = session.info.pop("notify_pending", None)
+        if eventos:
+            self.publish_local(eventos)
+
+    def _after_rollback(self, session: Session) -> None:
+        session.info.pop("notify_pending", None)
+
+    def publish_local(self, eventos: Iterable[Dict[str, Any]]) -> None:
+        """Reparte eventos entre los suscriptores de este worker (seguro desde cualquier hilo)"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._dispatch_all, list(eventos))
+
+    # Lectura
+
+    def start(self) -> None:
+        """Empieza a escuchar el canal; debe llamarse desde el event loop"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        if self.listener is not None:
+            self.listener.listen(self.channel, self._on_payload, on_gap=self._mark_lost)
+
+    async def stop(self) -> None:
+        self._mark_lost()
+        self._subscriptions.clear()
+        self._loop = None
+
+    def subscribe(self, lead_id: Optional[int] = None, chatbot_id: Optional[int] = None) -> Subscription:
+        self.start()
+        subscription = Subscription(lead_id, chatbot_id, self.max_queue)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions.discard(subscription)
+
+    def _mark_lost(self) -> None:
+        for subscription in self._subscriptions:
+            subscription.lost = True
+
+    def _dispatch_all(self, eventos: List[Dict[str, Any]]) -> None:
+        for evento in eventos:
+            self._dispatch(evento)
+
+    def _dispatch(self, evento: Dict[str, Any]) -> None:
+        for subscription in list(self._subscriptions):
+            if subscription.matches(evento):
+                delivered = subscription.offer(evento)
+                metrics.inc("mcp_notify_events_total", result="entregado" if delivered else "descartado")
+
+    def _on_payload(self, payload: str) -> None:
+        try:
+            self._dispatch(json.loads(payload))
+        except ValueError:
+            logger.warning("Notificación no válida en %s: %r", self.channel, payload[:200])
+
+def missed_messages(
+    db: Session,
+    after_id: int,
+    lead_id: Optional[int] = None,
+    chatbot_id: Optional[int] = None,
+    limit: int = 200
+) -> List[Dict[str, Any]]:
+    """Mensajes posteriores a `after_id` (reconexión con Last-Event-ID), en el formato de los eventos"""
+    m = mensajes_table.c
+    c = conversaciones_table.c
+    query = (
+        select(
+            m.id, m.conversacion_id, c.lead_id, c.chatbot_id,
+            m.origen, m.tipo_contenido, m.contenido, m.created_at
+        )
+        .join_from(mensajes_table, conversaciones_table, m.conversacion_id == c.id)
+        .where(m.id > after_id)
+        .order_by(m.id)
+        .limit(limit)
+    )
+    if lead_id is not None:
+        query = query.where(c.lead_id == lead_id)
+    if chatbot_id is not None:
+        query = query.where(c.chatbot_id == chatbot_id)
+    return [message_event(*row) for row in db.execute(query)]
@@ -0,0 +1,100 @@
+from typing import Dict, Any, Iterable, List, Optional
+import hashlib
+import json
+import re
+import textwrap
+
+# Disposición de los prompts para la caché de prefijos del proveedor: todo lo estático
+# (instrucciones, persona del chatbot, formato de salida) va primero y es idéntico byte
+# a byte entre llamadas; lo dinámico (historial, mensaje, contexto del lead) va al final.
+
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+def normalize_block(text: Optional[str]) -> str:
+    """Texto sin sangría común, sin espacios al final de línea y con como mucho una línea en blanco seguida"""
+    if not text:
+        return ""
+    text = textwrap.dedent(text.replace("\r\n", "\n"))
+    text = "\n".join(line.rstrip() for line in text.split("\n"))
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+def _section(title: str, content: Optional[str]) -> Optional[str]:
+    content = normalize_block(content)
+    return f"{title}: {content}" if content else None
+
+def _ordered_contexts(chatbot_context: Iterable[Any]) -> List[Any]:
+    # `orden` puede repetirse o faltar: el id desempata para que el orden no dependa de la consulta
+    return sorted(
+        chatbot_context,
+        key=lambda ctx: (ctx.orden is None, ctx.orden or 0, ctx.id or 0)
+    )
+
+def build_chatbot_system_prompt(chatbot: Any, chatbot_context: Iterable[Any]) -> str:
+    """Prompt de sistema del chatbot: depende solo de su configuración, nunca de la conversación"""
+    sections = [
+        f"Eres un asistente virtual para {normalize_block(chatbot.nombre)}.",
+        _section("PERSONALIDAD", chatbot.personalidad or "Amigable y profesional"),
+        _section("TONO", chatbot.tono or "Formal pero cercano"),
+        _section("INSTRUCCIONES", chatbot.instrucciones or "Responde de manera útil y concisa"),
+        _section("CONTEXTO", chatbot.contexto or "Eres un asistente virtual de atención al cliente"),
+        "IMPORTANTE: Nunca reveles que eres una IA. Responde como si fueras un agente humano representando a la empresa."
+    ]
+    for ctx in _ordered_contexts(chatbot_context):
+        sections.append(normalize_block(ctx.general_context) or None)
+        sections.append(_section("INSTRUCCIONES ESPECIALES", ctx.special_instructions))
+    return "\n\n".join(section for section in sections if section)
+
+EVALUATION_SYSTEM_PROMPT = normalize_block("""
+    Eres un analista experto en evaluación de leads.
+    Tu tarea es analizar la conversación proporcionada y evaluar:
+    1. El potencial del lead (0.0 a 1.0)
+    2. El nivel de satisfacción actual (0.0 a 1.0)
+    3. Interés en productos específicos
+    4. Palabras clave relevantes
+
+    IMPORTANTE: No uses ni reveles información personal en tu análisis.
+    Céntrate en patrones de comportamiento e intereses.
+""")
+
+EVALUATION_INCREMENTAL_PROMPT = normalize_block("""
+    El contexto incluye "evaluacion_previa" con los scores y el resumen de la evaluación
+    anterior, y solo los mensajes posteriores a ella. Actualiza la evaluación teniendo en
+    cuenta la previa y los mensajes nuevos, y devuelve un análisis que resuma toda la conversación.
+""")
+
+EVALUATION_OUTPUT_PROMPT = normalize_block("""
+    Analiza el siguiente contexto conversacional y proporciona:
+    {
+        "score_potencial": float,
+        "score_satisfaccion": float,
+        "interes_productos": {
+            "producto_name": float  // nivel de interés de 0 a 1
+        },
+        "palabras_clave": ["keyword1", "keyword2"],
+        "analisis": "Breve análisis sin datos personales"
+    }
+""")
+
+def serialize_context(context: Any) -> str:
+    """Serialización estable del contexto dinámico (claves ordenadas)"""
+    return json.dumps(context, ensure_ascii=False, sort_keys=True, default=str)
+
+def build_prompt_messages(
+    prompt_template: str,
+    context: Any,
+    system_context: Optional[str] = None
+) -> List[Dict[str, str]]:
+    """Mensajes de un prompt de análisis: sistema y plantilla fijos, contexto al final"""
+    messages = []
+    if system_context:
+        messages.append({"role": "system", "content": normalize_block(system_context)})
+    messages.append({
+        "role": "user",
+        "content": f"{normalize_block(prompt_template)}\n\nContexto:\n{serialize_context(context)}"
+    })
+    return messages
+
+def prefix_fingerprint(messages: List[Dict[str, str]]) -> str:
+    """Huella del prefijo estático (el primer mensaje) para comprobar que no cambia entre llamadas"""
+    head = messages[0]["content"] if messages else ""
+    return hashlib.sha256(head.encode("utf-8")).hexdigest()[:12]
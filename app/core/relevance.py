@@ -0,0 +1,126 @@
+from typing import Dict, Optional, Sequence
+import math
+from datetime import datetime, timedelta
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session
+from .config import settings
+from ..models.chat import ContextoConversacional
+
+# Origen fijo del tiempo para los scores en dominio logarítmico
+RELEVANCE_EPOCH = datetime(2024, 1, 1)
+
+TURN_TYPE_WEIGHTS: Dict[str, float] = {
+    "mensaje_usuario": 1.0,
+    "respuesta_chatbot": 0.6
+}
+
+class RelevanceModel:
+    """
+    Relevancia de un turno de contexto = peso base × decaimiento exponencial por antigüedad.
+
+    El peso base (`relevancia_score`, en [0, 1]) combina el tipo de turno y señales de
+    interacción del propio contenido (preguntas, longitud). En lugar de guardar la
+    relevancia actual, que cambiaría con el tiempo, se guarda en `relevancia_log`
+
+        log(peso) + tasa · (created_at − RELEVANCE_EPOCH)
+
+    que no depende del instante de la consulta: ordenar por `relevancia_log` equivale a
+    ordenar por relevancia actual, así que el top-k usa el índice
+    (token_anonimo, relevancia_log) y nunca hace falta recalcular la tabla. La relevancia
+    actual se obtiene con `current`. Reforzar un turno es sumar log(factor) a su fila; el
+    refuerzo por interacción (el usuario responde a él) tiene tope y se aplica una vez.
+    """
+
+    def __init__(
+        self,
+        half_life_hours: float = 72.0,
+        type_weights: Optional[Dict[str, float]] = None,
+        engagement_boost: float = 1.5
+    ):
+        self.rate = math.log(2) / (half_life_hours * 3600)
+        self.type_weights = type_weights or TURN_TYPE_WEIGHTS
+        self.engagement_boost = engagement_boost
+
+    def base_weight(self, tipo_contexto: Optional[str], contenido: Optional[str]) -> float:
+        weight = self.type_weights.get(tipo_contexto or "", 0.5)
+        contenido = contenido or ""
+        # Los turnos con más contenido y las preguntas suelen ser más informativos
+        weight *= 0.6 + 0.4 * min(1.0, len(contenido.split()) / 30)
+        if "?" in contenido:
+            weight *= 1.25
+        return round(min(1.0, max(weight, 1e-3)), 4)
+
+    def log_score(self, base: float, created_at: datetime) -> float:
+        return math.log(max(base, 1e-6)) + self.rate * (created_at - RELEVANCE_EPOCH).total_seconds()
+
+    def current(self, log_score: Optional[float], now: Optional[datetime] = None) -> Optional[float]:
+        """Relevancia en el instante `now` (por defecto, ahora) a partir del score guardado"""
+        if log_score is None:
+            return None
+        now = now or datetime.utcnow()
+        return round(math.exp(log_score - self.rate * (now - RELEVANCE_EPOCH).total_seconds()), 6)
+
+    def apply(self, contexto: ContextoConversacional) -> None:
+        """Completa `relevancia_score` y `relevancia_log` de un turno nuevo"""
+        if contexto.created_at is None:
+            contexto.created_at = datetime.utcnow()
+        if contexto.relevancia_score is None:
+            contexto.relevancia_score = self.base_weight(contexto.tipo_contexto, contexto.contenido_sanitizado)
+        if contexto.relevancia_log is None:
+            contexto.relevancia_log = self.log_score(contexto.relevancia_score, contexto.created_at)
+
+    def row_values(self, tipo_contexto: str, contenido: str, created_at: datetime) -> Dict[str, float]:
+        """Valores de relevancia para inserciones masivas (sin ORM)"""
+        base = self.base_weight(tipo_contexto, contenido)
+        return {"relevancia_score": base, "relevancia_log": self.log_score(base, created_at)}
+
+    def boost(self, db: Session, contexto_ids: Sequence[int], factor: Optional[float] = None) -> None:
+        """Refuerza turnos concretos; solo actualiza esas filas"""
+        if not contexto_ids:
+            return
+        factor = factor or self.engagement_boost
+        db.execute(
+            update(ContextoConversacional)
+            .where(ContextoConversacional.id.in_(list(contexto_ids)))
+            .values(relevancia_log=ContextoConversacional.relevancia_log + math.log(factor))
+        )
+
+    def reinforce_last_reply(self, db: Session, token_anonimo: str, window: timedelta) -> None:
+        """
+        Señal de interacción: si el usuario escribe poco después de una respuesta del
+        chatbot, esa respuesta se refuerza.
+
+        El refuerzo se aplica una sola vez por respuesta: `relevancia_log` se fija en el
+        score del peso base más log(engagement_boost), y solo si aún no lo alcanza, de modo
+        que varios mensajes seguidos (o dos workers a la vez) no lo acumulan.
+        """
+        ultima = db.query(
+            ContextoConversacional.id,
+            ContextoConversacional.created_at,
+            ContextoConversacional.relevancia_score
+        ).filter(
+            ContextoConversacional.token_anonimo == token_anonimo,
+            ContextoConversacional.tipo_contexto == "respuesta_chatbot"
+        ).order_by(ContextoConversacional.created_at.desc()).first()
+        if not ultima or not ultima.created_at or datetime.utcnow() - ultima.created_at > window:
+            return
+        base = ultima.relevancia_score if ultima.relevancia_score is not None else 1e-3
+        tope = self.log_score(base, ultima.created_at) + math.log(self.engagement_boost)
+        db.execute(
+            update(ContextoConversacional)
+            .where(
+                ContextoConversacional.id == ultima.id,
+                ContextoConversacional.relevancia_log < tope - 1e-9
+            )
+            .values(relevancia_log=tope)
+        )
+
+relevance = RelevanceModel(
+    half_life_hours=settings.RELEVANCE_HALF_LIFE_HOURS,
+    engagement_boost=settings.RELEVANCE_ENGAGEMENT_BOOST
+)
+
+@event.listens_for(ContextoConversacional, "before_insert")
+def _score_new_context(mapper, connection, target: ContextoConversacional) -> None:
+    # Todas las inserciones por ORM reciben su score sin que cada llamador lo calcule
+    relevance.apply(target)
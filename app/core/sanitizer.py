@@ -0,0 +1,100 @@
+from typing import Dict, Any, Callable, FrozenSet, Iterable, List, Tuple
+import hashlib
+import json
+import re
+
+# Funciones puras (sin estado ni clientes) para poder ejecutarlas en un pool de procesos
+
+SENSITIVE_FIELDS: FrozenSet[str] = frozenset({
+    'email', 'first_name', 'last_name', 'phone', 'viewer_ip',
+    'viewer_profile_id', 'profile_id', 'user_id', 'nombre',
+    'apellido', 'telefono', 'direccion', 'ciudad', 'pais'
+})
+
+_OCTET = r"(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)"
+
+PII_PATTERNS = {
+    "email": re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"),
+    # Cuatro octetos válidos que no forman parte de una secuencia con más puntos
+    "ip": re.compile(rf"(?<![\w.]){_OCTET}(?:\.{_OCTET}){{3}}(?!\.?\w)"),
+    # Prefijo internacional y código de área opcionales y grupos de 2-4 dígitos con un
+    # mismo separador (espacio, punto o guion) o sin separador
+    "telefono": re.compile(
+        r"(?<![\w.,+])(?:\+\d{1,3}[\s.-]?)?(?:\(\d{1,4}\)[\s.-]?)?"
+        r"\d{2,4}(?:([\s.-]?)\d{2,4}(?:\1\d{2,4}){0,3})?(?![\w.,-]?\d)"
+    ),
+}
+
+_ISO_DATE = re.compile(r"\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[-.]\d{1,2}[-.]\d{4}")
+_AMOUNT = re.compile(r"\d{1,3}(?:([.,])\d{3})(?:\1\d{3})*")
+
+def _is_phone(candidate: str) -> bool:
+    """Entre 7 y 15 dígitos (E.164) y no es una fecha ni un importe con separador de miles"""
+    digits = sum(ch.isdigit() for ch in candidate)
+    if not 7 <= digits <= 15:
+        return False
+    return not (_ISO_DATE.fullmatch(candidate) or _AMOUNT.fullmatch(candidate))
+
+# Comprobaciones adicionales de los candidatos de cada patrón
+PII_VALIDATORS: Dict[str, Callable[[str], bool]] = {
+    "telefono": _is_phone,
+}
+
+def hash_value(value: Any) -> str:
+    return hashlib.sha256(str(value).encode()).hexdigest()[:16]
+
+def anonymize_data(data: Dict[str, Any], sensitive_fields: Iterable[str] = SENSITIVE_FIELDS) -> Dict[str, Any]:
+    """Anonimiza datos sensibles reemplazándolos con hashes"""
+    anonymized = {}
+    for key, value in data.items():
+        if key in sensitive_fields and value:
+            anonymized[key] = hash_value(value)
+        elif isinstance(value, dict):
+            anonymized[key] = anonymize_data(value, sensitive_fields)
+        elif isinstance(value, list):
+            anonymized[key] = [
+                anonymize_data(item, sensitive_fields) if isinstance(item, dict) else item
+                for item in value
+            ]
+        else:
+            anonymized[key] = value
+    return anonymized
+
+def scan_pii(text: str) -> Tuple[str, Dict[str, int]]:
+    """Sustituye por hashes los datos personales detectados en texto libre"""
+    findings: Dict[str, int] = {}
+    for kind, pattern in PII_PATTERNS.items():
+        validator = PII_VALIDATORS.get(kind)
+        def replace(match, kind=kind, validator=validator):
+            if validator is not None and not validator(match.group(0)):
+                return match.group(0)
+            findings[kind] = findings.get(kind, 0) + 1
+            return f"[{kind}:{hash_value(match.group(0))}]"
+        text = pattern.sub(replace, text)
+    return text, findings
+
+def sanitize_records(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Sanitiza un lote de mensajes: anonimiza contenido y metadata y enmascara los datos
+    personales del texto. Devuelve por cada mensaje `contenido_sanitizado`,
+    `metadata_sanitizada` y `pii` (conteo de hallazgos). Una metadata que no es JSON válido
+    se sustituye por un objeto vacío (la carga descarta ese registro) sin abortar el lote.
+    """
+    sanitized = []
+    for record in records:
+        contenido = anonymize_data({"content": record.get("contenido") or ""})["content"]
+        contenido, findings = scan_pii(contenido)
+        metadata = record.get("metadata") or {}
+        if isinstance(metadata, str):
+            try:
+                metadata = json.loads(metadata) if metadata else {}
+            except ValueError:
+                metadata = {}
+        if not isinstance(metadata, dict):
+            metadata = {}
+        sanitized.append({
+            "contenido_sanitizado": contenido,
+            "metadata_sanitizada": anonymize_data(metadata),
+            "pii": findings
+        })
+    return sanitized
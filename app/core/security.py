@@ -0,0 +1,106 @@
+from typing import Dict, Any, Optional, Tuple
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import jwt
+from jwt.algorithms import get_default_algorithms
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from .config import settings
+
+# Valor por defecto de SECRET_KEY: con él cualquiera podría firmar tokens válidos
+PLACEHOLDER_SECRET_KEY = "your-secret-key-here"
+
+def check_auth_settings() -> None:
+    """Impide arrancar con autenticación obligatoria y la clave JWT de ejemplo"""
+    if settings.AUTH_REQUIRED and settings.SECRET_KEY in ("", PLACEHOLDER_SECRET_KEY):
+        raise RuntimeError(
+            "AUTH_REQUIRED está activo pero SECRET_KEY no está configurada: "
+            "defina una clave propia en SECRET_KEY"
+        )
+
+def verify_client_secret(client_secret: Optional[str]) -> bool:
+    """Comprueba la credencial de cliente que autoriza la emisión de tokens (en tiempo constante)"""
+    if not settings.TOKEN_CLIENT_SECRET or not client_secret:
+        return False
+    return hmac.compare_digest(client_secret.encode("utf-8"), settings.TOKEN_CLIENT_SECRET.encode("utf-8"))
+
+class TokenVerifier:
+    """
+    Verifica los JWT emitidos por /tokens/generate.
+
+    La clave se prepara una sola vez al crear el verificador, y los claims ya
+    verificados se guardan en un LRU acotado hasta su expiración, de modo que un
+    token repetido (caso normal en un chat) no se vuelve a decodificar.
+    """
+
+    def __init__(self, secret_key: str, algorithm: str, cache_size: int = 10000):
+        self.algorithm = algorithm
+        self.algorithms = [algorithm]
+        self._algorithm = get_default_algorithms()[algorithm]
+        self._key = self._algorithm.prepare_key(secret_key)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def create_token(self, data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
+        to_encode = data.copy()
+        expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
+        to_encode.update({"exp": expire})
+        return jwt.encode(to_encode, self._key, algorithm=self.algorithm)
+
+    def verify(self, token: str) -> Dict[str, Any]:
+        """Devuelve los claims del token o lanza jwt.InvalidTokenError"""
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(token)
+            if cached is not None:
+                claims, expires_at = cached
+                if expires_at > now:
+                    self._cache.move_to_end(token)
+                    self.stats["hits"] += 1
+                    return claims
+                del self._cache[token]
+
+        claims = jwt.decode(
+            token,
+            self._key,
+            algorithms=self.algorithms,
+            options={"require": ["exp"]}
+        )
+        self.stats["misses"] += 1
+        with self._lock:
+            self._cache[token] = (claims, float(claims["exp"]))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return claims
+
+_bearer = HTTPBearer(auto_error=False)
+
+async def require_token(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(_bearer)
+) -> Optional[Dict[str, Any]]:
+    """
+    Dependencia de FastAPI que exige un JWT válido en la cabecera Authorization.
+    Es asíncrona para que FastAPI no la despache al threadpool en cada petición.
+    """
+    if not settings.AUTH_REQUIRED:
+        return None
+    if credentials is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Token de acceso requerido",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    from .services import services
+    try:
+        return services.token_verifier.verify(credentials.credentials)
+    except jwt.InvalidTokenError as e:
+        raise HTTPException(
+            status_code=401,
+            detail=f"Token inválido: {str(e)}",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
@@ -0,0 +1,431 @@
+from typing import Dict, Any, Iterable, List, Optional, Protocol, Sequence, Tuple
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import Session, sessionmaker
+from .metrics import metrics
+from ..models.chat import ContextoConversacional
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+# Margen al buscar turnos nuevos de un token: cubre filas confirmadas tarde con un created_at anterior
+SYNC_OVERLAP = timedelta(seconds=60)
+# Instantáneas antiguas que se conservan (otros workers pueden tenerlas mapeadas)
+SNAPSHOT_GRACE_SECONDS = 3600
+
+class Embedder(Protocol):
+    dim: int
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Matriz (len(texts), dim) float32 con filas normalizadas (norma L2 = 1)"""
+        ...
+
+class HashingEmbedder:
+    """
+    Embedding local sin modelo: palabras y bigramas de palabras proyectados con feature
+    hashing (blake2b, estable entre procesos) en `dim` dimensiones con signo.
+    Captura solapamiento léxico; para similitud semántica real usar un modelo.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = _WORD.findall(text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for feature in self._features(text or ""):
+                h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+                vectors[i, h % self.dim] += 1.0 if h >> 63 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+class SentenceTransformerEmbedder:
+    """Embedding con un modelo local de sentence-transformers (dependencia opcional)"""
+
+    def __init__(self, model_name: str):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise RuntimeError("EMBEDDING_BACKEND=sentence-transformers requiere el paquete sentence-transformers")
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return np.asarray(
+            self.model.encode(list(texts), normalize_embeddings=True, show_progress_bar=False),
+            dtype=np.float32
+        )
+
+def build_embedder(backend: str, dim: int = 256) -> Embedder:
+    """`hashing` o `sentence-transformers:<modelo>`"""
+    if backend == "hashing":
+        return HashingEmbedder(dim)
+    if backend.startswith("sentence-transformers:"):
+        return SentenceTransformerEmbedder(backend.split(":", 1)[1])
+    raise ValueError(f"Backend de embeddings no soportado: {backend}")
+
+class MemoryIndex:
+    """
+    Índice de vectores particionado por token anónimo.
+
+    La búsqueda solo recorre la partición del token (decenas o cientos de turnos), por lo
+    que un producto escalar exacto sobre ella es más rápido que mantener un grafo ANN
+    global. Lo persistido (`save`) se guarda ordenado por token y se carga con
+    `mmap_mode="r"`: cada partición es un slice del fichero, sin copiarlo a memoria.
+    Los vectores nuevos se acumulan en memoria hasta el siguiente `save`.
+
+    Cada `save` escribe una instantánea completa en su propio subdirectorio y después
+    apunta `CURRENT` a ella de forma atómica: varios workers pueden guardar a la vez sin
+    mezclar ficheros. Lo que falte en la instantánea elegida se recupera de la base de
+    datos (`SemanticMemory.select_context` repasa los turnos nuevos de cada token).
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._lock = threading.RLock()
+        self._base_vectors = np.zeros((0, dim), dtype=np.float32)
+        self._base_ids = np.zeros(0, dtype=np.int64)
+        self._offsets: Dict[str, Tuple[int, int]] = {}
+        self._delta: Dict[str, Tuple[List[int], List[np.ndarray]]] = {}
+        self._known: Dict[str, set] = {}
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return len(self._base_ids) + sum(len(ids) for ids, _ in self._delta.values())
+
+    def has(self, token: str) -> bool:
+        with self._lock:
+            return token in self._offsets or token in self._delta
+
+    def _known_ids(self, token: str) -> set:
+        known = self._known.get(token)
+        if known is None:
+            start, end = self._offsets.get(token, (0, 0))
+            known = self._known[token] = set(self._base_ids[start:end].tolist())
+        return known
+
+    def add(self, token: str, ids: Sequence[int], vectors: np.ndarray) -> int:
+        """Añade vectores a la partición del token; ignora ids ya indexados"""
+        with self._lock:
+            known = self._known_ids(token)
+            delta_ids, delta_vectors = self._delta.setdefault(token, ([], []))
+            added = 0
+            for contexto_id, vector in zip(ids, vectors):
+                if contexto_id in known:
+                    continue
+                known.add(contexto_id)
+                delta_ids.append(int(contexto_id))
+                delta_vectors.append(np.asarray(vector, dtype=np.float32))
+                added += 1
+            return added
+
+    def missing(self, token: str, ids: Iterable[int]) -> List[int]:
+        """Los `ids` que aún no están en la partición del token"""
+        with self._lock:
+            known = self._known_ids(token)
+            return [contexto_id for contexto_id in ids if contexto_id not in known]
+
+    def partition(self, token: str) -> Tuple[np.ndarray, np.ndarray]:
+        with self._lock:
+            start, end = self._offsets.get(token, (0, 0))
+            ids = self._base_ids[start:end]
+            vectors = self._base_vectors[start:end]
+            delta_ids, delta_vectors = self._delta.get(token, ([], []))
+            if delta_ids:
+                ids = np.concatenate([ids, np.asarray(delta_ids, dtype=np.int64)])
+                vectors = np.vstack([vectors, np.stack(delta_vectors)])
+            return ids, vectors
+
+    def search(
+        self,
+        token: str,
+        query: np.ndarray,
+        k: int,
+        exclude: Iterable[int] = ()
+    ) -> List[Tuple[int, float]]:
+        """Los `k` turnos del token más similares (coseno) a `query`"""
+        ids, vectors = self.partition(token)
+        if not len(ids) or k <= 0:
+            return []
+        scores = vectors @ query
+        excluded = np.isin(ids, np.fromiter(exclude, dtype=np.int64))
+        scores = np.where(excluded, -np.inf, scores)
+        k = min(k, int((~excluded).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    def save(self, path: str) -> None:
+        """Guarda el índice en una instantánea nueva de `path` con las particiones contiguas por token"""
+        snapshot = f"snapshot-{int(time.time() * 1000)}-{os.getpid()}"
+        directory = os.path.join(path, snapshot)
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            tokens = sorted(set(self._offsets) | set(self._delta))
+            ids_parts, vector_parts, offsets = [], [], {}
+            position = 0
+            for token in tokens:
+                ids, vectors = self.partition(token)
+                offsets[token] = (position, position + len(ids))
+                position += len(ids)
+                ids_parts.append(ids)
+                vector_parts.append(np.asarray(vectors, dtype=np.float32))
+            all_ids = np.concatenate(ids_parts) if ids_parts else np.zeros(0, dtype=np.int64)
+            all_vectors = np.vstack(vector_parts) if vector_parts else np.zeros((0, self.dim), dtype=np.float32)
+            np.save(os.path.join(directory, "ids.npy"), all_ids)
+            np.save(os.path.join(directory, "vectors.npy"), all_vectors)
+            with open(os.path.join(directory, "offsets.json"), "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim, "offsets": offsets}, f)
+            tmp = os.path.join(path, f"CURRENT.{os.getpid()}.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(snapshot)
+            os.replace(tmp, os.path.join(path, "CURRENT"))
+            # Lo guardado pasa a ser la base (en memoria; el próximo arranque usará mmap)
+            self._base_ids, self._base_vectors = all_ids, all_vectors
+            self._offsets = offsets
+            self._delta = {}
+        self._prune(path, snapshot)
+
+    @staticmethod
+    def _prune(path: str, current: str) -> None:
+        """Borra las instantáneas antiguas que ya no son la vigente"""
+        limit = time.time() - SNAPSHOT_GRACE_SECONDS
+        for name in os.listdir(path):
+            directory = os.path.join(path, name)
+            if name.startswith("snapshot-") and name != current and os.path.getmtime(directory) < limit:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str, dim: int) -> "MemoryIndex":
+        """Carga la instantánea vigente guardada con `save` mapeando los vectores en memoria"""
+        index = cls(dim)
+        current = os.path.join(path, "CURRENT")
+        if not os.path.exists(current):
+            return index
+        with open(current, encoding="utf-8") as f:
+            directory = os.path.join(path, f.read().strip())
+        meta_path = os.path.join(directory, "offsets.json")
+        if not os.path.exists(meta_path):
+            return index
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("dim") != dim:
+            logger.warning("Índice de memoria en %s con dimensión %s distinta de %s; se ignora", path, meta.get("dim"), dim)
+            return index
+        index._base_ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        index._base_vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        index._offsets = {token: tuple(span) for token, span in meta["offsets"].items()}
+        return index
+
+class SemanticMemory:
+    """
+    Memoria semántica de la conversación de cada token anónimo.
+
+    Los turnos nuevos de `ContextoConversacional` se encolan al confirmarse la
+    transacción (listener de sesión) y un hilo en segundo plano los embebe por lotes,
+    fuera del camino de la petición. En cada turno, `select_context` devuelve los
+    turnos más recientes más los `k` más relevantes para el mensaje actual.
+
+    Los turnos escritos por otros workers o por la ingesta masiva no pasan por el listener
+    de este worker: cada `sync_interval` segundos por token se encolan los turnos con
+    `created_at` posterior al último repaso que aún no están indexados.
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        index: MemoryIndex,
+        batch_size: int = 64,
+        flush_interval: float = 0.5,
+        backfill_limit: int = 200,
+        sync_interval: float = 30.0
+    ):
+        self.embedder = embedder
+        self.index = index
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backfill_limit = backfill_limit
+        self.sync_interval = sync_interval
+        # token -> (mayor created_at repasado, instante del repaso)
+        self._synced: Dict[str, Tuple[Optional[datetime], float]] = {}
+        self._synced_lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[Tuple[str, int, str]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        metrics.register_gauge(
+            "mcp_memory_queue_depth",
+            lambda: self._queue.qsize(),
+            "Turnos pendientes de embeber"
+        )
+        metrics.register_gauge(
+            "mcp_memory_indexed_turns",
+            lambda: self.index.size,
+            "Turnos en el índice de memoria semántica"
+        )
+
+    def enqueue(self, token_anonimo: str, contexto_id: int, contenido: str) -> None:
+        self._queue.put((token_anonimo, contexto_id, contenido))
+
+    def attach(self, session_factory: sessionmaker) -> None:
+        """Encola los turnos de contexto de las sesiones de `session_factory` al hacer commit"""
+        if event.contains(session_factory, "after_flush", self._after_flush):
+            return
+        event.listen(session_factory, "after_flush", self._after_flush)
+        event.listen(session_factory, "after_commit", self._after_commit)
+        event.listen(session_factory, "after_rollback", self._after_rollback)
+
+    def _after_flush(self, session: Session, flush_context) -> None:
+        # Tras el flush los ids ya están asignados; se copian antes de que el commit expire los objetos
+        pendientes = [
+            (obj.token_anonimo, obj.id, obj.contenido_sanitizado)
+            for obj in session.new
+            if isinstance(obj, ContextoConversacional) and obj.contenido_sanitizado
+        ]
+        if pendientes:
+            session.info.setdefault("memory_pending", []).extend(pendientes)
+
+    def _after_commit(self, session: Session) -> None:
+        for token_anonimo, contexto_id, contenido in session.info.pop("memory_pending", []):
+            self.enqueue(token_anonimo, contexto_id, contenido)
+
+    def _after_rollback(self, session: Session) -> None:
+        session.info.pop("memory_pending", None)
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="mcp-memory", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self.index_batch(batch)
+            except Exception:
+                logger.exception("Error al embeber %d turnos de contexto", len(batch))
+            if stop:
+                return
+
+    def index_batch(self, batch: Sequence[Tuple[str, int, str]]) -> int:
+        """Embebe un lote de (token, contexto_id, contenido) y lo añade al índice"""
+        vectors = self.embedder.embed([contenido for _, _, contenido in batch])
+        por_token: Dict[str, Tuple[List[int], List[np.ndarray]]] = {}
+        for (token, contexto_id, _), vector in zip(batch, vectors):
+            ids, vecs = por_token.setdefault(token, ([], []))
+            ids.append(contexto_id)
+            vecs.append(vector)
+        added = sum(self.index.add(token, ids, np.stack(vecs)) for token, (ids, vecs) in por_token.items())
+        metrics.inc("mcp_memory_embedded_total", value=len(batch))
+        return added
+
+    def catch_up(self, db: Session, token_anonimo: str) -> int:
+        """
+        Encola los turnos del token posteriores a su último repaso (hasta `backfill_limit`)
+        que no están en el índice; como mucho un repaso cada `sync_interval` segundos
+        """
+        now = time.monotonic()
+        with self._synced_lock:
+            desde, repasado = self._synced.get(token_anonimo, (None, None))
+            if repasado is not None and now - repasado < self.sync_interval:
+                return 0
+            self._synced[token_anonimo] = (desde, now)
+
+        query = db.query(
+            ContextoConversacional.id,
+            ContextoConversacional.contenido_sanitizado,
+            ContextoConversacional.created_at
+        ).filter(ContextoConversacional.token_anonimo == token_anonimo)
+        if desde is not None:
+            query = query.filter(ContextoConversacional.created_at >= desde - SYNC_OVERLAP)
+        turnos = query.order_by(ContextoConversacional.created_at.desc()).limit(self.backfill_limit).all()
+
+        pendientes = set(self.index.missing(token_anonimo, [turno.id for turno in turnos]))
+        for turno in turnos:
+            if turno.id in pendientes and turno.contenido_sanitizado:
+                self.enqueue(token_anonimo, turno.id, turno.contenido_sanitizado)
+        ultimo = max((turno.created_at for turno in turnos if turno.created_at), default=desde)
+        with self._synced_lock:
+            self._synced[token_anonimo] = (ultimo, now)
+        if pendientes:
+            metrics.inc("mcp_memory_backfill_total", len(pendientes))
+        return len(pendientes)
+
+    def select_context(
+        self,
+        db: Session,
+        token_anonimo: str,
+        query: str,
+        k: int = 6,
+        recent: int = 4,
+        recent_turns: Optional[List[Any]] = None
+    ) -> List[ContextoConversacional]:
+        """
+        Turnos para el prompt: los `recent` más recientes y los `k` más relevantes para
+        `query`, en orden cronológico. Los turnos del token que faltan en el índice se encolan
+        (`catch_up`); si aún no tiene ninguno indexado se responde solo por recencia. Con `recent_turns`
+        (historial en memoria, en orden cronológico) los recientes no se consultan.
+        """
+        indexado = self.index.has(token_anonimo)
+        limite = recent if indexado else recent + k
+        if recent_turns is not None:
+            recientes = list(reversed(recent_turns[-limite:])) if limite else []
+        else:
+            recientes = db.query(ContextoConversacional).filter(
+                ContextoConversacional.token_anonimo == token_anonimo
+            ).order_by(ContextoConversacional.created_at.desc()).limit(limite).all()
+
+        self.catch_up(db, token_anonimo)
+        if not indexado:
+            metrics.inc("mcp_memory_retrievals_total", result="backfill")
+            return list(reversed(recientes))
+
+        relevantes_ids = [
+            contexto_id for contexto_id, _ in self.index.search(
+                token_anonimo,
+                self.embedder.embed([query])[0],
+                k,
+                exclude=[c.id for c in recientes]
+            )
+        ]
+        relevantes = db.query(ContextoConversacional).filter(
+            ContextoConversacional.id.in_(relevantes_ids)
+        ).all() if relevantes_ids else []
+        metrics.inc("mcp_memory_retrievals_total", result="semantic")
+        return sorted(recientes + relevantes, key=lambda c: (c.created_at, c.id))
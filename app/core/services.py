@@ -0,0 +1,563 @@
+from typing import Dict, Any, Callable, Optional
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import threading
+import time
+import openai
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from .config import settings
+from .admission import AdmissionController
+from .cohorts import CohortRollups
+from .concurrency import ConversationLocks
+from .conversation_state import ConversationStateStore, PgNotifyInvalidator, StateInvalidator
+from .database import ReplicaRouter, create_db_engine, create_session_factory, normalize_database_url
+from .evaluation_scheduler import EvaluationScheduler
+from .executors import CPUExecutor
+from .faq import FAQ_CHANNEL, FAQMatcher
+from .feature_store import LeadFeatureStore
+from .lead_scoring import LeadScorer, LeadScoringModel
+from .llm_handler import LLMHandler
+from .loop_monitor import EventLoopMonitor
+from .mcp_handler import ANALYZE_LEAD_FLIGHT, MCPHandler
+from .notifications import MessageNotifier, PgListener, asyncpg_dsn
+from .security import TokenVerifier, check_auth_settings
+from .semantic_memory import MemoryIndex, SemanticMemory, build_embedder
+from .singleflight import SingleFlight
+from .traffic import TrafficRecorder
+from .usage_ledger import UsageLedger
+
+logger = logging.getLogger(__name__)
+
+class ServiceContainer:
+    """
+    Contenedor de los servicios compartidos por todo el worker.
+
+    Cada servicio se crea una sola vez y de forma perezosa (en el primer acceso),
+    y se libera explícitamente en `shutdown`. El ciclo de vida lo controla el
+    lifespan de FastAPI definido en `app.main`.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._engine: Optional[Engine] = None
+        self._replica_engine: Optional[Engine] = None
+        self._replica_router: Optional[ReplicaRouter] = None
+        self._session_factory: Optional[sessionmaker] = None
+        self._openai_client: Optional[openai.OpenAI] = None
+        self._openai_async_client: Optional[openai.AsyncOpenAI] = None
+        self._llm_handler: Optional[LLMHandler] = None
+        self._mcp_handler: Optional[MCPHandler] = None
+        self._conversation_locks: Optional[ConversationLocks] = None
+        self._single_flights: Dict[str, SingleFlight] = {}
+        self._admission: Optional[AdmissionController] = None
+        self._token_verifier: Optional[TokenVerifier] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._cpu_executor: Optional[CPUExecutor] = None
+        self._loop_monitor: Optional[EventLoopMonitor] = None
+        self._feature_store: Optional[LeadFeatureStore] = None
+        self._cohort_rollups: Optional[CohortRollups] = None
+        self._lead_scorer: Optional[LeadScorer] = None
+        self._semantic_memory: Optional[SemanticMemory] = None
+        self._usage_ledger: Optional[UsageLedger] = None
+        self._traffic_recorder: Optional[TrafficRecorder] = None
+        self._evaluation_scheduler: Optional[EvaluationScheduler] = None
+        self._pg_listener: Optional[PgListener] = None
+        self._message_notifier: Optional[MessageNotifier] = None
+        self._conversation_state: Optional[ConversationStateStore] = None
+        self._faq: Optional[FAQMatcher] = None
+        # Tiempos de inicialización de cada servicio y del arranque del worker (ms)
+        self.init_timings: Dict[str, float] = {}
+        self.boot_timings: Dict[str, float] = {}
+
+    def _get_or_create(self, attr: str, name: str, factory: Callable[[], Any]) -> Any:
+        value = getattr(self, attr)
+        if value is not None:
+            return value
+        with self._lock:
+            value = getattr(self, attr)
+            if value is None:
+                start = time.perf_counter()
+                value = factory()
+                self.init_timings[name] = round((time.perf_counter() - start) * 1000, 3)
+                setattr(self, attr, value)
+        return value
+
+    @property
+    def engine(self) -> Engine:
+        return self._get_or_create(
+            "_engine", "engine",
+            lambda: create_db_engine(
+                pool_size=settings.DB_POOL_SIZE,
+                max_overflow=settings.DB_MAX_OVERFLOW,
+                pool_timeout=settings.DB_POOL_TIMEOUT_SECONDS
+            )
+        )
+
+    @property
+    def replica_engine(self) -> Optional[Engine]:
+        if not settings.DATABASE_REPLICA_URL:
+            return None
+        return self._get_or_create(
+            "_replica_engine", "replica_engine",
+            lambda: create_db_engine(
+                settings.DATABASE_REPLICA_URL,
+                pool_size=settings.DB_REPLICA_POOL_SIZE,
+                max_overflow=settings.DB_REPLICA_MAX_OVERFLOW,
+                pool_timeout=settings.DB_REPLICA_POOL_TIMEOUT_SECONDS,
+                **self._replica_engine_kwargs()
+            )
+        )
+
+    def _replica_engine_kwargs(self) -> Dict[str, Any]:
+        # connect_timeout es propio de libpq: SQLite no lo acepta
+        url = normalize_database_url(settings.DATABASE_REPLICA_URL)
+        if not url.startswith("postgres"):
+            return {}
+        return {"connect_args": {"connect_timeout": settings.DB_REPLICA_CONNECT_TIMEOUT_SECONDS}}
+
+    @property
+    def replica_router(self) -> ReplicaRouter:
+        return self._get_or_create(
+            "_replica_router", "replica_router",
+            lambda: ReplicaRouter(
+                primary_factory=lambda: self.session_factory,
+                replica_engine=self.replica_engine,
+                max_lag=settings.REPLICA_MAX_LAG_SECONDS,
+                check_interval=settings.REPLICA_LAG_CHECK_SECONDS
+            )
+        )
+
+    @property
+    def read_engine(self) -> Engine:
+        """Motor para lecturas masivas (exportaciones): réplica si está al día"""
+        return self.replica_router.read_engine(self.engine)
+
+    @property
+    def session_factory(self) -> sessionmaker:
+        return self._get_or_create(
+            "_session_factory", "session_factory",
+            self._create_session_factory
+        )
+
+    def _create_session_factory(self) -> sessionmaker:
+        factory = create_session_factory(self.engine)
+        # Los agregados por cohorte se actualizan al confirmar cada evaluación
+        self.cohort_rollups.attach(factory)
+        # Los turnos de contexto nuevos se encolan para embeberlos al confirmar la transacción
+        if self.semantic_memory is not None:
+            self.semantic_memory.attach(factory)
+        # Cada mensaje insertado emite su pg_notify en la misma transacción
+        if self.message_notifier is not None:
+            self.message_notifier.attach(factory)
+        return factory
+
+    @property
+    def openai_client(self) -> openai.OpenAI:
+        return self._get_or_create(
+            "_openai_client", "openai_client",
+            lambda: openai.OpenAI(api_key=settings.LLM_API_KEY, base_url=settings.LLM_BASE_URL or None)
+        )
+
+    @property
+    def openai_async_client(self) -> openai.AsyncOpenAI:
+        return self._get_or_create(
+            "_openai_async_client", "openai_async_client",
+            lambda: openai.AsyncOpenAI(api_key=settings.LLM_API_KEY, base_url=settings.LLM_BASE_URL or None)
+        )
+
+    @property
+    def llm_handler(self) -> LLMHandler:
+        return self._get_or_create(
+            "_llm_handler", "llm_handler",
+            lambda: LLMHandler(
+                client=self.openai_client,
+                async_client=self.openai_async_client,
+                memory=self.semantic_memory,
+                ledger=self.usage_ledger,
+                recorder=self.traffic_recorder,
+                state_store=self.conversation_state,
+                faq=self.faq,
+                admission=self.admission
+            )
+        )
+
+    @property
+    def mcp_handler(self) -> MCPHandler:
+        return self._get_or_create(
+            "_mcp_handler", "mcp_handler",
+            lambda: MCPHandler(
+                llm_handler=self.llm_handler,
+                executor=self.cpu_executor,
+                lead_scorer=self.lead_scorer
+            )
+        )
+
+    def _lock_dsn(self) -> Optional[str]:
+        # Los bloqueos consultivos solo existen en PostgreSQL
+        url = normalize_database_url(settings.DATABASE_URL)
+        return asyncpg_dsn(url) if url.startswith("postgres") else None
+
+    @property
+    def conversation_locks(self) -> ConversationLocks:
+        return self._get_or_create(
+            "_conversation_locks", "conversation_locks",
+            lambda: ConversationLocks(
+                dsn=self._lock_dsn(),
+                pool_size=settings.CONVERSATION_LOCK_POOL_SIZE,
+                timeout=settings.CONVERSATION_LOCK_TIMEOUT_SECONDS
+            )
+        )
+
+    @property
+    def admission(self) -> AdmissionController:
+        return self._get_or_create(
+            "_admission", "admission",
+            lambda: AdmissionController(
+                global_rps=settings.ADMISSION_GLOBAL_RPS,
+                global_burst=settings.ADMISSION_GLOBAL_BURST,
+                chatbot_rps=settings.ADMISSION_CHATBOT_RPS,
+                chatbot_burst=settings.ADMISSION_CHATBOT_BURST,
+                global_tpm=settings.ADMISSION_GLOBAL_TPM,
+                chatbot_tpm=settings.ADMISSION_CHATBOT_TPM,
+                tokens_estimate=settings.ADMISSION_TOKENS_ESTIMATE,
+                max_queue=settings.ADMISSION_MAX_QUEUE,
+                queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT_SECONDS
+            )
+        )
+
+    @property
+    def token_verifier(self) -> TokenVerifier:
+        return self._get_or_create(
+            "_token_verifier", "token_verifier",
+            lambda: TokenVerifier(
+                secret_key=settings.SECRET_KEY,
+                algorithm=settings.ALGORITHM,
+                cache_size=settings.AUTH_CACHE_SIZE
+            )
+        )
+
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        return self._get_or_create(
+            "_process_pool", "process_pool",
+            lambda: ProcessPoolExecutor(max_workers=settings.INGEST_WORKERS or None)
+        )
+
+    @property
+    def cpu_executor(self) -> CPUExecutor:
+        return self._get_or_create(
+            "_cpu_executor", "cpu_executor",
+            lambda: CPUExecutor(
+                kind=settings.CPU_EXECUTOR_KIND,
+                max_workers=settings.CPU_EXECUTOR_WORKERS,
+                threshold=settings.CPU_OFFLOAD_THRESHOLD,
+                process_pool_provider=lambda: self.process_pool
+            )
+        )
+
+    @property
+    def loop_monitor(self) -> EventLoopMonitor:
+        return self._get_or_create(
+            "_loop_monitor", "loop_monitor",
+            lambda: EventLoopMonitor(interval=settings.LOOP_MONITOR_INTERVAL_SECONDS)
+        )
+
+    @property
+    def feature_store(self) -> LeadFeatureStore:
+        return self._get_or_create(
+            "_feature_store", "feature_store",
+            self._create_feature_store
+        )
+
+    def _create_feature_store(self) -> LeadFeatureStore:
+        store = (
+            LeadFeatureStore.load(settings.FEATURE_STORE_PATH)
+            if settings.FEATURE_STORE_PATH else LeadFeatureStore()
+        )
+        # La tabla lead_profile_features es la fuente de verdad compartida por los workers
+        store.attach(lambda: self.session_factory, settings.FEATURE_STORE_SYNC_SECONDS)
+        return store
+
+    @property
+    def cohort_rollups(self) -> CohortRollups:
+        return self._get_or_create(
+            "_cohort_rollups", "cohort_rollups",
+            lambda: CohortRollups(
+                bins=settings.COHORT_HISTOGRAM_BINS,
+                max_score=settings.COHORT_MAX_SCORE
+            )
+        )
+
+    @property
+    def lead_scorer(self) -> Optional[LeadScorer]:
+        if not settings.LEAD_SCORING_ENABLED:
+            return None
+        return self._get_or_create(
+            "_lead_scorer", "lead_scorer",
+            lambda: LeadScorer(
+                profile_provider=lambda lead_ids: self.feature_store.profile_matrix(lead_ids),
+                model=LeadScoringModel.load(settings.LEAD_SCORING_MODEL_PATH),
+                model_path=settings.LEAD_SCORING_MODEL_PATH,
+                # Los scores del LLM están en [0, COHORT_MAX_SCORE]
+                max_score=settings.COHORT_MAX_SCORE,
+                margin=settings.LEAD_SCORING_MARGIN,
+                high_value=settings.LEAD_SCORING_HIGH_VALUE,
+                max_rmse=settings.LEAD_SCORING_MAX_RMSE,
+                tolerance=settings.LEAD_SCORING_AGREEMENT_TOLERANCE,
+                shadow_rate=settings.LEAD_SCORING_SHADOW_RATE,
+                min_samples=settings.LEAD_SCORING_MIN_SAMPLES,
+                train_limit=settings.LEAD_SCORING_TRAIN_LIMIT,
+                reload_interval=settings.LEAD_SCORING_RELOAD_SECONDS
+            )
+        )
+
+    @property
+    def semantic_memory(self) -> Optional[SemanticMemory]:
+        if not settings.SEMANTIC_MEMORY_ENABLED:
+            return None
+        return self._get_or_create("_semantic_memory", "semantic_memory", self._create_semantic_memory)
+
+    def _create_semantic_memory(self) -> SemanticMemory:
+        embedder = build_embedder(settings.EMBEDDING_BACKEND, settings.EMBEDDING_DIM)
+        index = (
+            MemoryIndex.load(settings.MEMORY_INDEX_PATH, embedder.dim)
+            if settings.MEMORY_INDEX_PATH else MemoryIndex(embedder.dim)
+        )
+        memory = SemanticMemory(
+            embedder,
+            index,
+            batch_size=settings.MEMORY_BATCH_SIZE,
+            flush_interval=settings.MEMORY_FLUSH_SECONDS,
+            backfill_limit=settings.MEMORY_BACKFILL_LIMIT,
+            sync_interval=settings.MEMORY_SYNC_SECONDS
+        )
+        memory.start()
+        return memory
+
+    @property
+    def usage_ledger(self) -> UsageLedger:
+        return self._get_or_create("_usage_ledger", "usage_ledger", self._create_usage_ledger)
+
+    def _create_usage_ledger(self) -> UsageLedger:
+        ledger = UsageLedger(
+            engine_provider=lambda: self.engine,
+            pricing=settings.LLM_PRICING,
+            flush_size=settings.LLM_USAGE_FLUSH_SIZE,
+            flush_interval=settings.LLM_USAGE_FLUSH_SECONDS,
+            max_buffer=settings.LLM_USAGE_MAX_BUFFER
+        )
+        ledger.start()
+        return ledger
+
+    @property
+    def traffic_recorder(self) -> Optional[TrafficRecorder]:
+        if not settings.TRAFFIC_RECORD_PATH:
+            return None
+        return self._get_or_create(
+            "_traffic_recorder", "traffic_recorder",
+            lambda: TrafficRecorder(settings.TRAFFIC_RECORD_PATH, sample_rate=settings.TRAFFIC_SAMPLE_RATE)
+        )
+
+    @property
+    def evaluation_scheduler(self) -> Optional[EvaluationScheduler]:
+        if not settings.AUTO_EVALUATION_ENABLED:
+            return None
+        return self._get_or_create(
+            "_evaluation_scheduler", "evaluation_scheduler",
+            lambda: EvaluationScheduler(
+                session_factory_provider=lambda: self.session_factory,
+                mcp_handler_provider=lambda: self.mcp_handler,
+                single_flight_provider=lambda: self.single_flight(ANALYZE_LEAD_FLIGHT),
+                debounce=settings.AUTO_EVALUATION_DEBOUNCE_SECONDS,
+                max_delay=settings.AUTO_EVALUATION_MAX_DELAY_SECONDS,
+                workers=settings.AUTO_EVALUATION_WORKERS,
+                max_queue=settings.AUTO_EVALUATION_MAX_QUEUE
+            )
+        )
+
+    @property
+    def pg_listener(self) -> Optional[PgListener]:
+        """Conexión LISTEN compartida del worker (None si la base de datos no es PostgreSQL)"""
+        url = normalize_database_url(settings.DATABASE_URL)
+        if not url.startswith("postgres"):
+            return None
+        return self._get_or_create(
+            "_pg_listener", "pg_listener",
+            lambda: PgListener(asyncpg_dsn(url), reconnect_delay=settings.PG_LISTEN_RECONNECT_SECONDS)
+        )
+
+    @property
+    def message_notifier(self) -> Optional[MessageNotifier]:
+        if not settings.MESSAGE_NOTIFY_ENABLED:
+            return None
+        return self._get_or_create(
+            "_message_notifier", "message_notifier",
+            lambda: MessageNotifier(listener=self.pg_listener, max_queue=settings.MESSAGE_NOTIFY_QUEUE)
+        )
+
+    @property
+    def conversation_state(self) -> Optional[ConversationStateStore]:
+        if not settings.CONVERSATION_STATE_ENABLED:
+            return None
+        return self._get_or_create("_conversation_state", "conversation_state", self._create_conversation_state)
+
+    def _create_conversation_state(self) -> ConversationStateStore:
+        invalidator = StateInvalidator()
+        if settings.CONVERSATION_STATE_INVALIDATION == "pg_notify":
+            if self.pg_listener is not None:
+                invalidator = PgNotifyInvalidator(self.pg_listener)
+            else:
+                logger.warning("CONVERSATION_STATE_INVALIDATION=pg_notify requiere PostgreSQL; invalidación local")
+        return ConversationStateStore(
+            max_conversations=settings.CONVERSATION_STATE_MAX_ENTRIES,
+            max_chars=settings.CONVERSATION_STATE_MAX_CHARS,
+            history_turns=settings.CONVERSATION_STATE_HISTORY,
+            ttl=settings.CONVERSATION_STATE_TTL_SECONDS,
+            chatbot_ttl=settings.CHATBOT_PROMPT_TTL_SECONDS,
+            invalidator=invalidator
+        )
+
+    @property
+    def faq(self) -> Optional[FAQMatcher]:
+        if not settings.FAQ_ENABLED:
+            return None
+        return self._get_or_create(
+            "_faq", "faq",
+            lambda: FAQMatcher(
+                fuzzy=settings.FAQ_FUZZY_ENABLED,
+                threshold=settings.FAQ_MIN_SIMILARITY,
+                min_chars=settings.FAQ_MIN_CHARS,
+                ttl=settings.FAQ_INDEX_TTL_SECONDS,
+                max_chatbots=settings.FAQ_MAX_CHATBOTS,
+                # Los pares nuevos invalidan el índice en todos los workers (si hay PostgreSQL)
+                invalidator=PgNotifyInvalidator(self.pg_listener, channel=FAQ_CHANNEL)
+                if self.pg_listener is not None else None
+            )
+        )
+
+    def single_flight(self, name: str, max_results: int = 0) -> SingleFlight:
+        """Grupo de single-flight con nombre, compartido por todas las peticiones del worker"""
+        flight = self._single_flights.get(name)
+        if flight is None:
+            with self._lock:
+                flight = self._single_flights.setdefault(name, SingleFlight(max_results=max_results))
+        return flight
+
+    def startup(self, warmup: bool = False) -> None:
+        """Arranque del worker. Con `warmup` se crean todos los servicios por adelantado."""
+        # La clave de verificación de JWT se prepara siempre al arrancar (es barato)
+        check_auth_settings()
+        self.token_verifier
+        if warmup:
+            self.session_factory
+            self.mcp_handler
+
+    async def shutdown(self) -> None:
+        """Cierra los clientes HTTP y el pool de conexiones y guarda los índices locales"""
+        # Las evaluaciones en segundo plano usan el LLM y la base de datos: se cancelan primero
+        if self._evaluation_scheduler is not None:
+            await self._evaluation_scheduler.stop()
+            self._evaluation_scheduler = None
+        if self._message_notifier is not None:
+            await self._message_notifier.stop()
+            self._message_notifier = None
+        if self._pg_listener is not None:
+            await self._pg_listener.stop()
+            self._pg_listener = None
+        if self._conversation_locks is not None:
+            await self._conversation_locks.close()
+        if self._replica_router is not None:
+            await self._replica_router.stop()
+        self._conversation_state = None
+        self._faq = None
+        # El último volcado del registro de uso necesita el motor: antes de liberarlo
+        if self._usage_ledger is not None:
+            self._usage_ledger.stop()
+        with self._lock:
+            client, self._openai_client = self._openai_client, None
+            async_client, self._openai_async_client = self._openai_async_client, None
+            engine, self._engine = self._engine, None
+            replica_engine, self._replica_engine = self._replica_engine, None
+            self._replica_router = None
+            self._session_factory = None
+            self._llm_handler = None
+            self._mcp_handler = None
+            self._conversation_locks = None
+            self._single_flights = {}
+            self._admission = None
+            self._token_verifier = None
+            process_pool, self._process_pool = self._process_pool, None
+            cpu_executor, self._cpu_executor = self._cpu_executor, None
+            loop_monitor, self._loop_monitor = self._loop_monitor, None
+            feature_store, self._feature_store = self._feature_store, None
+            self._cohort_rollups = None
+            self._lead_scorer = None
+            semantic_memory, self._semantic_memory = self._semantic_memory, None
+            self._usage_ledger = None
+            traffic_recorder, self._traffic_recorder = self._traffic_recorder, None
+            self.init_timings = {}
+        if feature_store is not None and settings.FEATURE_STORE_PATH:
+            feature_store.save(settings.FEATURE_STORE_PATH)
+        if semantic_memory is not None:
+            semantic_memory.stop()
+            if settings.MEMORY_INDEX_PATH:
+                semantic_memory.index.save(settings.MEMORY_INDEX_PATH)
+        if traffic_recorder is not None:
+            traffic_recorder.close()
+        if loop_monitor is not None:
+            await loop_monitor.stop()
+        if async_client is not None:
+            await async_client.close()
+        if client is not None:
+            client.close()
+        if cpu_executor is not None:
+            cpu_executor.shutdown()
+        if process_pool is not None:
+            process_pool.shutdown(wait=False, cancel_futures=True)
+        if engine is not None:
+            engine.dispose()
+        if replica_engine is not None:
+            replica_engine.dispose()
+
+    def record_boot(self, name: str, started_at: float) -> float:
+        elapsed = round((time.perf_counter() - started_at) * 1000, 3)
+        self.boot_timings[name] = elapsed
+        return elapsed
+
+    def boot_report(self) -> Dict[str, Any]:
+        return {
+            "boot_ms": dict(self.boot_timings),
+            "service_init_ms": dict(self.init_timings),
+            "warmup": settings.SERVICES_WARMUP
+        }
+
+services = ServiceContainer()
+
+# Dependencias de FastAPI
+def get_services() -> ServiceContainer:
+    return services
+
+def get_mcp_handler() -> MCPHandler:
+    return services.mcp_handler
+
+def get_llm_handler() -> LLMHandler:
+    return services.llm_handler
+
+def get_conversation_locks() -> ConversationLocks:
+    return services.conversation_locks
+
+def get_admission() -> AdmissionController:
+    return services.admission
+
+def get_traffic_recorder() -> Optional[TrafficRecorder]:
+    return services.traffic_recorder
+
+def get_evaluation_scheduler() -> Optional[EvaluationScheduler]:
+    return services.evaluation_scheduler
+
+def get_conversation_state() -> Optional[ConversationStateStore]:
+    return services.conversation_state
+
+def get_faq() -> Optional[FAQMatcher]:
+    return services.faq
@@ -0,0 +1,62 @@
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+import asyncio
+import functools
+from collections import OrderedDict
+
+class SingleFlight:
+    """
+    Agrupa las llamadas concurrentes con la misma clave en una sola ejecución.
+
+    La clave debe incluir la marca de agua de los datos (p. ej. la fecha del último
+    mensaje), de modo que un cambio en los datos produce una clave nueva. Si
+    `max_results` es mayor que cero también se guardan los últimos resultados
+    completados, y una clave repetida se sirve sin volver a calcular.
+
+    El cálculo corre en una tarea propia, desacoplada de quien lo inició: no debe usar
+    recursos que se liberen al terminar esa petición (p. ej. su sesión de base de datos).
+    """
+
+    def __init__(self, max_results: int = 0):
+        self.max_results = max_results
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._results: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.stats = {"executed": 0, "coalesced": 0, "cached": 0}
+
+    def cached(self, key: Hashable) -> Optional[Any]:
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+        return None
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if key in self._results:
+            self.stats["cached"] += 1
+            return self.cached(key)
+
+        task = self._inflight.get(key)
+        if task is not None:
+            # Ya hay una ejecución en curso: se espera su resultado
+            self.stats["coalesced"] += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            self.stats["executed"] += 1
+            task.add_done_callback(functools.partial(self._finish, key))
+        # Todos esperan la tarea protegida: si se cancela uno (p. ej. el cliente se
+        # desconecta), ni se cancela el cálculo ni reciben la cancelación los demás
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # exception() marca la excepción como recuperada aunque nadie espere ya la tarea
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.max_results > 0:
+            self._results[key] = task.result()
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
@@ -0,0 +1,191 @@
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+import gzip
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+from .metrics import metrics
+from .sanitizer import scan_pii
+
+TRACE_VERSION = 1
+
+# Operación del LLM que el servidor simulado debe reproducir (la envía LLMHandler)
+OPERATION_HEADER = "X-MCP-Operation"
+
+def open_trace(path: str, mode: str = "rt"):
+    """Abre una traza NDJSON, comprimida con gzip si termina en `.gz`"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding="utf-8")
+    return open(path, mode.replace("t", ""), encoding="utf-8")
+
+def read_trace(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Eventos de una traza (sin las cabeceras), en el orden en que se grabaron. Si la
+    traza tiene varias grabaciones seguidas (reinicios del worker), sus instantes se
+    encadenan.
+    """
+    base = last = 0.0
+    with open_trace(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event.get("kind") == "header":
+                if event.get("version") != TRACE_VERSION:
+                    raise ValueError(f"Versión de traza no soportada: {event.get('version')}")
+                base = last
+                continue
+            event["t"] = last = base + event["t"]
+            yield event
+
+def scrub(value: Any) -> Any:
+    """Enmascara con `scan_pii` los datos personales de todos los textos de un valor"""
+    if isinstance(value, str):
+        return scan_pii(value)[0]
+    if isinstance(value, dict):
+        return {key: scrub(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [scrub(item) for item in value]
+    return value
+
+class TrafficRecorder:
+    """
+    Graba en una traza NDJSON compacta el tráfico de `/messages/sanitize` y `/analytics/*`
+    y los tiempos de las llamadas al LLM, para reproducirlo después con `app.cli.replay`
+    contra un LLM simulado (`app.cli.fake_llm`).
+
+    Solo se graban datos anonimizados: `anonymize_message` solo oculta los campos
+    sensibles de la metadata y deja el texto libre tal cual, así que los textos de
+    `params` y `body` pasan además por `scan_pii` (emails, teléfonos, etc. se sustituyen
+    por su hash), y los lead_id se sustituyen por un ordinal estable dentro de la traza. Cada evento lleva `t`, los segundos desde el inicio de la
+    grabación. El muestreo (`sample_rate`) se decide por lead, así que las conversaciones
+    muestreadas se graban completas. Con varios workers, `{pid}` en la ruta da a cada
+    uno su propio fichero.
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0):
+        self.path = path.format(pid=os.getpid())
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._leads: Dict[int, int] = {}
+        self._started = time.perf_counter()
+        self._file = open_trace(self.path, "at")
+        self._write({
+            "kind": "header",
+            "version": TRACE_VERSION,
+            "started_at": datetime.utcnow().isoformat()
+        })
+
+    def _write(self, event: Dict[str, Any]) -> None:
+        line = json.dumps(event, ensure_ascii=False, separators=(",", ":"), default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def _sampled(self, lead_id: Optional[int]) -> bool:
+        if self.sample_rate >= 1.0:
+            return True
+        key = str(lead_id).encode()
+        return zlib.crc32(key) / 0xFFFFFFFF < self.sample_rate
+
+    def _lead(self, lead_id: int) -> int:
+        with self._lock:
+            return self._leads.setdefault(lead_id, len(self._leads) + 1)
+
+    def record_request(
+        self,
+        endpoint: str,
+        method: str,
+        path: str,
+        lead_id: Optional[int] = None,
+        params: Optional[Dict[str, Any]] = None,
+        body: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """
+        Graba una petición. `path` es relativo a API_V1_STR y puede contener `{lead_id}`;
+        `params` y `body` no deben incluir el lead_id (el reproductor lo añade a partir
+        del ordinal).
+        """
+        if not self._sampled(lead_id):
+            return
+        event = {
+            "t": round(time.perf_counter() - self._started, 4),
+            "kind": "request",
+            "endpoint": endpoint,
+            "method": method,
+            "path": path
+        }
+        if lead_id is not None:
+            event["lead"] = self._lead(lead_id)
+        if params:
+            event["params"] = scrub(params)
+        if body is not None:
+            event["body"] = scrub(body)
+        self._write(event)
+        metrics.inc("mcp_traffic_recorded_total", kind="request")
+
+    def record_llm(
+        self,
+        operacion: str,
+        latencia_ms: float,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        exito: bool = True
+    ) -> None:
+        """Graba el tiempo de una llamada al LLM (sin prompt ni respuesta)"""
+        self._write({
+            "t": round(time.perf_counter() - self._started, 4),
+            "kind": "llm",
+            "operacion": operacion,
+            "latencia_ms": round(latencia_ms, 3),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "exito": exito
+        })
+        metrics.inc("mcp_traffic_recorded_total", kind="llm")
+
+    def close(self) -> None:
+        with self._lock:
+            f, self._file = self._file, None
+        if f is not None:
+            f.close()
+
+class LatencyProfile:
+    """
+    Tiempos de las llamadas al LLM grabados en una traza, por operación. Cada llamada
+    al servidor simulado toma la siguiente muestra de su operación (en bucle), de modo
+    que la distribución de latencias y tokens se reproduce en el mismo orden.
+    """
+
+    def __init__(self, samples: Dict[str, List[Tuple[float, int, int]]], default_ms: float = 500.0):
+        self.samples = samples
+        self.default_ms = default_ms
+        self._cycles = {op: itertools.cycle(values) for op, values in samples.items() if values}
+        # Si la operación no se grabó se usan todas las muestras
+        todas = [sample for values in samples.values() for sample in values]
+        self._fallback = itertools.cycle(todas) if todas else None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_trace(cls, path: str) -> "LatencyProfile":
+        samples: Dict[str, List[Tuple[float, int, int]]] = {}
+        for event in read_trace(path):
+            if event.get("kind") != "llm" or not event.get("exito", True):
+                continue
+            samples.setdefault(event["operacion"], []).append((
+                float(event["latencia_ms"]),
+                int(event.get("prompt_tokens") or 0),
+                int(event.get("completion_tokens") or 0)
+            ))
+        return cls(samples)
+
+    def next(self, operacion: Optional[str]) -> Tuple[float, int, int]:
+        """(latencia_ms, prompt_tokens, completion_tokens) de la siguiente llamada"""
+        with self._lock:
+            cycle = self._cycles.get(operacion or "") or self._fallback
+            if cycle is None:
+                return self.default_ms, 0, 50
+            return next(cycle)
@@ -0,0 +1,243 @@
+from typing import Dict, Any, Callable, List, Optional
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from sqlalchemy import Float, case, cast, func, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from .metrics import metrics
+from ..models.chat import LLMUsage
+
+logger = logging.getLogger(__name__)
+
+USAGE_GROUPS = {
+    "chatbot": LLMUsage.chatbot_id,
+    "modelo": LLMUsage.modelo,
+    "dia": func.date(LLMUsage.created_at),
+    "operacion": LLMUsage.operacion
+}
+USAGE_ORDER = ("costo", "latencia", "llamadas", "tokens")
+
+class UsageLedger:
+    """
+    Registro del uso de cada llamada al LLM: tokens (incluidos los del prompt que el
+    proveedor sirvió desde su caché de prefijos), latencia, modelo, chatbot, coste y si la
+    respuesta salió de caché.
+
+    `record` solo añade la entrada a un buffer en memoria (sin E/S en el camino de la
+    petición). Un hilo en segundo plano vuelca el buffer con un INSERT por lotes cada
+    `flush_interval` segundos o al llegar a `flush_size` entradas. Si la base de datos
+    falla, las entradas vuelven al buffer; por encima de `max_buffer` se descartan las
+    más antiguas (métrica `mcp_llm_usage_dropped_total`).
+    """
+
+    def __init__(
+        self,
+        engine_provider: Callable[[], Engine],
+        pricing: Optional[Dict[str, Dict[str, float]]] = None,
+        flush_size: int = 200,
+        flush_interval: float = 2.0,
+        max_buffer: int = 20000
+    ):
+        self._engine_provider = engine_provider
+        self.pricing = pricing or {}
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer: deque = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        metrics.register_gauge(
+            "mcp_llm_usage_buffered",
+            lambda: self.buffered,
+            "Entradas de uso del LLM pendientes de volcar"
+        )
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    def cost(
+        self,
+        modelo: Optional[str],
+        prompt_tokens: Optional[int],
+        completion_tokens: Optional[int],
+        cached_tokens: Optional[int] = None
+    ) -> Optional[float]:
+        """
+        Coste en USD según LLM_PRICING (precios por 1K tokens); None si el modelo no tiene
+        precio. Los tokens cacheados usan el precio `cached_prompt` si está definido.
+        """
+        precio = self.pricing.get(modelo or "")
+        if precio is None:
+            return None
+        cached = min(cached_tokens or 0, prompt_tokens or 0)
+        return round(
+            ((prompt_tokens or 0) - cached) / 1000 * precio.get("prompt", 0.0)
+            + cached / 1000 * precio.get("cached_prompt", precio.get("prompt", 0.0))
+            + (completion_tokens or 0) / 1000 * precio.get("completion", 0.0),
+            6
+        )
+
+    def record(
+        self,
+        operacion: str,
+        modelo: Optional[str],
+        provider: Optional[str] = None,
+        chatbot_id: Optional[int] = None,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        cached_tokens: Optional[int] = None,
+        latencia_ms: Optional[float] = None,
+        cache_hit: bool = False,
+        exito: bool = True
+    ) -> None:
+        total = (prompt_tokens or 0) + (completion_tokens or 0) if prompt_tokens is not None or completion_tokens is not None else None
+        entry = {
+            "created_at": datetime.utcnow(),
+            "operacion": operacion,
+            "chatbot_id": chatbot_id,
+            "modelo": modelo,
+            "provider": provider,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total,
+            "cached_tokens": cached_tokens,
+            "latencia_ms": round(latencia_ms, 3) if latencia_ms is not None else None,
+            "costo_usd": 0.0 if cache_hit else self.cost(modelo, prompt_tokens, completion_tokens, cached_tokens),
+            "cache_hit": cache_hit,
+            "exito": exito
+        }
+        with self._lock:
+            self._buffer.append(entry)
+            self._trim()
+            full = len(self._buffer) >= self.flush_size
+        metrics.inc("mcp_llm_calls_total", operation=operacion, cache_hit=str(cache_hit).lower())
+        if cached_tokens:
+            metrics.inc("mcp_llm_cached_tokens_total", cached_tokens, operation=operacion)
+        if full:
+            self._wake.set()
+
+    def _trim(self) -> None:
+        while len(self._buffer) > self.max_buffer:
+            self._buffer.popleft()
+            metrics.inc("mcp_llm_usage_dropped_total")
+
+    def flush(self) -> int:
+        """Vuelca el buffer en un solo INSERT multi-fila; devuelve las entradas escritas"""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._buffer)
+                self._buffer.clear()
+            if not batch:
+                return 0
+            try:
+                with self._engine_provider().begin() as conn:
+                    conn.execute(insert(LLMUsage.__table__), batch)
+            except Exception:
+                logger.exception("No se pudo volcar el registro de uso del LLM (%d entradas)", len(batch))
+                with self._lock:
+                    self._buffer.extendleft(reversed(batch))
+                    self._trim()
+                return 0
+            return len(batch)
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="mcp-usage-ledger", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Detiene el hilo y hace un último volcado"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def report(
+        self,
+        db: Session,
+        group_by: List[str],
+        desde: Optional[datetime] = None,
+        hasta: Optional[datetime] = None,
+        order_by: str = "costo",
+        limit: int = 100
+    ) -> List[Dict[str, Any]]:
+        """Coste, tokens y latencia agregados por las dimensiones de `group_by`"""
+        unknown = [group for group in group_by if group not in USAGE_GROUPS]
+        if unknown or not group_by:
+            raise ValueError(f"Agrupación no soportada. Opciones: {', '.join(USAGE_GROUPS)}")
+        if order_by not in USAGE_ORDER:
+            raise ValueError(f"Orden no soportado. Opciones: {', '.join(USAGE_ORDER)}")
+
+        dimensions = [USAGE_GROUPS[group].label(group) for group in group_by]
+        aggregates = [
+            func.count(LLMUsage.id).label("llamadas"),
+            func.coalesce(func.sum(LLMUsage.prompt_tokens), 0).label("prompt_tokens"),
+            func.coalesce(func.sum(LLMUsage.completion_tokens), 0).label("completion_tokens"),
+            func.coalesce(func.sum(LLMUsage.total_tokens), 0).label("tokens"),
+            func.coalesce(func.sum(LLMUsage.cached_tokens), 0).label("cached_tokens"),
+            func.coalesce(func.sum(LLMUsage.costo_usd), 0.0).label("costo"),
+            func.avg(LLMUsage.latencia_ms).label("latencia"),
+            func.max(LLMUsage.latencia_ms).label("latencia_max"),
+            # Latencia de las llamadas con y sin prefijo cacheado, para medir el efecto de la caché
+            func.avg(case((LLMUsage.cached_tokens > 0, LLMUsage.latencia_ms))).label("latencia_prefijo_cacheado"),
+            func.avg(case(
+                (func.coalesce(LLMUsage.cached_tokens, 0) == 0, LLMUsage.latencia_ms)
+            )).label("latencia_sin_prefijo_cacheado"),
+            func.avg(cast(case((LLMUsage.cache_hit == True, 1), else_=0), Float)).label("cache_hit_rate"),
+            func.avg(cast(case((LLMUsage.exito == False, 1), else_=0), Float)).label("error_rate")
+        ]
+        if db.bind is not None and db.bind.dialect.name == "postgresql":
+            aggregates.append(
+                func.percentile_cont(0.95).within_group(LLMUsage.latencia_ms).label("latencia_p95")
+            )
+
+        query = db.query(*dimensions, *aggregates)
+        if desde:
+            query = query.filter(LLMUsage.created_at >= desde)
+        if hasta:
+            query = query.filter(LLMUsage.created_at < hasta)
+        query = query.group_by(*[USAGE_GROUPS[group] for group in group_by])
+        order = {
+            "costo": func.coalesce(func.sum(LLMUsage.costo_usd), 0.0),
+            "latencia": func.avg(LLMUsage.latencia_ms),
+            "llamadas": func.count(LLMUsage.id),
+            "tokens": func.coalesce(func.sum(LLMUsage.total_tokens), 0)
+        }[order_by]
+        rows = query.order_by(order.desc().nullslast()).limit(limit).all()
+
+        report = []
+        for row in rows:
+            item = dict(row._mapping)
+            if "dia" in item and item["dia"] is not None:
+                item["dia"] = str(item["dia"])
+            item["cached_ratio"] = round(item["cached_tokens"] / item["prompt_tokens"], 4) if item["prompt_tokens"] else 0.0
+            for key in (
+                "costo", "latencia", "latencia_max", "latencia_p95", "latencia_prefijo_cacheado",
+                "latencia_sin_prefijo_cacheado", "cache_hit_rate", "error_rate"
+            ):
+                if item.get(key) is not None:
+                    item[key] = round(float(item[key]), 6 if key == "costo" else 3)
+            item["costo_usd"] = item.pop("costo")
+            item["latencia_ms"] = item.pop("latencia")
+            item["latencia_max_ms"] = item.pop("latencia_max")
+            item["latencia_prefijo_cacheado_ms"] = item.pop("latencia_prefijo_cacheado")
+            item["latencia_sin_prefijo_cacheado_ms"] = item.pop("latencia_sin_prefijo_cacheado")
+            if "latencia_p95" in item:
+                item["latencia_p95_ms"] = item.pop("latencia_p95")
+            report.append(item)
+        return report
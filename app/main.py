@@ -1,13 +1,50 @@
+import time
+
+# Inicio del arranque del worker (antes de importar dependencias pesadas)
+_boot_started = time.perf_counter()
+
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from .core.config import settings
+from .core.http_cache import CompressionMiddleware
 from .api.api_v1.api import router as api_router
-from .core.mcp_handler import MCPHandler
+from .core.services import services
+
+logger = logging.getLogger(__name__)
+_import_ms = round((time.perf_counter() - _boot_started) * 1000, 3)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Los servicios se crean de forma perezosa; con SERVICES_WARMUP se crean aquí
+    startup_started = time.perf_counter()
+    services.startup(warmup=settings.SERVICES_WARMUP)
+    services.boot_timings["import"] = _import_ms
+    services.record_boot("startup", startup_started)
+    services.record_boot("worker_boot", _boot_started)
+    # Sonda de retraso del event loop (gauge mcp_event_loop_lag_ms en /metrics)
+    services.loop_monitor.start()
+    # Medición del retraso de la réplica de lectura fuera del event loop
+    services.replica_router.start()
+    # Invalidaciones del estado de conversaciones publicadas por los demás workers
+    if services.conversation_state is not None:
+        services.conversation_state.start()
+    # Invalidaciones de los índices de preguntas frecuentes publicadas por los demás workers
+    if services.faq is not None:
+        services.faq.start()
+    # Trabajadores de la reevaluación de leads en segundo plano
+    if services.evaluation_scheduler is not None:
+        services.evaluation_scheduler.start()
+    logger.info("Worker listo: %s", services.boot_report())
+    yield
+    await services.shutdown()
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
     description="Servidor MCP para CRM con IA que procesa datos de manera segura",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configuración CORS
@@ -28,8 +65,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Inicializar el manejador MCP
-mcp_handler = MCPHandler()
+# Compresión de respuestas grandes (no de los flujos SSE)
+if settings.GZIP_MINIMUM_SIZE > 0:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=settings.GZIP_MINIMUM_SIZE,
+        compresslevel=settings.GZIP_COMPRESS_LEVEL,
+        exclude_paths=(f"{settings.API_V1_STR}/messages/stream",)
+    )
 
 # Incluir rutas de la API
 app.include_router(api_router, prefix=settings.API_V1_STR)
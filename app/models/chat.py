@@ -1,10 +1,25 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, JSON, Float
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, JSON, Float, UniqueConstraint, Index
+from sqlalchemy import table, column
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
 Base = declarative_base()
 
+# Tablas del CRM que este servicio solo consulta para filtrar (construcciones ligeras, sin ORM)
+conversaciones_table = table(
+    "conversaciones",
+    column("id"), column("lead_id"), column("chatbot_id"), column("canal_id"),
+    column("estado"), column("chatbot_activo"), column("ultimo_mensaje")
+)
+
+mensajes_table = table(
+    "mensajes",
+    column("id"), column("conversacion_id"), column("origen"), column("remitente_id"),
+    column("contenido"), column("tipo_contenido"), column("metadata", JSON),
+    column("leido"), column("created_at")
+)
+
 class MensajeSanitizado(Base):
     __tablename__ = "mensajes_sanitizados"
     
@@ -23,8 +38,14 @@ class ContextoConversacional(Base):
     tipo_contexto = Column(String)
     contenido_sanitizado = Column(String)
     relevancia_score = Column(Float)
+    # Score con decaimiento normalizado en dominio logarítmico (ver app.core.relevance)
+    relevancia_log = Column(Float)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_contexto_token_relevancia", "token_anonimo", "relevancia_log"),
+    )
 
 class PIIToken(Base):
     __tablename__ = "pii_tokens"
@@ -86,4 +107,94 @@ class EvaluacionLLM(Base):
     llm_configuracion_id = Column(Integer, ForeignKey("llm_configuraciones.id"))
     prompt_utilizado = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
\ No newline at end of file
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        # Historial por lead ordenado por fecha y marca de agua (max id/fecha, conteo) solo con el índice
+        Index("ix_evaluaciones_lead_fecha", "lead_id", "fecha_evaluacion", "id"),
+    )
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    
+    id = Column(Integer, primary_key=True)
+    scope = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    request_hash = Column(String)
+    respuesta = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime)
+    
+    __table_args__ = (
+        UniqueConstraint("scope", "key", name="uq_idempotency_scope_key"),
+    )
+
+class LeadWatermark(Base):
+    __tablename__ = "lead_evaluacion_watermarks"
+    
+    id = Column(Integer, primary_key=True)
+    lead_id = Column(Integer, ForeignKey("leads.id"), unique=True, index=True)
+    evaluacion_id = Column(Integer, ForeignKey("evaluaciones_llm.id"))
+    ultimo_mensaje_at = Column(DateTime)
+    ultimo_contexto_at = Column(DateTime)
+    mensajes_evaluados = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class CohortRollup(Base):
+    __tablename__ = "cohort_rollups"
+    
+    id = Column(Integer, primary_key=True)
+    dimension = Column(String, nullable=False)
+    valor = Column(String, nullable=False)
+    # Agregados de score_potencial: conteo, media y M2 (Welford) e histograma de bins fijos
+    total = Column(Integer, default=0)
+    media = Column(Float, default=0.0)
+    m2 = Column(Float, default=0.0)
+    histograma = Column(JSON)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint("dimension", "valor", name="uq_cohort_dimension_valor"),
+    )
+
+class CohortLeadScore(Base):
+    __tablename__ = "cohort_lead_scores"
+    
+    # Aportación vigente de cada lead a los agregados por cohorte (se reemplaza, no se acumula)
+    lead_id = Column(Integer, ForeignKey("leads.id"), primary_key=True)
+    evaluacion_id = Column(Integer, ForeignKey("evaluaciones_llm.id"))
+    score = Column(Float)
+    cohorte = Column(JSON)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class LeadProfileFeatures(Base):
+    __tablename__ = "lead_profile_features"
+    
+    # Features de perfil de cada lead (salida de extract_profile_analytics, sin datos personales)
+    lead_id = Column(Integer, ForeignKey("leads.id"), primary_key=True)
+    analytics = Column(JSON)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+class LLMUsage(Base):
+    __tablename__ = "llm_usage"
+    
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    operacion = Column(String)
+    chatbot_id = Column(Integer, ForeignKey("chatbots.id"), nullable=True)
+    modelo = Column(String)
+    provider = Column(String)
+    prompt_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
+    total_tokens = Column(Integer)
+    # Tokens del prompt servidos desde la caché de prefijos del proveedor
+    cached_tokens = Column(Integer)
+    latencia_ms = Column(Float)
+    costo_usd = Column(Float)
+    cache_hit = Column(Boolean, default=False)
+    exito = Column(Boolean, default=True)
+    
+    __table_args__ = (
+        Index("ix_llm_usage_chatbot_fecha", "chatbot_id", "created_at"),
+        Index("ix_llm_usage_modelo_fecha", "modelo", "created_at"),
+    )
@@ -125,4 +125,9 @@ class ContextoConversacionalCreate(ContextoConversacionalBase):
 class ContextoConversacionalResponse(ContextoConversacionalBase):
     id: int
     created_at: datetime
-    updated_at: datetime
\ No newline at end of file
+    updated_at: datetime
+
+class LeadProfileCreate(BaseModel):
+    lead_id: int
+    # Perfil completo; solo se materializan las features de `extract_profile_analytics`
+    profile: Dict[str, Any]
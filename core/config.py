@@ -1,15 +1,3 @@
-from pydantic_settings import BaseSettings
-
-class Settings(BaseSettings):
-    API_V1_STR: str = "/api/v1"
-    PROJECT_NAME: str = "ServidorMCP"
-    
-    # JWT
-    SECRET_KEY: str = "your-secret-key-here"
-    ALGORITHM: str = "HS256"
-    ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
-
-    class Config:
-        case_sensitive = True
-
-settings = Settings()
+# La configuración vive en app.core.config; este módulo la reexporta para que
+# emisión y verificación de tokens usen la misma SECRET_KEY y el mismo algoritmo
+from app.core.config import Settings, settings
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, insert, select
+from sqlalchemy.orm import Session
+
+from app.core.database import ReplicaRouter, create_db_engine, create_session_factory
+
+metadata = MetaData()
+origen = Table(
+    "origen",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("nombre", String(20))
+)
+
+def _database(path, nombre):
+    """Base SQLite con una sola fila que identifica de qué base se leyó"""
+    engine = create_db_engine(f"sqlite:///{path}")
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(origen).values(id=1, nombre=nombre))
+    return engine
+
+def _read(session: Session) -> str:
+    try:
+        return session.execute(select(origen.c.nombre)).scalar_one()
+    finally:
+        session.close()
+
+@pytest.fixture
+def primary(tmp_path):
+    engine = _database(tmp_path / "primario.db", "primario")
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def replica(tmp_path):
+    engine = _database(tmp_path / "replica.db", "replica")
+    yield engine
+    engine.dispose()
+
+def _router(primary, replica=None, **kwargs):
+    factory = create_session_factory(primary)
+    return ReplicaRouter(primary_factory=lambda: factory, replica_engine=replica, **kwargs)
+
+def test_reads_go_to_replica_when_up_to_date(primary, replica):
+    router = _router(primary, replica, max_lag=30.0)
+
+    assert router.replica_lag() == 0.0
+    assert _read(router.read_session()) == "replica"
+    assert router.read_engine(primary) is replica
+
+def test_lagging_replica_falls_back_to_primary(primary, replica, monkeypatch):
+    router = _router(primary, replica, max_lag=30.0)
+    monkeypatch.setattr(router, "replica_lag", lambda: 45.0)
+
+    assert not router.use_replica()
+    assert _read(router.read_session()) == "primario"
+    assert router.read_engine(primary) is primary
+
+    # En cuanto la réplica se pone al día, las lecturas vuelven a ella
+    monkeypatch.setattr(router, "replica_lag", lambda: 2.0)
+    assert _read(router.read_session()) == "replica"
+
+def test_unreachable_replica_falls_back_to_primary(primary, tmp_path):
+    ausente = create_db_engine(f"sqlite:///{tmp_path / 'no-existe' / 'replica.db'}")
+    router = _router(primary, ausente, check_interval=0.0)
+
+    assert router.replica_lag() is None
+    assert _read(router.read_session()) == "primario"
+    ausente.dispose()
+
+def test_without_replica_everything_goes_to_primary(primary):
+    router = _router(primary)
+
+    assert router.replica_factory is None
+    assert router.replica_lag() is None
+    assert _read(router.read_session()) == "primario"
+    assert router.read_engine(primary) is primary
+
+def test_lag_is_checked_at_most_every_interval(primary, replica, monkeypatch):
+    router = _router(primary, replica, check_interval=60.0)
+    assert router.replica_lag() == 0.0
+
+    # Dentro del intervalo se reutiliza el valor medido sin volver a conectar
+    connects = []
+    monkeypatch.setattr(replica, "connect", lambda: connects.append(1))
+    router.lag = 90.0
+    assert router.replica_lag() == 90.0
+    assert connects == []
+    assert _read(router.read_session()) == "primario"
+
+def test_background_refresh_never_connects_from_the_caller(primary, replica, monkeypatch):
+    router = _router(primary, replica, check_interval=60.0)
+
+    async def main():
+        router.start()
+        await asyncio.sleep(0.1)
+        # Con la medición en segundo plano, decidir solo lee el último valor
+        connects = []
+        monkeypatch.setattr(replica, "connect", lambda: connects.append(1))
+        router.lag = 90.0
+        use = router.use_replica()
+        await router.stop()
+        return connects, use
+
+    connects, use = asyncio.run(main())
+    assert connects == []
+    assert not use
+    assert router._task is None
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from app.core.singleflight import SingleFlight
+
+def test_concurrent_calls_share_one_execution():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "resultado"
+
+        results = await asyncio.gather(*(flight.do("clave", compute) for _ in range(3)))
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(main())
+    assert results == ["resultado"] * 3
+    assert calls == [1]
+    assert flight.stats["executed"] == 1 and flight.stats["coalesced"] == 2
+    assert flight.inflight == 0
+
+def test_cancelled_leader_does_not_fail_followers():
+    async def main():
+        flight = SingleFlight(max_results=10)
+        started = asyncio.Event()
+
+        async def compute():
+            started.set()
+            await asyncio.sleep(0.05)
+            return 42
+
+        leader = asyncio.create_task(flight.do("clave", compute))
+        await started.wait()
+        follower = asyncio.create_task(flight.do("clave", compute))
+        await asyncio.sleep(0)
+        # El cliente del líder se desconecta: el cálculo sigue y el seguidor recibe el resultado
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return flight, await follower
+
+    flight, result = asyncio.run(main())
+    assert result == 42
+    assert flight.stats["executed"] == 1
+    assert flight.cached("clave") == 42
+
+def test_errors_reach_every_caller_and_are_not_cached():
+    async def main():
+        flight = SingleFlight(max_results=10)
+
+        async def compute():
+            await asyncio.sleep(0.01)
+            raise ValueError("fallo")
+
+        results = await asyncio.gather(
+            flight.do("clave", compute), flight.do("clave", compute), return_exceptions=True
+        )
+        return flight, results
+
+    flight, results = asyncio.run(main())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert flight.cached("clave") is None
+    assert flight.inflight == 0